@@ -6,9 +6,10 @@ import sys
 import nltk
 import re
 import numpy as np
-import networkx as nx
 import os
+from collections import Counter
 from nltk.corpus import stopwords
+from scipy.sparse import csr_matrix, diags
 
 sys.path.append(os.path.dirname(os.path.realpath(__file__)))
 # print the current working directory
@@ -26,7 +27,7 @@ while True:
 
 print("Max field size limit: ", maxInt)
 # nltk.download('stopwords')
-stop_words = stopwords.words('english')
+stop_words = set(stopwords.words('english'))
 
 #load document paths
 def read_data(path: str = "articles50000.csv") -> List[Article]:
@@ -59,36 +60,88 @@ def preprocess(text: str, remove_stop: bool=True) -> str:
     return [t for t in engine.preprocess(text) if t not in stop_words]
 
 
-def get_similarity(sent1: str, sent2: str) -> np.float32:
-    
-    terms1 = preprocess(sent1)
-    terms2 = preprocess(sent2)
-
-    terms = list(set(terms1 + terms2))
-
-    sent1_vec = np.zeros(len(terms), dtype='int32')
-    sent2_vec = np.zeros(len(terms), dtype='int32')
-
-    for term in terms1:
-        sent1_vec[terms.index(term)] += 1
-    
-    for term in terms2:
-        sent2_vec[terms.index(term)] += 1
-    
-    return 1 - nltk.cluster.cosine_distance(sent1_vec, sent2_vec)
-
+def get_sentence_vectors(sentences: List[str], query: str = None) -> csr_matrix:
+    """
+    The term counts of the sentences, one row per sentence, each sentence preprocessed once.
+    With a query, its counts are the last row.
+    """
+    texts = sentences + ([query] if query is not None else [])
+    vocabulary = {}
+    rows, cols, values = [], [], []
+    for row, text in enumerate(texts):
+        for term, count in Counter(preprocess(text)).items():
+            rows.append(row)
+            cols.append(vocabulary.setdefault(term, len(vocabulary)))
+            values.append(count)
+    return csr_matrix(
+        (np.array(values, dtype='float32'), (rows, cols)), shape=(len(texts), len(vocabulary))
+    )
+
+
+def normalize_rows(vectors: csr_matrix) -> csr_matrix:
+    norms = np.sqrt(np.asarray(vectors.multiply(vectors).sum(axis=1)).ravel())
+    # the sentences without terms are left as zero rows, they are similar to nothing
+    return diags(np.divide(1.0, norms, out=np.zeros_like(norms), where=norms > 0)) @ vectors
+
+
+def get_cosine_graph(vectors: csr_matrix) -> csr_matrix:
+    """The similarities of normalized vectors, in one sparse product, without self-similarity"""
+    sim_matrix = (vectors @ vectors.T).tocsr()
+    sim_matrix.setdiag(0)
+    sim_matrix.eliminate_zeros()
+    return sim_matrix
 
-def get_similarity_matrix(sentences: List[str]) -> np.ndarray:
-  
-    n = len(sentences)
-    sim_matrix = np.zeros((n, n), dtype='float32')
 
-    for i in range(n):
-        for j in range(n):
-            if i != j:
-                sim_matrix[i, j] = get_similarity(sentences[i], sentences[j])
-        
-    return sim_matrix
+def get_similarity_matrix(sentences: List[str]) -> csr_matrix:
+    return get_cosine_graph(normalize_rows(get_sentence_vectors(sentences)))
+
+
+def pagerank(
+    sim_matrix: csr_matrix,
+    personalization: np.ndarray = None,
+    alpha: float = 0.85,
+    max_iter: int = 100,
+    tol: float = 1.0e-6,
+) -> np.ndarray:
+    """
+    PageRank of the weighted graph of the matrix by power iteration, like networkx.pagerank:
+    the sentences without edges jump by the personalization, uniform by default.
+    """
+    n = sim_matrix.shape[0]
+    if n == 0:
+        return np.zeros(0)
+    p = np.full(n, 1.0 / n) if personalization is None else personalization / personalization.sum()
+    out_weights = np.asarray(sim_matrix.sum(axis=1)).ravel()
+    dangling = out_weights == 0
+    transition = diags(np.divide(1.0, out_weights, out=np.zeros(n), where=~dangling)) @ sim_matrix
+    transition_t = transition.T.tocsr()
+
+    x = np.full(n, 1.0 / n)
+    for _ in range(max_iter):
+        x_last = x
+        x = alpha * (transition_t @ x_last + x_last[dangling].sum() * p) + (1 - alpha) * p
+        if np.abs(x - x_last).sum() < n * tol:
+            break
+    return x
+
+
+def textrank(sentences: List[str], sentence_cnt: int, query: str = None) -> List[int]:
+    """
+    Indices of the `sentence_cnt` sentences of highest TextRank, highest first.
+    With a query, the random jumps favour the sentences similar to it, for query-biased
+    summaries such as result snippets.
+    """
+    vectors = normalize_rows(get_sentence_vectors(sentences, query))
+    sentence_vectors = vectors[: len(sentences)]
+    sim_matrix = get_cosine_graph(sentence_vectors)
+
+    personalization = None
+    if query is not None:
+        query_similarities = np.asarray((sentence_vectors @ vectors[len(sentences)].T).todense()).ravel()
+        if query_similarities.sum() > 0:
+            personalization = query_similarities
+    scores = pagerank(sim_matrix, personalization)
+    return [int(i) for i in np.argsort(-scores, kind='stable')[:sentence_cnt]]
 
 
 def cosine_pagerank(doc: Article, query: str, sentence_cnt: int) -> str:
@@ -96,18 +149,18 @@ def cosine_pagerank(doc: Article, query: str, sentence_cnt: int) -> str:
     result = [doc.title, '\n']
     
     sentences = get_text_sentences(doc.body)
-    similarity_matrix = get_similarity_matrix(sentences)
-    
-    graph = nx.from_numpy_matrix(similarity_matrix)
-    sentence_scores = nx.pagerank(graph)
-
-    sentence_scores = sorted(sentence_scores.items(), key=lambda kv: kv[1], reverse=True)
-    for i in range(sentence_cnt):
-        result.append(sentences[sentence_scores[i][0]] + ' ')
+    for i in textrank(sentences, sentence_cnt):
+        result.append(sentences[i] + ' ')
     
     return ''.join(result)
 
 
+def query_biased_summary(text: str, query: str, sentence_cnt: int = 2) -> str:
+    """The sentences of a text that summarize it best for a query, in their order in the text"""
+    sentences = get_text_sentences(text)
+    return ' '.join(sentences[i] for i in sorted(textrank(sentences, sentence_cnt, query)))
+
+
 def doc_sum(doc: Article, query: str, sentence_cnt: int = 5):
     
     if len(get_text_sentences(doc.body)) < sentence_cnt:
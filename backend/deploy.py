@@ -1,6 +1,8 @@
 from fastapi import FastAPI, HTTPException
 import uvicorn
 from routers.api import router as api_router
+from utils.startup import lifespan
+from metrics import server_timing_middleware
 from fastapi.staticfiles import StaticFiles
 from dotenv import load_dotenv
 import os
@@ -8,7 +10,8 @@ from starlette.exceptions import HTTPException as StarletteHTTPException
 
 load_dotenv()
 os.chdir(os.path.dirname(os.path.abspath(__file__)))
-app = FastAPI(dependencies=[])
+app = FastAPI(dependencies=[], lifespan=lifespan)
+app.middleware("http")(server_timing_middleware)
 app.include_router(api_router)
 class SPAStaticFiles(StaticFiles):
     async def get_response(self, path: str, scope):
@@ -1,6 +1,8 @@
 from fastapi import FastAPI
 import uvicorn
 from routers.api import router as api_router
+from utils.startup import lifespan
+from metrics import server_timing_middleware
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from dotenv import load_dotenv
@@ -10,7 +12,7 @@ load_dotenv()
 os.chdir(os.path.dirname(os.path.abspath(__file__)))
 
 
-app = FastAPI(dependencies=[])
+app = FastAPI(dependencies=[], lifespan=lifespan)
 
 # change the port if you want (react app)
 origins = [
@@ -27,6 +29,7 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.middleware("http")(server_timing_middleware)
 app.include_router(api_router)
 
 if __name__ == "__main__":
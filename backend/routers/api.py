@@ -1,6 +1,10 @@
 from fastapi import APIRouter
 from .search import router as search_router
 from .file import router as file_router
+from .metrics import router as metrics_router
+from .health import router as health_router
 router = APIRouter()
 router.include_router(search_router)
 router.include_router(file_router)
+router.include_router(metrics_router)
+router.include_router(health_router)
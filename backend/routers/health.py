@@ -0,0 +1,29 @@
+from fastapi import APIRouter
+from fastapi.responses import ORJSONResponse
+from os.path import basename
+from utils.startup import is_ready, startup_state
+
+router = APIRouter(
+    prefix=f"/{basename(__file__).replace('.py', '')}",
+    tags=[basename(__file__).replace('.py', '')],
+    dependencies=[],
+    responses={404: {"description": "Not found"}}
+)
+
+@router.get("/live")
+async def live():
+    r'''
+    Liveness probe, the server is up and answering requests.
+    '''
+    return ORJSONResponse(content={"status": "alive"})
+
+@router.get("/ready")
+async def ready():
+    r'''
+    Readiness probe, 503 until the models required by the endpoints are loaded.
+    ```
+        - status: starting, ready or failed
+        - resources: loading state of every model
+    ```
+    '''
+    return ORJSONResponse(content=startup_state, status_code=200 if is_ready() else 503)
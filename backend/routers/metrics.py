@@ -0,0 +1,19 @@
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+from os.path import basename
+import utils  # the top-level names of the utils modules, see utils/__init__.py
+from metrics import generate_latest
+
+router = APIRouter(
+    prefix=f"/{basename(__file__).replace('.py', '')}",
+    tags=[basename(__file__).replace('.py', '')],
+    dependencies=[],
+    responses={404: {"description": "Not found"}}
+)
+
+@router.get("")
+async def metrics():
+    r'''
+    Exposing the query latency histograms in the Prometheus text format.
+    '''
+    return PlainTextResponse(content=generate_latest(), media_type="text/plain; version=0.0.4")
@@ -1,26 +1,38 @@
 from fastapi import APIRouter, Depends, Query
-from fastapi.responses import ORJSONResponse
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from os.path import basename
 from os import getenv
-from typing import Optional, Annotated
-from pydantic import BaseModel, Field
+from typing import Optional, Annotated, Literal
+from pydantic import BaseModel, Field, constr
 from utils.basetype import Result
-from utils.query_engine import boolean_test, ranked_test, check_query
+from utils.query_engine import (
+    boolean_test,
+    ranked_test,
+    check_query,
+    sharded_boolean_search,
+    sharded_ranked_search,
+)
 from utils.redis_utils import (
     caching_query_result,
     get_cache,
     get_docs_fields,
     check_cache_exists,
+    get_tfidf_max_results,
+    is_index_sharding_enabled,
 )
+from utils.batch_evaluation import evaluate_batch, to_trec_lines
 from utils.basetype import RedisKeys, RedisDocKeys
 #from ai.QE_Bert import expand_query
-from utils.roberta import expand_query
 from math import ceil
 from utils.spell_checker import SpellChecker
-from utils.query_suggestion import QuerySuggestion
+from query_suggestion import load_query_suggestion
+from utils.dictionary_updates import load_following_dictionary_deltas
+from utils.query_popularity import QueryPopularityRecorder, load_following_query_popularity
 from urllib.parse import unquote
 from typing import List, Dict, Tuple
 from utils.query_expander import QueryExpander
+from executors import get_endpoint_executor, register_resource
+from functools import partial
 from utils.constant import (
     MONOGRAM_PKL_PATH,
     STOP_WORDS_FILE_PATH,
@@ -70,6 +82,13 @@ async def test(body: TestBody):
     test_env = getenv("TESTING", "default")
     return ORJSONResponse(content={"field": body.field, "env": test_env})
 
+INDEX_SHARDING = is_index_sharding_enabled()
+# the pages of a tf-idf search end at the best TFIDF_MAX_RESULTS documents
+TFIDF_MAX_RESULTS = get_tfidf_max_results()
+# the searched words feed the ranking of the query suggestions
+query_popularity_recorder = QueryPopularityRecorder()
+
+
 def paginate_doc_ids(doc_ids: List[int], current_page: int, limit: int, total_pages: int) -> Dict[int, List[int]]:
     """Function to paginated doc_ids"""
     start_page = max(current_page - 4, 1)
@@ -95,13 +114,18 @@ async def boolean_search(
     """
 
     q = unquote(q)
+    if page == 1:
+        query_popularity_recorder.record(q)
     
     # uncomment this when the caching is ready
     if await check_cache_exists(RedisKeys.cache("boolean", q, page)):
         results = await get_cache(RedisKeys.cache("boolean", q, page))
         return ORJSONResponse(content=results)
 
-    results = await boolean_test([q])
+    if INDEX_SHARDING:
+        results = [await sharded_boolean_search(q)]
+    else:
+        results = await boolean_test([q])
     total_pages = ceil(len(results[0]) / limit)
     if not results or len(results) > page * limit or total_pages == 0:
         return []
@@ -152,12 +176,17 @@ async def tfidf_search(
     """
 
     q = unquote(q)
+    if page == 1:
+        query_popularity_recorder.record(q)
     
     if await check_cache_exists(RedisKeys.cache("tfidf", q, page)):
         results = await get_cache(RedisKeys.cache("tfidf", q, page))
         return ORJSONResponse(content=results)
 
-    results = await ranked_test([q])
+    if INDEX_SHARDING:
+        results = [await sharded_ranked_search(q, top_k=TFIDF_MAX_RESULTS)]
+    else:
+        results = await ranked_test([q], top_k=TFIDF_MAX_RESULTS)
     total_pages = ceil(len(results[0]) / limit)
     if not results or len(results) > page * limit or total_pages == 0:
         return []
@@ -181,7 +210,50 @@ async def tfidf_search(
     return ORJSONResponse(content=page_results)
 
 
-spell_checker = SpellChecker(dictionary_path=MONOGRAM_PKL_PATH)
+class BatchQuery(BaseModel):
+    id: str = Field(..., description="Query id", min_length=1, max_length=64)
+    query: str = Field(..., description="Search query", min_length=1, max_length=1024)
+
+
+class BatchEvaluationBody(BaseModel):
+    queries: List[BatchQuery] = Field(..., min_length=1, max_length=10000)
+    method: Literal["boolean", "tfidf"] = "tfidf"
+    top_k: int = Field(1000, description="Results per query", ge=1, le=1000)
+    run_name: str = Field("ttds", min_length=1, max_length=64)
+
+
+@router.post("/batch")
+async def batch_evaluation(body: BatchEvaluationBody):
+    r"""
+    Evaluating many queries concurrently. Streams a TREC run file
+    (query_id Q0 doc_id rank score run_name) as the queries complete.
+    ```
+        - queries: list of {id, query}
+        - method: boolean or tfidf (default: tfidf)
+        - top_k: results per query for tfidf (default: 1000)
+        - run_name: run name of the TREC run file
+    ```
+    """
+    queries = [(item.id, unquote(item.query)) for item in body.queries]
+
+    async def stream_run_file():
+        async for query_id, result in evaluate_batch(queries, body.method, body.top_k):
+            for line in to_trec_lines(query_id, result, body.run_name):
+                yield line
+
+    return StreamingResponse(stream_run_file(), media_type="text/plain")
+
+
+# the models are loaded at startup where their executor runs, see utils/startup.py
+# both keep merging the dictionary deltas of the daily articles, see utils/dictionary_updates.py
+register_resource(
+    "spell_checker",
+    partial(load_following_dictionary_deltas, partial(SpellChecker, dictionary_path=MONOGRAM_PKL_PATH)),
+)
+# SymSpell is pure Python, so it runs in the process pool
+spellcheck_executor = get_endpoint_executor(
+    "spellcheck", default_mode="process", resources=["spell_checker"]
+)
 
 
 @router.get("/spellcheck")
@@ -196,7 +268,24 @@ async def spellcheck(
     """
     # spell_checker.correct_query("bidan vs trumpp uneted stetes of amurica"))
     q=unquote(q)
-    return spell_checker.correct_query(q)
+    return await spellcheck_executor.call_resource("spell_checker", "correct_query", q)
+
+
+class SpellcheckBatchBody(BaseModel):
+    # every query is limited like the q of /spellcheck
+    queries: List[constr(min_length=1, max_length=1024)] = Field(..., min_length=1, max_length=1000)
+
+
+@router.post("/spellcheck-batch")
+async def spellcheck_batch(body: SpellcheckBatchBody):
+    r"""
+    Spell checking many query strings in one call. Returns the corrected strings in order.
+    ```
+        - queries: queries to correct, at most 1000 of at most 1024 characters.
+    ```
+    """
+    queries = [unquote(q) for q in body.queries]
+    return await spellcheck_executor.call_resource("spell_checker", "correct_queries", queries)
 
 @router.get("/validate-boolean-query")
 async def validate_boolean_query(
@@ -244,13 +333,20 @@ async def validate_boolean_query(
 #     return ORJSONResponse(content={"expanded_queries": suggestions})
 
 # Query expansion with word2vec
-expander = QueryExpander()
+# optional, the word2vec model is only loaded by the first expansion
+register_resource("query_expander", QueryExpander, optional=True)
+# most_similar is numpy work that releases the GIL, so threads are enough
+query_expansion_executor = get_endpoint_executor(
+    "query-expansion", default_mode="thread", resources=["query_expander"]
+)
 @router.get("/query-expansion")
 async def query_expansion(
     q: str = Query(..., description="Search query", min_length=1, max_length=1024),
     expansions: int = Query(3, description="Number of expansions", ge=1, le=10)
 ):
-    expanded_query, added_terms = expander.expand_query(q, expansions)
+    expanded_query, added_terms = await query_expansion_executor.call_resource(
+        "query_expander", "expand_query", q, expansions
+    )
     return ORJSONResponse(content={"expanded_query": expanded_query, "added_terms": added_terms})
 
 # Query Expansion with Roberta
@@ -267,8 +363,20 @@ class ExpansionQuery(BaseModel):
 
 
 # query suggestion with bigram bk trees
-query_suggestion = QuerySuggestion(monogram_pkl_path=MONOGRAM_PKL_PATH)
-query_suggestion.load_words(words_path=MONOGRAM_AND_BIGRAM_DICTIONARY_PATH)
+register_resource(
+    "query_suggestion",
+    partial(
+        load_following_query_popularity,
+        partial(
+            load_following_dictionary_deltas,
+            partial(load_query_suggestion, MONOGRAM_PKL_PATH, MONOGRAM_AND_BIGRAM_DICTIONARY_PATH),
+        ),
+    ),
+)
+# the trie search is pure Python, so it runs in the process pool
+query_suggestion_executor = get_endpoint_executor(
+    "query-suggestion", default_mode="process", resources=["query_suggestion"]
+)
 
 # this is not query expansion, but SUGGESTION, but leaving it like this in order 
 # to not break the frontend
@@ -280,5 +388,8 @@ async def suggest_query_api(query_data: ExpansionQuery):
         - q: query to search (string)
     ```
     """
-    suggestions =  query_suggestion.get_query_suggestions(query_data.query)
+    suggestions = await query_suggestion_executor.call_resource(
+        "query_suggestion", "get_query_suggestions", query_data.query
+    )
     return ORJSONResponse(content={"expanded_queries": suggestions})
+
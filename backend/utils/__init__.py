@@ -0,0 +1,7 @@
+import os
+import sys
+
+# the utils modules import each other by their top-level names. The app imports the modules
+# holding shared state (metrics, executors, query_suggestion) by these names too, so there is
+# a single copy of each instead of one per name.
+sys.path.append(os.path.dirname(__file__))
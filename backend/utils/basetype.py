@@ -116,6 +116,22 @@ class RedisKeys:
     """term frequencies for a term (Dict[doc_id, int])"""
     df = lambda term: f"df:{term}"
     """document frequencies for a term (int)"""
+    shards = "meta:shards"
+    """ids of the doc-id range shards of the index (Set[int])"""
+    shard = lambda shard_id, key: key if shard_id is None else f"shard:{shard_id}:{key}"
+    """key inside a doc-id range shard, the key itself for the unsharded index"""
+    dictionary_deltas = "meta:dictionary_deltas"
+    """word and bigram counts of the daily articles, in the order they were pushed (List[json])"""
+    dictionary_delta_names = "meta:dictionary_delta_names"
+    """names of the pushed dictionary deltas (Set[str])"""
+    monogram_totals = "meta:monogram_totals"
+    """counts of the words pushed in the dictionary deltas (Hash[word, int])"""
+    bigram_totals = "meta:bigram_totals"
+    """counts of the bigrams pushed in the dictionary deltas (Hash["word word", int])"""
+    query_popularity = "meta:query_popularity"
+    """most searched words and bigrams with their forward decayed counts (SortedSet[term, float])"""
+    query_popularity_epoch = "meta:query_popularity_epoch"
+    """unix time the forward decayed counts are relative to, once they were rebased (float)"""
 
 
 class RedisDocKeys:
@@ -0,0 +1,171 @@
+import os
+import sys
+import time
+import asyncio
+import argparse
+from typing import AsyncIterator, Dict, Iterator, List, Optional, Tuple
+
+sys.path.append(os.path.dirname(__file__))
+
+from common import get_preprocessed_words
+from executors import get_endpoint_executor, shutdown_executors
+from query_engine import (
+    evaluate_boolean_query,
+    parse_queries,
+    rank_documents,
+    sharded_boolean_search,
+    sharded_ranked_search,
+)
+from redis_utils import get_doc_ids_list, get_tfidf_doc_size, get_tfs, is_index_sharding_enabled
+
+# number of terms requested with a single MGET
+TERM_FETCH_BATCH_SIZE = 500
+DEFAULT_RUN_NAME = "ttds"
+
+
+async def fetch_tfs_for_queries(
+    words_lists: List[List[str]],
+) -> Dict[str, Dict[str, int]]:
+    """Fetch the term frequencies of every distinct term of the queries once"""
+    unique_words = list(dict.fromkeys(word for words in words_lists for word in words))
+    tfs = {}
+    for i in range(0, len(unique_words), TERM_FETCH_BATCH_SIZE):
+        tfs.update(await get_tfs(unique_words[i : i + TERM_FETCH_BATCH_SIZE]))
+    return tfs
+
+
+async def evaluate_ranked_batch(
+    queries: List[Tuple[str, str]],
+    top_k: Optional[int] = 1000,
+    concurrency: int = 32,
+) -> AsyncIterator[Tuple[str, List[Tuple[str, float]]]]:
+    """
+    Yield (query_id, ranked results) in completion order.
+    The scoring runs in the scoring executor of the search endpoints, see executors.py.
+    """
+    if is_index_sharding_enabled():
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def search(query_id: str, query: str):
+            async with semaphore:
+                return query_id, await sharded_ranked_search(query, top_k)
+
+        for task in asyncio.as_completed([search(query_id, query) for query_id, query in queries]):
+            yield await task
+        return
+
+    # the unsharded index: the queries are scored in windows of `concurrency`, the terms
+    # of a window are fetched once and released after its scoring
+    docs_size = await get_tfidf_doc_size()
+    scoring_executor = get_endpoint_executor("scoring", default_mode="process")
+
+    async def score(query_id: str, words: List[str], tfs: Dict[str, Dict[str, int]]):
+        query_tfs = {word: tfs[word] for word in words if word in tfs}
+        if not query_tfs:
+            return query_id, []
+        scores = await scoring_executor.run(rank_documents, words, docs_size, query_tfs, None, top_k)
+        return query_id, scores
+
+    for i in range(0, len(queries), concurrency):
+        window = queries[i : i + concurrency]
+        words_lists = [get_preprocessed_words(query) for _, query in window]
+        tfs = await fetch_tfs_for_queries(words_lists)
+        tasks = [
+            score(query_id, words, tfs)
+            for (query_id, _), words in zip(window, words_lists)
+        ]
+        for task in asyncio.as_completed(tasks):
+            yield await task
+        del tfs, tasks
+
+
+async def evaluate_boolean_batch(
+    queries: List[Tuple[str, str]],
+    concurrency: int = 32,
+) -> AsyncIterator[Tuple[str, List[int]]]:
+    """Yield (query_id, doc_ids) in completion order"""
+    index_sharding = is_index_sharding_enabled()
+    doc_ids_list = None if index_sharding else await get_doc_ids_list()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def evaluate(query_id: str, query: str):
+        async with semaphore:
+            if index_sharding:
+                return query_id, await sharded_boolean_search(query)
+            return query_id, await evaluate_boolean_query(query, doc_ids_list)
+
+    tasks = [evaluate(query_id, query) for query_id, query in queries]
+    for task in asyncio.as_completed(tasks):
+        yield await task
+
+
+def to_trec_lines(
+    query_id: str, results: list, run_name: str = DEFAULT_RUN_NAME
+) -> Iterator[str]:
+    """Format the results of a query as TREC run lines, boolean matches get a score of 1"""
+    if results and not isinstance(results[0], tuple):
+        results = [(doc_id, 1.0) for doc_id in sorted(results)]
+    for rank, (doc_id, score) in enumerate(results, start=1):
+        yield f"{query_id} Q0 {doc_id} {rank} {score:.4f} {run_name}\n"
+
+
+async def evaluate_batch(
+    queries: List[Tuple[str, str]],
+    method: str = "tfidf",
+    top_k: Optional[int] = 1000,
+    concurrency: int = 32,
+) -> AsyncIterator[Tuple[str, list]]:
+    if method == "boolean":
+        results = evaluate_boolean_batch(queries, concurrency)
+    elif method == "tfidf":
+        results = evaluate_ranked_batch(queries, top_k, concurrency)
+    else:
+        raise ValueError(f"Invalid method: {method}")
+    async for query_id, result in results:
+        yield query_id, result
+
+
+async def write_run_file(
+    queries: List[Tuple[str, str]],
+    output_path: str,
+    method: str = "tfidf",
+    top_k: Optional[int] = 1000,
+    concurrency: int = 32,
+    run_name: str = DEFAULT_RUN_NAME,
+):
+    """Evaluate the queries and stream the results to a TREC run file as they complete"""
+    with open(output_path, "w") as f:
+        async for query_id, result in evaluate_batch(queries, method, top_k, concurrency):
+            f.writelines(to_trec_lines(query_id, result, run_name))
+            f.flush()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evaluate a query file into a TREC run file")
+    parser.add_argument("queries", help='file with one "query_id: query" per line')
+    parser.add_argument("--output", default="run.txt")
+    parser.add_argument("--method", choices=["boolean", "tfidf"], default="tfidf")
+    parser.add_argument("--top-k", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--run-name", default=DEFAULT_RUN_NAME)
+    args = parser.parse_args()
+
+    with open(args.queries, "r") as f:
+        queries = parse_queries(f.read())
+
+    start_time = time.time()
+    try:
+        # the scoring processes are set by EXECUTOR_PROCESS_WORKERS
+        asyncio.run(
+            write_run_file(
+                queries,
+                args.output,
+                method=args.method,
+                top_k=args.top_k,
+                concurrency=args.concurrency,
+                run_name=args.run_name,
+            )
+        )
+    finally:
+        shutdown_executors()
+    print(f"Evaluated {len(queries)} queries in {time.time() - start_time:.2f} seconds")
@@ -0,0 +1,375 @@
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import platform
+import subprocess
+import orjson
+import numpy as np
+from datetime import date, datetime
+from typing import Callable, Dict, List, Tuple
+
+sys.path.append(os.path.dirname(__file__))
+
+from basetype import (
+    NewsArticleData,
+    NewsArticlesBatch,
+    NewsArticlesFragment,
+    RedisKeys,
+)
+from build_index import positional_inverted_index, encode_index
+from common import get_preprocessed_words, get_stop_words, load_batch_from_news_source
+from constant import Source
+from query_engine import evaluate_boolean_query, evaluate_ranked_query
+import redis_utils
+from redis_utils import (
+    batch_push_news_data,
+    check_cache_exists,
+    get_cache,
+    get_doc_ids_list,
+    get_tfidf_doc_size,
+    initialize_async_redis,
+    set_cache,
+    update_index,
+    update_tfidf_index,
+)
+
+BASEPATH = os.path.dirname(__file__)
+BENCHMARK_RESULTS_PATH = os.path.join(BASEPATH, "benchmark_results")
+LOCAL_REDIS_HOSTS = {"localhost", "127.0.0.1", "::1"}
+QUERY_TYPES = ["boolean", "phrase", "proximity", "ranked", "cache_miss", "cache_hit"]
+PERCENTILES = [50, 95, 99]
+
+SYLLABLES = [c + v for c in "bcdfghjklmnprstvz" for v in "aeiou"]
+
+
+def generate_synthetic_batch(
+    num_docs: int,
+    vocab_size: int = 20000,
+    doc_length: int = 200,
+    zipf_exponent: float = 1.1,
+    seed: int = 0,
+) -> NewsArticlesBatch:
+    """Generate articles of pseudo words drawn from a Zipf distribution, same seed gives the same corpus"""
+    rng = random.Random(seed)
+    stop_words = set(get_stop_words())
+    vocab = []
+    seen = set()
+    while len(vocab) < vocab_size:
+        word = "".join(rng.choices(SYLLABLES, k=rng.randint(2, 4)))
+        if word not in seen and word not in stop_words:
+            seen.add(word)
+            vocab.append(word)
+    cum_weights = np.cumsum(1.0 / np.arange(1, vocab_size + 1) ** zipf_exponent).tolist()
+
+    articles = []
+    for doc_id in range(1, num_docs + 1):
+        words = rng.choices(vocab, cum_weights=cum_weights, k=doc_length)
+        articles.append(
+            NewsArticleData(
+                title=" ".join(words[:8]),
+                date="2024/01/01",
+                doc_id=str(doc_id),
+                content=" ".join(words[8:]),
+                hypertext={},
+                figcaption={},
+                url=f"https://www.synthetic.com/news/topic/{doc_id}",
+            )
+        )
+
+    fragment = NewsArticlesFragment(
+        source="synthetic", date=date(2024, 1, 1), index=0, articles=articles
+    )
+    return NewsArticlesBatch(
+        doc_ids=list(range(1, num_docs + 1)),
+        indices={"synthetic": ["0"]},
+        fragments={"synthetic": [fragment]},
+    )
+
+
+def generate_query_mix(
+    news_batch: NewsArticlesBatch, num_queries: int, seed: int = 0
+) -> Dict[str, List[str]]:
+    """Draw the query terms from the articles so that every query has at least one match"""
+    rng = random.Random(seed)
+    documents = []
+    for fragments in news_batch.fragments.values():
+        for fragment in fragments:
+            for article in fragment.articles:
+                # keep the original words, the query engine stems them itself
+                words = get_preprocessed_words(
+                    article.title + "\n" + article.content, stemming=False
+                )
+                if len(words) >= 6:
+                    documents.append(words)
+    assert documents, "The corpus has no article long enough to draw queries from"
+
+    query_mix = {query_type: [] for query_type in QUERY_TYPES}
+    for _ in range(num_queries):
+        words = rng.choice(documents)
+        position = rng.randrange(len(words) - 5)
+        first, second = words[position], words[position + 1]
+        distance = rng.randint(2, 5)
+
+        if rng.random() < 0.5:
+            query_mix["boolean"].append(f"{first} AND {words[position + distance]}")
+        else:
+            query_mix["boolean"].append(f"{first} OR NOT {words[position + distance]}")
+        query_mix["phrase"].append(f'"{first} {second}"')
+        query_mix["proximity"].append(f"#{distance}({first}, {words[position + distance]})")
+        ranked_query = " ".join(rng.sample(words, rng.randint(2, 5)))
+        query_mix["ranked"].append(ranked_query)
+        query_mix["cache_miss"].append(ranked_query)
+        query_mix["cache_hit"].append(ranked_query)
+    return query_mix
+
+
+async def ensure_local_redis(redis_host: str, flush: bool, allow_remote: bool = False):
+    """Refuse to run against a remote or non-empty redis, the benchmark overwrites every db"""
+    if redis_host not in LOCAL_REDIS_HOSTS and not allow_remote:
+        raise ValueError(
+            f"Refusing to benchmark against {redis_host}, use a local redis-server"
+        )
+    for db in redis_utils.redis_async_connection:
+        await initialize_async_redis(db=db)
+        connection = redis_utils.redis_async_connection[db]
+        if flush:
+            await connection.flushdb()
+        elif await connection.dbsize():
+            raise ValueError(f"Redis db {db} is not empty, rerun with --flush to clear it")
+
+
+async def load_corpus(news_batch: NewsArticlesBatch) -> float:
+    """Push the batch the same way the daily indexing does, returns the loading time"""
+    start_time = time.perf_counter()
+    inverted_index = positional_inverted_index(news_batch)
+    encode_index(inverted_index)
+    await batch_push_news_data(news_batch)
+    await update_index(inverted_index)
+    await update_tfidf_index(inverted_index)
+    return time.perf_counter() - start_time
+
+
+def summarise_latencies(latencies: List[float], elapsed: float) -> Dict[str, float]:
+    latencies_ms = np.array(latencies) * 1000
+    summary = {
+        "count": len(latencies),
+        "mean_ms": float(latencies_ms.mean()),
+        "throughput_qps": len(latencies) / elapsed if elapsed else 0.0,
+    }
+    for percentile, value in zip(PERCENTILES, np.percentile(latencies_ms, PERCENTILES)):
+        summary[f"p{percentile}_ms"] = float(value)
+    return summary
+
+
+async def run_queries(
+    queries: List[str],
+    run_query: Callable,
+    concurrency: int = 1,
+) -> Dict[str, float]:
+    """Time every query, throughput is measured over the whole batch at the given concurrency"""
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def timed_query(idx: int, query: str):
+        async with semaphore:
+            start_time = time.perf_counter()
+            await run_query(idx, query)
+            latencies.append(time.perf_counter() - start_time)
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*[timed_query(idx, query) for idx, query in enumerate(queries)])
+    return summarise_latencies(latencies, time.perf_counter() - start_time)
+
+
+async def run_benchmark(
+    query_mix: Dict[str, List[str]],
+    concurrency: int = 1,
+    warmup: int = 10,
+    top_k: int = 10,
+) -> Dict[str, Dict[str, float]]:
+    doc_ids_list = await get_doc_ids_list()
+    docs_size = await get_tfidf_doc_size()
+
+    async def boolean_query(idx: int, query: str):
+        await evaluate_boolean_query(query, doc_ids_list)
+
+    async def ranked_query(idx: int, query: str):
+        await evaluate_ranked_query(query, docs_size)
+
+    async def cache_miss_query(idx: int, query: str):
+        # the key is new for every query, so this covers the search and the cache write
+        key = RedisKeys.cache("benchmark", query, idx)
+        if not await check_cache_exists(key):
+            results = await evaluate_ranked_query(query, docs_size)
+            await set_cache(key, [doc_id for doc_id, _ in results[:top_k]])
+
+    async def cache_hit_query(idx: int, query: str):
+        key = RedisKeys.cache("benchmark", query, idx)
+        if await check_cache_exists(key):
+            await get_cache(key)
+
+    query_functions = {
+        "boolean": boolean_query,
+        "phrase": boolean_query,
+        "proximity": boolean_query,
+        "ranked": ranked_query,
+        "cache_miss": cache_miss_query,
+        # hits the keys written by cache_miss
+        "cache_hit": cache_hit_query,
+    }
+
+    results = {}
+    for query_type in QUERY_TYPES:
+        warmup_queries = query_mix[query_type][:warmup]
+        queries = query_mix[query_type][warmup:]
+        if query_type != "cache_hit":
+            # negative indices keep the cache keys of the measured queries unseen
+            await run_queries(
+                warmup_queries, lambda idx, query: query_functions[query_type](-idx - 1, query)
+            )
+        results[query_type] = await run_queries(
+            queries, query_functions[query_type], concurrency
+        )
+        print(
+            f"{query_type:>10}: p50 {results[query_type]['p50_ms']:.2f}ms "
+            f"p95 {results[query_type]['p95_ms']:.2f}ms "
+            f"p99 {results[query_type]['p99_ms']:.2f}ms "
+            f"{results[query_type]['throughput_qps']:.1f} q/s"
+        )
+    return results
+
+
+def get_git_revision() -> Tuple[str, bool]:
+    """Current commit and whether the working tree has uncommitted changes"""
+    try:
+        commit = subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=BASEPATH, stderr=subprocess.DEVNULL
+        ).decode().strip()
+        dirty = bool(
+            subprocess.check_output(
+                ["git", "status", "--porcelain", "--untracked-files=no"],
+                cwd=BASEPATH,
+                stderr=subprocess.DEVNULL,
+            ).strip()
+        )
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return "unknown", False
+    return commit, dirty
+
+
+def save_report(report: dict, output_dir: str = BENCHMARK_RESULTS_PATH) -> str:
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    timestamp = datetime.strptime(report["timestamp"], "%Y-%m-%dT%H:%M:%S")
+    file_name = f"{timestamp.strftime('%Y%m%d_%H%M%S')}_{report['commit'][:8]}.json"
+    file_path = os.path.join(output_dir, file_name)
+    with open(file_path, "wb") as f:
+        f.write(orjson.dumps(report, option=orjson.OPT_INDENT_2))
+    return file_path
+
+
+def compare_reports(report: dict, baseline: dict):
+    """Print the relative change of the latency percentiles against a previous run"""
+    print(f"Compared to {baseline['commit'][:8]} ({baseline['timestamp']}):")
+    for query_type, summary in report["results"].items():
+        if query_type not in baseline["results"]:
+            continue
+        changes = []
+        for percentile in PERCENTILES:
+            key = f"p{percentile}_ms"
+            previous = baseline["results"][query_type][key]
+            change = (summary[key] - previous) / previous * 100 if previous else 0.0
+            changes.append(f"{key} {change:+.1f}%")
+        print(f"{query_type:>10}: {' '.join(changes)}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the search engine against a local redis-server")
+    parser.add_argument("--corpus", choices=["synthetic", "csv"], default="synthetic")
+    parser.add_argument("--docs", type=int, default=5000, help="synthetic documents")
+    parser.add_argument("--vocab", type=int, default=20000, help="synthetic vocabulary size")
+    parser.add_argument("--doc-length", type=int, default=200, help="synthetic words per document")
+    parser.add_argument("--zipf", type=float, default=1.1, help="synthetic Zipf exponent")
+    parser.add_argument("--source", choices=[source.value for source in Source], default=Source.BBC.value)
+    parser.add_argument("--date", type=date.fromisoformat, help="csv date YYYY-MM-DD")
+    parser.add_argument("--start-index", type=int, default=0, help="first csv fragment")
+    parser.add_argument("--end-index", type=int, default=-1, help="last csv fragment")
+    parser.add_argument("--queries", type=int, default=200, help="queries per query type")
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--redis-host", default="127.0.0.1")
+    parser.add_argument("--redis-port", default="6379")
+    parser.add_argument("--allow-remote", action="store_true")
+    parser.add_argument("--flush", action="store_true", help="clear the redis dbs before loading")
+    parser.add_argument("--output-dir", default=BENCHMARK_RESULTS_PATH)
+    parser.add_argument("--baseline", help="previous result file to compare with")
+    return parser.parse_args()
+
+
+async def main(args):
+    # the environment takes precedence over the .env file read by get_redis_config
+    os.environ["REDIS_HOST"] = args.redis_host
+    os.environ["REDIS_PORT"] = str(args.redis_port)
+    os.environ.pop("REDIS_PASSWORD", None)
+    await ensure_local_redis(args.redis_host, args.flush, args.allow_remote)
+
+    if args.corpus == "synthetic":
+        news_batch = generate_synthetic_batch(
+            args.docs, args.vocab, args.doc_length, args.zipf, args.seed
+        )
+        corpus = {
+            "type": "synthetic",
+            "docs": args.docs,
+            "vocab": args.vocab,
+            "doc_length": args.doc_length,
+            "zipf": args.zipf,
+            "seed": args.seed,
+        }
+    else:
+        assert args.date is not None, "--date is required for the csv corpus"
+        news_batch = load_batch_from_news_source(
+            Source(args.source), args.date, args.start_index, args.end_index
+        )
+        corpus = {
+            "type": "csv",
+            "source": args.source,
+            "date": args.date.isoformat(),
+            "start_index": args.start_index,
+            "end_index": args.end_index,
+            "docs": len(news_batch.doc_ids),
+        }
+
+    query_mix = generate_query_mix(news_batch, args.queries + args.warmup, args.seed)
+    load_seconds = await load_corpus(news_batch)
+    print(f"\nLoaded {len(news_batch.doc_ids)} documents in {load_seconds:.2f} seconds")
+
+    results = await run_benchmark(
+        query_mix, concurrency=args.concurrency, warmup=args.warmup
+    )
+
+    commit, dirty = get_git_revision()
+    report = {
+        "commit": commit,
+        "dirty": dirty,
+        "timestamp": datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "corpus": corpus,
+        "queries": args.queries,
+        "concurrency": args.concurrency,
+        "load_seconds": load_seconds,
+        "results": results,
+    }
+    print(f"Saved results to {save_report(report, args.output_dir)}")
+
+    if args.baseline:
+        with open(args.baseline, "rb") as f:
+            compare_reports(report, orjson.loads(f.read()))
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
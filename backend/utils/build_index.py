@@ -171,6 +171,33 @@ def merge_inverted_indices(
                 )
 
 
+def split_index_by_doc_range(
+    inverted_index: InvertedIndex, shard_size: int
+) -> Dict[int, InvertedIndex]:
+    """Split an index into sub-indexes of `shard_size` consecutive doc ids, keyed by shard id"""
+    shards = {}
+
+    def get_shard(doc_id) -> InvertedIndex:
+        shard_id = int(doc_id) // shard_size
+        if shard_id not in shards:
+            shards[shard_id] = InvertedIndex(
+                meta=InvertedIndexMetadata(document_size=0, doc_ids_list=[]),
+                index=defaultdict(default_dict_list),
+            )
+        return shards[shard_id]
+
+    for doc_id in inverted_index.meta.doc_ids_list:
+        shard = get_shard(doc_id)
+        shard.meta.document_size += 1
+        shard.meta.doc_ids_list.append(doc_id)
+
+    for term, record in inverted_index.index.items():
+        for doc_id, positions in record.items():
+            get_shard(doc_id).index[term][doc_id] = positions
+
+    return shards
+
+
 def delta_encode_list(positions):
     """Convert a list of positions into a delta-encoded list."""
     if not positions:
@@ -219,6 +219,19 @@ def append_index_to_csv(source: Source, date: date, start_doc_id: int) -> int:
     with open("current_doc_id.txt", "w") as f:
         f.write(str(current_doc_id))
 
+def get_logger(name: str) -> logging.Logger:
+    """Logger writing to stderr, its level is set by LOG_LEVEL (default WARNING)"""
+    logger = logging.getLogger(name)
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(
+            logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+        )
+        logger.addHandler(handler)
+        logger.setLevel(os.getenv("LOG_LEVEL", "WARNING").upper())
+    return logger
+
+
 class Logger:
     def __init__(self, logfile):
         self.logfile = logfile
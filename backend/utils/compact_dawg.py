@@ -0,0 +1,385 @@
+import os
+import sys
+import mmap
+import time
+import struct
+import argparse
+from array import array
+from collections import deque
+from collections.abc import Mapping
+from typing import Dict, Optional
+
+sys.path.append(os.path.dirname(__file__))
+
+from constant import (
+    COMPACT_DAWG_PATH,
+    MONOGRAM_PKL_PATH,
+    MONOGRAM_AND_BIGRAM_DICTIONARY_PATH,
+)
+from query_suggestion import ORIGINAL_KEY, _DawgNode, load_query_suggestion
+
+MAGIC = b"TTDSDAWG"
+VERSION = 2
+# magic, version, little endian, nodes, edges, strings, words, string bytes
+HEADER = struct.Struct("<8sIIQQQQQ")
+ALIGNMENT = 8
+NO_STRING = -1
+
+# name, array typecode, length as a function of the header counts
+SECTIONS = [
+    ("node_edge_start", "I", lambda n: n["nodes"] + 1),
+    ("edge_labels", "I", lambda n: n["edges"]),
+    ("edge_targets", "I", lambda n: n["edges"]),
+    ("node_counts", "q", lambda n: n["nodes"]),
+    ("node_max_counts", "q", lambda n: n["nodes"]),
+    ("node_words", "i", lambda n: n["nodes"]),
+    ("node_original_keys", "i", lambda n: n["nodes"]),
+    ("string_offsets", "Q", lambda n: n["strings"] + 1),
+    ("word_keys", "i", lambda n: n["words"]),
+    ("word_counts", "q", lambda n: n["words"]),
+    ("word_original_keys", "i", lambda n: n["words"]),
+    ("word_sorted", "I", lambda n: n["words"]),
+]
+
+
+def _padding(size: int) -> bytes:
+    return b"\0" * (-size % ALIGNMENT)
+
+
+def save_compact_dawg(root: _DawgNode, words: Dict[str, dict], output_path: str):
+    """
+    Flatten a dawg and its words dictionary into arrays: every node has a range of
+    edges (label, target node), a count and optional word and original key strings.
+    Nodes shared by synonyms stay shared, and the children keep their insertion order
+    so that the traversals return the same results as the original dawg.
+    """
+    # the word keys come first in the string table, in the order of the words
+    strings = dict.fromkeys(words)
+    for index, word in enumerate(strings):
+        strings[word] = index
+
+    def string_index(value: Optional[str]) -> int:
+        if value is None:
+            return NO_STRING
+        if value not in strings:
+            strings[value] = len(strings)
+        return strings[value]
+
+    node_ids = {id(root): 0}
+    nodes = [root]
+    que = deque([root])
+    while que:
+        node = que.popleft()
+        for child in node.children.values():
+            if id(child) not in node_ids:
+                node_ids[id(child)] = len(nodes)
+                nodes.append(child)
+                que.append(child)
+
+    data = {name: array(typecode) for name, typecode, _ in SECTIONS}
+    data["node_edge_start"].append(0)
+    for node in nodes:
+        for letter, child in node.children.items():
+            data["edge_labels"].append(ord(letter))
+            data["edge_targets"].append(node_ids[id(child)])
+        data["node_edge_start"].append(len(data["edge_labels"]))
+        data["node_counts"].append(int(node.count))
+        data["node_max_counts"].append(int(node.max_count))
+        data["node_words"].append(string_index(node.word))
+        data["node_original_keys"].append(string_index(node.original_key))
+
+    for word, info in words.items():
+        data["word_keys"].append(string_index(word))
+        data["word_counts"].append(int(info.get("count", 0)))
+        data["word_original_keys"].append(string_index(info.get(ORIGINAL_KEY)))
+    # a permutation of the words sorted by key, for the lookups by binary search
+    data["word_sorted"].extend(sorted(range(len(words)), key=list(words).__getitem__))
+
+    blob = bytearray()
+    data["string_offsets"].append(0)
+    for value in strings:
+        blob += value.encode("utf-8")
+        data["string_offsets"].append(len(blob))
+
+    if sys.byteorder != "little":
+        for section in data.values():
+            section.byteswap()
+
+    with open(output_path, "wb") as f:
+        f.write(
+            HEADER.pack(
+                MAGIC, VERSION, 1, len(nodes), len(data["edge_labels"]),
+                len(strings), len(words), len(blob),
+            )
+        )
+        f.write(_padding(HEADER.size))
+        for name, _, _ in SECTIONS:
+            section = data[name].tobytes()
+            f.write(section)
+            f.write(_padding(len(section)))
+        f.write(blob)
+
+
+def is_current_version(path: str) -> bool:
+    """Whether the file was saved in the format of this version of the loader"""
+    with open(path, "rb") as f:
+        header = f.read(HEADER.size)
+    if len(header) < HEADER.size:
+        return False
+    magic, version, *_ = HEADER.unpack(header)
+    return magic == MAGIC and version == VERSION
+
+
+class CompactDawg:
+    """
+    Read-only memory-mapped dawg. Changes made after loading (inserted words, updated
+    counts) are kept in overlay dictionaries and never written back to the file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        buffer = memoryview(self._mmap)
+
+        magic, version, little_endian, *counts = HEADER.unpack_from(buffer)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} compact dawg file")
+        if sys.byteorder != "little":
+            raise ValueError("Compact dawg files can only be loaded on little endian machines")
+        self.counts = dict(zip(["nodes", "edges", "strings", "words", "blob"], counts))
+
+        offset = HEADER.size + len(_padding(HEADER.size))
+        for name, typecode, length in SECTIONS:
+            size = length(self.counts) * array(typecode).itemsize
+            setattr(self, name, buffer[offset : offset + size].cast(typecode))
+            offset += size + len(_padding(size))
+        self.strings_blob = buffer[offset : offset + self.counts["blob"]]
+
+        self.child_overlay: Dict[int, dict] = {}
+        self.word_overlay: Dict[int, Optional[str]] = {}
+        self.original_key_overlay: Dict[int, Optional[str]] = {}
+        self.count_overlay: Dict[int, int] = {}
+        self.max_count_overlay: Dict[int, int] = {}
+
+        self.root = _CompactDawgNode(self, 0)
+        self.words = CompactWords(self)
+
+    def get_string(self, index: int) -> Optional[str]:
+        if index == NO_STRING:
+            return None
+        return str(
+            self.strings_blob[self.string_offsets[index] : self.string_offsets[index + 1]],
+            "utf-8",
+        )
+
+    def find_child(self, index: int, letter: str) -> int:
+        """Index of the child node reached through `letter`, -1 if there is none"""
+        label = ord(letter)
+        for edge in range(self.node_edge_start[index], self.node_edge_start[index + 1]):
+            if self.edge_labels[edge] == label:
+                return self.edge_targets[edge]
+        return -1
+
+
+class _CompactDawgNode(_DawgNode):
+    """
+    Flyweight view of a node of a CompactDawg. Subclassing _DawgNode reuses its
+    insert and traversal methods, which only go through the properties below.
+    """
+
+    __slots__ = ("_dawg", "_index")
+
+    def __init__(self, dawg: CompactDawg, index: int):
+        self._dawg = dawg
+        self._index = index
+
+    def __eq__(self, other):
+        if not isinstance(other, _CompactDawgNode):
+            return NotImplemented
+        return self._index == other._index and self._dawg is other._dawg
+
+    def __hash__(self):
+        return hash(self._index)
+
+    def __repr__(self):
+        return f"<CompactDawgNode children={list(self.children.keys())}, {self.word}>"
+
+    @property
+    def children(self):
+        return _CompactChildren(self._dawg, self._index)
+
+    @property
+    def word(self):
+        if self._index in self._dawg.word_overlay:
+            return self._dawg.word_overlay[self._index]
+        return self._dawg.get_string(self._dawg.node_words[self._index])
+
+    @word.setter
+    def word(self, value):
+        self._dawg.word_overlay[self._index] = value
+
+    @property
+    def original_key(self):
+        if self._index in self._dawg.original_key_overlay:
+            return self._dawg.original_key_overlay[self._index]
+        return self._dawg.get_string(self._dawg.node_original_keys[self._index])
+
+    @original_key.setter
+    def original_key(self, value):
+        self._dawg.original_key_overlay[self._index] = value
+
+    @property
+    def count(self):
+        return self._dawg.count_overlay.get(self._index, self._dawg.node_counts[self._index])
+
+    @count.setter
+    def count(self, value):
+        self._dawg.count_overlay[self._index] = value
+
+    @property
+    def max_count(self):
+        return self._dawg.max_count_overlay.get(self._index, self._dawg.node_max_counts[self._index])
+
+    @max_count.setter
+    def max_count(self, value):
+        self._dawg.max_count_overlay[self._index] = value
+
+
+class _CompactChildren:
+    """Children of a compact node, in the same order as the original dawg, then the inserted ones"""
+
+    __slots__ = ("_dawg", "_index", "_overlay")
+
+    def __init__(self, dawg: CompactDawg, index: int):
+        self._dawg = dawg
+        self._index = index
+        self._overlay = dawg.child_overlay.get(index)
+
+    def _base_items(self):
+        dawg = self._dawg
+        for edge in range(dawg.node_edge_start[self._index], dawg.node_edge_start[self._index + 1]):
+            yield chr(dawg.edge_labels[edge]), dawg.edge_targets[edge]
+
+    def __contains__(self, letter):
+        if self._overlay and letter in self._overlay:
+            return True
+        return self._dawg.find_child(self._index, letter) != -1
+
+    def __getitem__(self, letter):
+        if self._overlay and letter in self._overlay:
+            return self._overlay[letter]
+        child = self._dawg.find_child(self._index, letter)
+        if child == -1:
+            raise KeyError(letter)
+        return _CompactDawgNode(self._dawg, child)
+
+    def __setitem__(self, letter, node):
+        self._dawg.child_overlay.setdefault(self._index, {})[letter] = node
+        self._overlay = self._dawg.child_overlay[self._index]
+
+    def get(self, letter, default=None):
+        try:
+            return self[letter]
+        except KeyError:
+            return default
+
+    def items(self):
+        overlay = self._overlay or {}
+        for letter, child in self._base_items():
+            if letter not in overlay:
+                yield letter, _CompactDawgNode(self._dawg, child)
+        yield from overlay.items()
+
+    def keys(self):
+        return [letter for letter, _ in self.items()]
+
+    def values(self):
+        return [node for _, node in self.items()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        overlay = self._overlay or {}
+        new_letters = sum(1 for letter in overlay if self._dawg.find_child(self._index, letter) == -1)
+        return self._dawg.node_edge_start[self._index + 1] - self._dawg.node_edge_start[self._index] + new_letters
+
+
+class CompactWords(Mapping):
+    """Read-only words dictionary of a CompactDawg, the values are built on access"""
+
+    def __init__(self, dawg: CompactDawg):
+        self._dawg = dawg
+
+    def _key(self, position: int) -> str:
+        return self._dawg.get_string(self._dawg.word_keys[position])
+
+    def _find(self, word: str) -> int:
+        """Position of `word` in the words, -1 if missing"""
+        word_sorted = self._dawg.word_sorted
+        low, high = 0, len(word_sorted)
+        while low < high:
+            middle = (low + high) // 2
+            if self._key(word_sorted[middle]) < word:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(word_sorted) and self._key(word_sorted[low]) == word:
+            return word_sorted[low]
+        return -1
+
+    def __getitem__(self, word):
+        position = self._find(word) if isinstance(word, str) else -1
+        if position == -1:
+            raise KeyError(word)
+        value = {"count": self._dawg.word_counts[position]}
+        original_key = self._dawg.get_string(self._dawg.word_original_keys[position])
+        if original_key is not None:
+            value[ORIGINAL_KEY] = original_key
+        return value
+
+    def __contains__(self, word):
+        return isinstance(word, str) and self._find(word) != -1
+
+    def __iter__(self):
+        for position in range(len(self)):
+            yield self._key(position)
+
+    def sorted_keys(self):
+        """
+        The keys in sorted order and their positions, for the fuzzy index.
+        The keys are decoded once, the binary searches of the index are too hot to decode them on access.
+        """
+        word_sorted = self._dawg.word_sorted
+        return [self._key(position) for position in word_sorted], word_sorted
+
+    def __len__(self):
+        return self._dawg.counts["words"]
+
+
+def build_compact_dawg(
+    monogram_pkl_path: str = MONOGRAM_PKL_PATH,
+    words_path: str = MONOGRAM_AND_BIGRAM_DICTIONARY_PATH,
+    output_path: str = COMPACT_DAWG_PATH,
+):
+    """Build the suggestion dawg the slow way once and save it for the loader"""
+    start_time = time.time()
+    query_suggestion = load_query_suggestion(monogram_pkl_path, words_path, compact_dawg_path=None)
+    print(f"Built the dawg in {time.time() - start_time:.2f} seconds")
+
+    start_time = time.time()
+    save_compact_dawg(query_suggestion._dwg, query_suggestion.words, output_path)
+    print(
+        f"Saved {output_path} ({os.path.getsize(output_path) / 1e6:.1f} MB) "
+        f"in {time.time() - start_time:.2f} seconds"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the memory-mappable query suggestion dawg")
+    parser.add_argument("--monogram-pkl", default=MONOGRAM_PKL_PATH)
+    parser.add_argument("--words", default=MONOGRAM_AND_BIGRAM_DICTIONARY_PATH)
+    parser.add_argument("--output", default=COMPACT_DAWG_PATH)
+    args = parser.parse_args()
+    build_compact_dawg(args.monogram_pkl, args.words, args.output)
@@ -26,6 +26,26 @@ MONOGRAM_AND_BIGRAM_DICTIONARY_PATH = os.path.abspath(
     )
 )
 
+COMPACT_DAWG_PATH = os.path.abspath(
+    os.path.join(
+        os.path.dirname(__file__),
+        "spell_checking_and_autocomplete_files",
+        "query_suggestion_dawg.bin",
+    )
+)
+
+# json, named .data like the words dictionary since the image leaves the .json files out
+APPLIED_DICTIONARY_DELTAS_PATH = os.path.abspath(
+    os.path.join(
+        os.path.dirname(__file__),
+        "spell_checking_and_autocomplete_files",
+        "applied_dictionary_deltas.data",
+    )
+)
+
+# words seen this many times or less are left out of the spell checking dictionary
+DICTIONARY_MIN_FREQUENCY = 100
+
 FULL_TXT_CORPUS_PATH = os.path.abspath(
     os.path.join(
         os.path.dirname(__file__),
@@ -48,6 +68,16 @@ QUERY_EXPANSION_MODEL_PATH = os.path.abspath(
     )
 )
 
+ONNX_MODEL_PATH = os.path.abspath(
+    os.path.join(
+        os.path.dirname(__file__),
+        "onnx_files",
+    )
+)
+
+# number of consecutive doc ids stored in one index shard
+SHARD_SIZE = 100000
+
 
 class Source(Enum):
     BBC = "bbc"
@@ -0,0 +1,293 @@
+import os
+import re
+import sys
+import time
+import hashlib
+import argparse
+import numpy as np
+import orjson
+import pandas as pd
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Iterator, List, Optional, Set, Tuple
+from symspellpy import SymSpell
+from tqdm import tqdm
+
+sys.path.append(os.path.dirname(__file__))
+
+from constant import (
+    DATA_PATH,
+    MONOGRAM_PKL_PATH,
+    MONOGRAM_AND_BIGRAM_DICTIONARY_PATH,
+    Source,
+)
+from query_suggestion import (
+    FULL_STOP_WORDS,
+    build_monogram_and_bigram_dictionary,
+    select_suggestion_monograms,
+)
+
+# the tokens of the filtered corpus and of the bigrams, counted per line of the articles
+# like the corpus file used to be read
+WORD_PATTERN = re.compile(r"\w+")
+LINE_BREAK_PATTERN = re.compile(r"\r\n|\r|\n")
+
+
+class CountMinSketch:
+    """
+    Approximate counts in a fixed depth x width table, never below the true count.
+    Sketches with the same shape are merged by adding their tables.
+    """
+
+    def __init__(self, width: int = 2**20, depth: int = 4):
+        self.table = np.zeros((depth, width), dtype=np.int64)
+
+    def _indices(self, keys: List[str]) -> np.ndarray:
+        # double hashing from one 64 bit digest, stable across processes unlike hash()
+        digests = b"".join(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest() for key in keys)
+        hashes = np.frombuffer(digests, dtype="<u4").reshape(-1, 2).astype(np.uint64)
+        depth, width = self.table.shape
+        rows = np.arange(depth, dtype=np.uint64)[:, None]
+        return ((hashes[:, 0] + rows * hashes[:, 1]) % np.uint64(width)).astype(np.int64)
+
+    def add(self, keys: List[str], counts: List[int]) -> np.ndarray:
+        """Add the counts and return the estimates of the keys after adding them"""
+        indices = self._indices(keys)
+        counts = np.asarray(counts, dtype=np.int64)
+        for row, row_indices in enumerate(indices):
+            np.add.at(self.table[row], row_indices, counts)
+        return self._estimate(indices)
+
+    def estimate(self, keys: List[str]) -> np.ndarray:
+        return self._estimate(self._indices(keys))
+
+    def _estimate(self, indices: np.ndarray) -> np.ndarray:
+        return np.min(self.table[np.arange(len(self.table))[:, None], indices], axis=0)
+
+    def merge(self, other: "CountMinSketch"):
+        self.table += other.table
+
+
+def get_csv_paths(data_path: str = DATA_PATH, sources: List[str] = None) -> List[str]:
+    sources = sources or [source.value for source in Source]
+    csv_paths = []
+    for source in sources:
+        folder_path = os.path.join(data_path, source)
+        if not os.path.isdir(folder_path):
+            print(f"Skipping {folder_path}, it does not exist")
+            continue
+        csv_paths.extend(
+            os.path.join(folder_path, file_name)
+            for file_name in sorted(os.listdir(folder_path))
+            if file_name.endswith(".csv")
+        )
+    return csv_paths
+
+
+def read_articles(csv_path: str, chunk_size: int) -> Iterator[List[str]]:
+    """The contents of the articles of a csv file, `chunk_size` rows at a time"""
+    for chunk in pd.read_csv(csv_path, usecols=["content"], chunksize=chunk_size):
+        # articles without content are read as NaN, they were skipped from the corpus file too
+        yield [article for article in chunk["content"] if isinstance(article, str)]
+
+
+def count_words_and_bigrams(articles: List[str], monograms: Counter, bigrams: Counter):
+    for article in articles:
+        for line in LINE_BREAK_PATTERN.split(article.lower()):
+            words = WORD_PATTERN.findall(line)
+            monograms.update(words)
+            bigrams.update(zip(words, words[1:]))
+
+
+def count_csv_files(
+    csv_paths: List[str],
+    chunk_size: int = 1000,
+    sketch_shape: Optional[Tuple[int, int]] = None,
+) -> Tuple[Counter, Optional[Counter], Optional[CountMinSketch]]:
+    """
+    Count the words and bigrams of the csv files, one chunk of rows in memory at a time.
+    With a sketch shape the bigrams only go to a CountMinSketch, to be collected by a second pass.
+    """
+    monograms = Counter()
+    bigrams = Counter()
+    sketch = CountMinSketch(*sketch_shape) if sketch_shape else None
+
+    for csv_path in csv_paths:
+        for articles in read_articles(csv_path, chunk_size):
+            if sketch is None:
+                count_words_and_bigrams(articles, monograms, bigrams)
+                continue
+            chunk_bigrams = Counter()
+            count_words_and_bigrams(articles, monograms, chunk_bigrams)
+            if chunk_bigrams:
+                sketch.add([" ".join(key) for key in chunk_bigrams], list(chunk_bigrams.values()))
+
+    if sketch is None:
+        return monograms, bigrams, None
+    return monograms, None, sketch
+
+
+def collect_bigrams(
+    csv_paths: List[str],
+    chunk_size: int,
+    sketch: CountMinSketch,
+    vocabulary: Set[str],
+    min_count: int = 2,
+) -> Counter:
+    """
+    Count exactly the bigrams of two words of the vocabulary that the sketch of the whole
+    corpus estimates at `min_count` or more. The sketch never underestimates, so no such
+    bigram is missed, and the ones seen once are mostly left out.
+    """
+    bigrams = Counter()
+    for csv_path in csv_paths:
+        for articles in read_articles(csv_path, chunk_size):
+            chunk_bigrams = Counter()
+            count_words_and_bigrams(articles, Counter(), chunk_bigrams)
+            keys = [key for key in chunk_bigrams if key[0] in vocabulary and key[1] in vocabulary]
+            if not keys:
+                continue
+            estimates = sketch.estimate([" ".join(key) for key in keys])
+            for key, estimate in zip(keys, estimates):
+                if estimate >= min_count:
+                    bigrams[key] += chunk_bigrams[key]
+    return bigrams
+
+
+def split_by_size(paths: List[str], num_groups: int) -> List[List[str]]:
+    """Balance the files by size over the groups, biggest files first"""
+    groups = [[] for _ in range(max(1, min(num_groups, len(paths))))]
+    group_sizes = [0] * len(groups)
+    for path in sorted(paths, key=os.path.getsize, reverse=True):
+        smallest = group_sizes.index(min(group_sizes))
+        groups[smallest].append(path)
+        group_sizes[smallest] += os.path.getsize(path)
+    return groups
+
+
+def count_corpus(
+    csv_paths: List[str],
+    workers: int = os.cpu_count() or 1,
+    chunk_size: int = 1000,
+    sketch_shape: Optional[Tuple[int, int]] = None,
+) -> Tuple[Counter, Optional[Counter], Optional[CountMinSketch]]:
+    """Count the words and bigrams of the csv files in parallel and merge the counts of the workers"""
+    monograms = Counter()
+    bigrams = None if sketch_shape else Counter()
+    sketch = None
+
+    groups = split_by_size(csv_paths, workers)
+    with ProcessPoolExecutor(max_workers=len(groups)) as executor:
+        futures = [executor.submit(count_csv_files, group, chunk_size, sketch_shape) for group in groups]
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Counting"):
+            group_monograms, group_bigrams, group_sketch = future.result()
+            monograms.update(group_monograms)
+            if group_sketch is None:
+                bigrams.update(group_bigrams)
+            elif sketch is None:
+                sketch = group_sketch
+            else:
+                sketch.merge(group_sketch)
+    return monograms, bigrams, sketch
+
+
+def collect_corpus_bigrams(
+    csv_paths: List[str],
+    sketch: CountMinSketch,
+    vocabulary: Set[str],
+    workers: int = os.cpu_count() or 1,
+    chunk_size: int = 1000,
+) -> Counter:
+    """Second pass of the bounded memory mode, see collect_bigrams"""
+    bigrams = Counter()
+    groups = split_by_size(csv_paths, workers)
+    with ProcessPoolExecutor(max_workers=len(groups)) as executor:
+        futures = [
+            executor.submit(collect_bigrams, group, chunk_size, sketch, vocabulary)
+            for group in groups
+        ]
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Collecting bigrams"):
+            bigrams.update(future.result())
+    return bigrams
+
+
+def build_dictionaries(
+    data_path: str = DATA_PATH,
+    sources: List[str] = None,
+    monogram_pkl_path: str = MONOGRAM_PKL_PATH,
+    words_path: str = MONOGRAM_AND_BIGRAM_DICTIONARY_PATH,
+    min_frequency: int = 100,
+    workers: int = os.cpu_count() or 1,
+    chunk_size: int = 1000,
+    sketch_shape: Optional[Tuple[int, int]] = None,
+):
+    """
+    Build the SymSpell dictionary and the suggestion dictionary from the csv files directly,
+    instead of going through the corpus and filtered corpus text files.
+    In one pass holding every bigram, or with a sketch shape in two passes holding only
+    the bigrams that can make it to the suggestions, with the same result.
+    """
+    csv_paths = get_csv_paths(data_path, sources)
+    print(f"Counting words and bigrams of {len(csv_paths)} csv files with {workers} workers...")
+    start_time = time.time()
+    monograms, bigrams, sketch = count_corpus(csv_paths, workers, chunk_size, sketch_shape)
+    print(f"Counted {len(monograms)} words in {time.time() - start_time:.2f} seconds")
+
+    print("Creating SymSpell dictionary...")
+    sym_spell = SymSpell()
+    for word, count in monograms.items():
+        if count > min_frequency:
+            # SymSpell split the words of the filtered corpus on underscores when reading it
+            for part in word.split("_"):
+                if part:
+                    sym_spell.create_dictionary_entry(part, count)
+    sym_spell.save_pickle(monogram_pkl_path)
+    print("Dictionary created and saved in ", monogram_pkl_path)
+
+    full_stop_words = set(FULL_STOP_WORDS)
+    suggestion_monograms = select_suggestion_monograms(sym_spell.words, full_stop_words)
+    if sketch is not None:
+        print("Collecting the bigrams of the suggested words...")
+        bigrams = collect_corpus_bigrams(csv_paths, sketch, set(suggestion_monograms), workers, chunk_size)
+    print(f"Counted {len(bigrams)} bigrams in {time.time() - start_time:.2f} seconds")
+
+    print("Creating monogram and bigram dictionary...")
+    monogram_and_bigram_dictionary = build_monogram_and_bigram_dictionary(
+        suggestion_monograms, bigrams, full_stop_words
+    )
+    with open(words_path, "wb") as file:
+        file.write(orjson.dumps(monogram_and_bigram_dictionary))
+    print("Monogram and bigram dictionary created and saved in ", words_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Build the spell checking and query suggestion dictionaries from the csv data"
+    )
+    parser.add_argument("--data-path", default=DATA_PATH)
+    parser.add_argument("--sources", nargs="+", choices=[source.value for source in Source])
+    parser.add_argument("--monogram-pkl", default=MONOGRAM_PKL_PATH)
+    parser.add_argument("--words", default=MONOGRAM_AND_BIGRAM_DICTIONARY_PATH)
+    parser.add_argument(
+        "--min-frequency", type=int, default=100, help="words seen this many times or less are left out"
+    )
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--chunk-size", type=int, default=1000, help="csv rows read at a time")
+    parser.add_argument(
+        "--bounded-memory",
+        action="store_true",
+        help="read the csv files twice and keep only the bigrams that can be suggested",
+    )
+    parser.add_argument("--sketch-width", type=int, default=2**20)
+    parser.add_argument("--sketch-depth", type=int, default=4)
+    args = parser.parse_args()
+    build_dictionaries(
+        data_path=args.data_path,
+        sources=args.sources,
+        monogram_pkl_path=args.monogram_pkl,
+        words_path=args.words,
+        min_frequency=args.min_frequency,
+        workers=args.workers,
+        chunk_size=args.chunk_size,
+        sketch_shape=(args.sketch_width, args.sketch_depth) if args.bounded_memory else None,
+    )
@@ -43,12 +43,14 @@ if __name__ == "__main__":
     path_module_new_data = os.path.join(BASEPATH, "module_new_data.py")
     path_run_daily_index = os.path.join(BASEPATH, "run_daily_index.py")
     path_run_daily_sentiment = os.path.join(BASEPATH, "run_daily_sentiment.py")
+    path_run_daily_dictionary = os.path.join(BASEPATH, "run_daily_dictionary.py")
     path_run_summarizer = os.path.join(BASEPATH, "run_summarizer.py")
 
     script_paths = [
         path_module_new_data,
         path_run_daily_index,
         path_run_daily_sentiment,
+        path_run_daily_dictionary,
         path_run_summarizer
     ]  # Add more scripts as needed
     
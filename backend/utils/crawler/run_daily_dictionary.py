@@ -0,0 +1,40 @@
+import os, sys
+
+from datetime import datetime
+from tqdm import tqdm
+
+FILENAME = os.path.basename(__file__)
+BASEPATH = os.path.dirname(__file__)
+UTILPATH = os.path.dirname(BASEPATH)
+
+sys.path.append(UTILPATH)
+
+from dictionary_updates import push_csv_dictionary_delta, snapshot_dictionaries
+from common import Logger
+
+if __name__ == "__main__":
+    logpath = os.path.join(UTILPATH, "logger.log")
+    logger = Logger(logpath)
+
+    logger.log_event("info", f"{FILENAME} - Start script")
+
+    today = datetime.now()
+    today_str = today.strftime("%Y%m%d")
+
+    folder_path = os.path.join(UTILPATH, "data", today_str)
+    files = os.listdir(folder_path)
+    files = [i for i in files if f'data_{today_str}' in i]
+
+    for idx, f in tqdm(enumerate(files)):
+        inputfile = os.path.join(folder_path, f)
+
+        # the running services merge the pushed deltas into their spell checker and suggestions
+        logger.log_event("info", f"{FILENAME} - {idx} - {f} Pushing the dictionary delta to Redis")
+        if not push_csv_dictionary_delta(f"{today_str}/{f}", [inputfile]):
+            logger.log_event("info", f"{FILENAME} - {idx} - {f} Dictionary delta already pushed")
+
+    logger.log_event("info", f"{FILENAME} - Saving the dictionaries with the deltas")
+    merged = snapshot_dictionaries()
+    logger.log_event("info", f"{FILENAME} - Merged {merged} dictionary deltas")
+
+    logger.log_event("info", f"{FILENAME} - DONE")
@@ -15,7 +15,8 @@ sys.path.append(UTILPATH)
 
 from basetype import NewsArticlesFragment, NewsArticleData, NewsArticlesBatch
 from build_index import positional_inverted_index, encode_index, save_json_file
-from redis_utils import update_index, batch_push_news_data, get_doc_size
+from redis_utils import update_index, batch_push_news_data, get_doc_size, is_index_sharding_enabled
+from push_index import push_sharded_index
 from common import Logger
 
 
@@ -94,7 +95,10 @@ if __name__ == "__main__":
         save_json_file(indexname, inverted_index.model_dump(), indexpath)
 
         logger.log_event('info', f'{FILENAME} - {idx} - {f} Pusing Index to Redis')
-        asyncio.run(update_index(inverted_index))
+        if is_index_sharding_enabled():
+            asyncio.run(push_sharded_index(inverted_index))
+        else:
+            asyncio.run(update_index(inverted_index))
 
 
         logger.log_event('info', f'{FILENAME} - {idx} - {f} Pusing Data to Redis')
@@ -1,13 +1,7 @@
-### TO DO - MOVE THE MODEL, TOKENIZER, AND DEVICE DETERMINATION
-# TO THE INITIALIZATION OF THE MODULE
-
 import os
 import warnings
 import pandas as pd
 from tqdm import tqdm
-import numpy as np
-import torch
-from transformers import AutoTokenizer, AutoModelForSequenceClassification
 import orjson
 import pandas as pd
 import os, sys
@@ -21,73 +15,53 @@ UTILPATH = os.path.dirname(BASEPATH)
 
 sys.path.append(UTILPATH)
 
-DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-MODEL_NAME = "mrm8488/distilroberta-finetuned-financial-news-sentiment-analysis"
-TOKENIZER = AutoTokenizer.from_pretrained(MODEL_NAME)
-MODEL = AutoModelForSequenceClassification.from_pretrained(MODEL_NAME)
-
 from common import Logger
 from basetype import RedisDocKeys
-from push_data_colwise import do_gather_task_push_value, func_sentiment
+from redis_utils import set_news_data_cols
+from push_data_colwise import func_sentiment
+from sentiment_engine import get_sentiment_workers, iter_sentiments, load_sentiment_engine
+
+# the model, tokenizer and device are loaded once, with the settings of the .env
+ENGINE = load_sentiment_engine()
+# rows analyzed by a worker at a time, and sentiments set on redis in one pipeline
+CHUNK_SIZE = 256
+PUSH_BATCH_SIZE = 500
 
 
-def analyze_sentiment(text, model=MODEL, tokenizer=TOKENIZER, device=DEVICE):
+def analyze_sentiment(text, engine=ENGINE):
     """
     Analyzes sentiment for a single piece of text and returns rounded sentiment probabilities.
 
     Parameters:
         text (str): The text to analyze.
-        model: The pre-trained sentiment analysis model.
-        tokenizer: The tokenizer for the model.
-        device: The device to run the model on.
+        engine: The SentimentEngine holding the model and its tokenizer.
 
     Returns:
         list: A list containing the probabilities for [negative, neutral, positive] sentiments.
     """
     try:
-        inputs = tokenizer(
-            text, return_tensors="pt", truncation=True, max_length=512
-        ).to(device)
-        with torch.no_grad():
-            outputs = model(**inputs)
-        sentiments = (
-            torch.nn.functional.softmax(outputs.logits, dim=-1)
-            .to("cpu")[0]
-            .float()
-            .numpy()
-        )
-        # Round the first 2 elements and convert them to Python floats
-        rounded_sentiments = [float(np.round(sentiment, 2)) for sentiment in sentiments]
-        diff = 1.0 - sum(rounded_sentiments)
-        rounded_sentiments[-1] = float(np.round(rounded_sentiments[-1] + diff, 2))
-        return rounded_sentiments
+        return engine.analyze([text])[0]
     except Exception as e:
         return None
 
 
 def get_sentiment_dictionary_from_df(
     df,
-    device=DEVICE,
-    model=MODEL,
-    tokenizer=TOKENIZER,
+    engine=ENGINE,
     csv_sentiment_dictionary=None,
+    workers=1,
 ):
     """
     Returns {doc_id: [prob_negative, prob_neutral, prob_positive]}.
 
     If csv_sentiment_dictionary is None, a new dictionary will be created.
+    The articles are analyzed together in batches, by forked worker processes when
+    workers is more than 1.
     """
-    content_series = df["content"]
-    doc_id_series = df["doc_id"]
-
-    model.to(device)
-
     if csv_sentiment_dictionary is None:
         csv_sentiment_dictionary = {}
 
-    for doc_id, text in zip(doc_id_series, content_series):
-        sentiment_list = analyze_sentiment(text, model, tokenizer, device)
-
+    for doc_id, sentiment_list in iter_sentiments(engine, iter_chunks([df]), workers):
         if str(doc_id) in csv_sentiment_dictionary.keys():
             warnings.warn(
                 f"Duplicate doc_id found: {doc_id}. Overwriting the previous entry!"
@@ -98,6 +72,32 @@ def get_sentiment_dictionary_from_df(
     return csv_sentiment_dictionary
 
 
+def iter_chunks(dfs, chunk_size=CHUNK_SIZE):
+    """(doc_ids, contents) of `chunk_size` rows of the dataframes"""
+    for df in dfs:
+        for start in range(0, len(df), chunk_size):
+            chunk = df.iloc[start:start + chunk_size]
+            yield list(chunk["doc_id"]), list(chunk["content"])
+
+
+async def analyze_and_push_sentiments(dfs, engine=ENGINE, workers=1, push_batch_size=PUSH_BATCH_SIZE):
+    """
+    Analyze the articles of the dataframes and set their sentiments on redis in pipelined batches
+    while the next ones are analyzed. Returns {doc_id: [prob_negative, prob_neutral, prob_positive]}.
+    """
+    sentiment_dictionary = {}
+    batch = {}
+    for doc_id, sentiment_list in iter_sentiments(engine, iter_chunks(dfs), workers):
+        sentiment_dictionary[str(doc_id)] = sentiment_list
+        batch[str(doc_id)] = func_sentiment(sentiment_list)
+        if len(batch) >= push_batch_size:
+            await set_news_data_cols(batch, RedisDocKeys.sentiment)
+            batch = {}
+    if batch:
+        await set_news_data_cols(batch, RedisDocKeys.sentiment)
+    return sentiment_dictionary
+
+
 if __name__ == "__main__":
     logpath = os.path.join(UTILPATH, 'logger.log')
     logger = Logger(logpath)
@@ -108,6 +108,7 @@ if __name__ == "__main__":
     today_str_dash = today.strftime("%Y-%m-%d")
     folder_path = os.path.join(UTILPATH, "data", today_str)
 
+    workers = get_sentiment_workers()
     files = os.listdir(folder_path)
     files = [i for i in files if f'data_{today_str}' in i]
 
@@ -130,24 +131,18 @@ if __name__ == "__main__":
         print("No Thanks")
 
         logger.log_event('info', f'{FILENAME} - {idx} Start script')
-        sentiment_dictionary = {}
 
         logger.log_event('info', f'{FILENAME} - {idx} Read Data in Chunk')
-        df_all = pd.read_csv(inputfile, chunksize=100, usecols=["doc_id", "content"])
-
-        # Iterate over each file in the current outlet folder
-        logger.log_event('info', f'{FILENAME} - {idx} Iterating')
-        for df in tqdm(df_all):
-            # Read the current CSV file into a pandas DataFrame
-            sentiment_dictionary = get_sentiment_dictionary_from_df(
-                df, csv_sentiment_dictionary=sentiment_dictionary
-            )
+        df_all = pd.read_csv(inputfile, chunksize=1000, usecols=["doc_id", "content"])
+
+        # the sentiments are set on Redis as they are computed
+        logger.log_event('info', f'{FILENAME} - {idx} Iterating with {workers} workers')
+        sentiment_dictionary = asyncio.run(
+            analyze_and_push_sentiments(tqdm(df_all), workers=workers)
+        )
         logger.log_event('info', f'{FILENAME} - {idx} Dumping the data to json')
 
         with open(outputfile, "wb") as file:
             file.write(orjson.dumps(sentiment_dictionary))
 
-        logger.log_event('info', f'{FILENAME} - {idx} Updating the sentiment on Redis')
-        asyncio.run(do_gather_task_push_value(sentiment_dictionary, RedisDocKeys.sentiment, func_sentiment))
-
     logger.log_event('info', f'{FILENAME} - Done')
\ No newline at end of file
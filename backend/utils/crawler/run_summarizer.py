@@ -1,6 +1,7 @@
 import os, sys
 import asyncio
 import orjson
+import pandas as pd
 
 from datetime import datetime
 from typing import List
@@ -13,17 +14,49 @@ UTILPATH = os.path.dirname(BASEPATH)
 sys.path.append(UTILPATH)
 
 # from common import get_preprocessed_words
-from push_data_colwise import do_gather_task_push_value, do_push_value, func_summary
-from module_summarizer import get_summaries_of_csv_file
+from dotenv import load_dotenv
+from constant import PROJECT_PATH
+from push_data_colwise import func_summary
+from module_summarizer import read_summary_checkpoint, summarize_csv_files
+from redis_utils import set_news_data_cols
 from common import Logger
 from basetype import RedisDocKeys
 
+# summaries set on redis in one pipeline
+PUSH_BATCH_SIZE = 500
+
+
+async def push_summaries(results):
+    """Set the (doc_id, summary) results on redis in pipelined batches, as they come"""
+    batch = {}
+    for doc_id, summary in results:
+        batch[doc_id] = func_summary(summary)
+        if len(batch) >= PUSH_BATCH_SIZE:
+            await set_news_data_cols(batch, RedisDocKeys.summary)
+            batch = {}
+    if batch:
+        await set_news_data_cols(batch, RedisDocKeys.summary)
+
+
+async def summarize_and_push(csv_paths, checkpoint_path, workers, summarized_paths):
+    # the summaries of the files done before are updated, and the ones of an
+    # interrupted run may not have been pushed
+    for summary_path in summarized_paths:
+        with open(summary_path, "rb") as file:
+            await push_summaries(orjson.loads(file.read()).items())
+    await push_summaries(read_summary_checkpoint(checkpoint_path).items())
+    await push_summaries(tqdm(summarize_csv_files(csv_paths, checkpoint_path, workers)))
+
+
 if __name__ == "__main__":
     logpath = os.path.join(UTILPATH, "logger.log")
     logger = Logger(logpath)
 
     logger.log_event("info", f"{FILENAME} - Start script")
 
+    load_dotenv(dotenv_path=os.path.join(PROJECT_PATH, ".env"))
+    workers = int(os.getenv("SUMMARIZER_WORKERS", os.cpu_count() or 1))
+
     today = datetime.now()
     # today = datetime(2024, 3, 9)
     today_str = today.strftime("%Y%m%d")
@@ -31,32 +64,30 @@ if __name__ == "__main__":
 
     folder_path = os.path.join(UTILPATH, "data", today_str)
     files = os.listdir(folder_path)
-    files = [i for i in files if f'data_{today_str}' in i]    
+    files = sorted(i for i in files if f'data_{today_str}' in i)
 
-    # inputfile = os.path.join(folder_path, f"data_{today_str}.csv")
-    for idx, f in tqdm(enumerate(files)):
-        inputfile = os.path.join(folder_path, f)
-        outputname = f.replace('data_', 'summary_').replace('.csv', '.json')
+    # the summaries of all the files of the day, one [doc_id, summary] line per article
+    checkpoint_path = os.path.join(folder_path, f"summary_{today_str}.jsonl")
+    csv_paths, summarized_paths = [], []
+    for f in files:
+        outputpath = os.path.join(folder_path, f.replace('data_', 'summary_').replace('.csv', '.json'))
+        if os.path.exists(outputpath):
+            # skip if the summaries do exist
+            summarized_paths.append(outputpath)
+        else:
+            csv_paths.append(os.path.join(folder_path, f))
 
-        outputpath = os.path.join(folder_path, outputname)
+    logger.log_event("info", f"{FILENAME} - Generating the summaries of {len(csv_paths)} files with {workers} workers")
+    asyncio.run(summarize_and_push(csv_paths, checkpoint_path, workers, summarized_paths))
 
-        if os.path.exists(outputpath):
-            # skip if the index does exist
-            with open(outputpath, "rb") as file:
-                results = orjson.loads(file.read())
-                logger.log_event("info", f"{FILENAME} - {idx} Updating the data on Redis")
-                asyncio.run(do_gather_task_push_value(results, RedisDocKeys.summary, func_summary))
-            continue
-
-        logger.log_event("info", f"{FILENAME} - {idx} Generating the summary")
-        results = get_summaries_of_csv_file(
-            inputfile, number_of_initial_sentences_to_skip=2
+    logger.log_event("info", f"{FILENAME} - Dumping the data into JSON")
+    summaries = read_summary_checkpoint(checkpoint_path)
+    for inputfile in csv_paths:
+        outputpath = os.path.join(
+            folder_path, os.path.basename(inputfile).replace('data_', 'summary_').replace('.csv', '.json')
         )
-
-        logger.log_event("info", f"{FILENAME} - {idx} Dumping the data into JSON")
+        doc_ids = pd.read_csv(inputfile, usecols=["doc_id"])["doc_id"]
+        results = {str(doc_id): summaries.get(str(doc_id)) for doc_id in doc_ids}
         with open(outputpath, "wb") as file:
             file.write(orjson.dumps(results))
-
-        logger.log_event("info", f"{FILENAME} - {idx} Updating the data on Redis")
-        asyncio.run(do_gather_task_push_value(results, RedisDocKeys.summary, func_summary))
     logger.log_event("info", f"{FILENAME} - Done")
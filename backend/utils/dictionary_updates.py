@@ -0,0 +1,183 @@
+import os
+import sys
+import threading
+import orjson
+from collections import Counter
+from typing import Callable, Iterable, List, Set, Tuple
+
+sys.path.append(os.path.dirname(__file__))
+
+from dotenv import load_dotenv
+from constant import (
+    PROJECT_PATH,
+    MONOGRAM_PKL_PATH,
+    MONOGRAM_AND_BIGRAM_DICTIONARY_PATH,
+    COMPACT_DAWG_PATH,
+    APPLIED_DICTIONARY_DELTAS_PATH,
+)
+from common import get_logger
+from redis_utils import get_dictionary_deltas, push_dictionary_delta
+
+logger = get_logger(__name__)
+
+DELTA_POLL_SECONDS = 300
+
+
+def count_dictionary_delta(csv_paths: List[str], chunk_size: int = 1000) -> Tuple[Counter, Counter]:
+    """
+    Word and bigram counts of new csv files, counted like the dictionaries were built.
+    The bigrams of words too short to be suggested are left out.
+    """
+    from corpus_statistics import count_csv_files
+
+    words, bigrams, _ = count_csv_files(csv_paths, chunk_size)
+    monograms = Counter()
+    for word, count in words.items():
+        # SymSpell split the words on underscores when the dictionary was built
+        for part in word.split("_"):
+            if part:
+                monograms[part] += count
+    bigram_counts = Counter(
+        {f"{first} {second}": count for (first, second), count in bigrams.items() if len(first) > 3 and len(second) > 3}
+    )
+    return monograms, bigram_counts
+
+
+def push_csv_dictionary_delta(name: str, csv_paths: List[str]) -> bool:
+    """Count and push the delta of new csv files, once by name"""
+    monograms, bigrams = count_dictionary_delta(csv_paths)
+    return push_dictionary_delta(name, monograms, bigrams)
+
+
+def read_applied_deltas(path: str = APPLIED_DICTIONARY_DELTAS_PATH) -> Tuple[Set[str], int]:
+    """
+    Names of the deltas already merged into the saved dictionaries, and the position in the
+    list of deltas in redis after the last of them, where the followers start reading
+    """
+    if not path or not os.path.exists(path):
+        return set(), 0
+    with open(path, "rb") as file:
+        applied = orjson.loads(file.read())
+    # the first snapshots only saved the names
+    if isinstance(applied, list):
+        return set(applied), 0
+    return set(applied["names"]), applied["position"]
+
+
+def write_applied_deltas(names: Iterable[str], position: int, path: str = APPLIED_DICTIONARY_DELTAS_PATH):
+    with open(path, "wb") as file:
+        file.write(orjson.dumps({"names": sorted(names), "position": position}))
+
+
+class DictionaryDeltaFollower:
+    """
+    Merges the dictionary deltas pushed to redis into a resource with a merge_dictionary_delta
+    method, skipping the ones merged into the dictionary it was loaded from.
+    The deltas are read from `position` on, the ones before it are in the loaded dictionary.
+    Every process follows the deltas for its own copy of the resource.
+    """
+
+    def __init__(
+        self,
+        resource,
+        applied_names: Iterable[str] = (),
+        position: int = 0,
+        poll_seconds: float = DELTA_POLL_SECONDS,
+    ):
+        self.resource = resource
+        self.applied_names = set(applied_names)
+        self.poll_seconds = poll_seconds
+        self.position = position
+        self._stopped = threading.Event()
+
+    def poll(self) -> int:
+        """Merge the deltas pushed since the last poll, returns how many were merged"""
+        return self.merge(get_dictionary_deltas(self.position))
+
+    def merge(self, deltas: List[dict]) -> int:
+        """Merge the deltas read from the position of the follower"""
+        merged = 0
+        for delta in deltas:
+            self.position += 1
+            if delta["name"] in self.applied_names:
+                continue
+            self.resource.merge_dictionary_delta(delta)
+            self.applied_names.add(delta["name"])
+            merged += 1
+        if merged:
+            logger.info("Merged %d dictionary deltas into %s", merged, type(self.resource).__name__)
+        return merged
+
+    def _run(self):
+        while True:
+            try:
+                self.poll()
+            except Exception:
+                # redis may be down, the resource keeps serving what it has
+                logger.exception("Failed to merge the dictionary deltas")
+            if self._stopped.wait(self.poll_seconds):
+                return
+
+    def start(self):
+        threading.Thread(target=self._run, name="dictionary-deltas", daemon=True).start()
+
+    def stop(self):
+        self._stopped.set()
+
+
+def load_following_dictionary_deltas(factory: Callable, applied_deltas_path: str = APPLIED_DICTIONARY_DELTAS_PATH):
+    """
+    Load a resource and keep merging the new dictionary deltas into it, usable as a picklable
+    factory. DICTIONARY_DELTA_POLL_SECONDS sets how often redis is checked, 0 disables it.
+    """
+    load_dotenv(dotenv_path=os.path.join(PROJECT_PATH, ".env"))
+    poll_seconds = float(os.getenv("DICTIONARY_DELTA_POLL_SECONDS", DELTA_POLL_SECONDS))
+    resource = factory()
+    if poll_seconds > 0:
+        applied_names, position = read_applied_deltas(applied_deltas_path)
+        DictionaryDeltaFollower(resource, applied_names, position, poll_seconds).start()
+    return resource
+
+
+def snapshot_dictionaries(
+    monogram_pkl_path: str = MONOGRAM_PKL_PATH,
+    words_path: str = MONOGRAM_AND_BIGRAM_DICTIONARY_PATH,
+    compact_dawg_path: str = COMPACT_DAWG_PATH,
+    applied_deltas_path: str = APPLIED_DICTIONARY_DELTAS_PATH,
+) -> int:
+    """
+    Merge the pending deltas into the saved dictionaries, so that the services start from them,
+    and rebuild the compact dawg when there is one. Returns the number of merged deltas.
+    The position in the list of deltas is saved with them, so the services only read the
+    deltas pushed after the snapshot.
+    """
+    from spell_checker import SpellChecker
+    from query_suggestion import QuerySuggestion
+
+    applied_names, position = read_applied_deltas(applied_deltas_path)
+    spell_checker = SpellChecker(dictionary_path=monogram_pkl_path)
+    # the suggestions are built from the pickle before the merged one replaces it
+    query_suggestion = QuerySuggestion(monogram_pkl_path=monogram_pkl_path)
+    query_suggestion.load_words(words_path=words_path)
+
+    # both merge the same deltas, even if one is pushed meanwhile
+    deltas = get_dictionary_deltas(position)
+    spell_checker_follower = DictionaryDeltaFollower(spell_checker, applied_names, position)
+    merged = spell_checker_follower.merge(deltas)
+    DictionaryDeltaFollower(query_suggestion, applied_names, position).merge(deltas)
+    if not merged:
+        if spell_checker_follower.position != position:
+            # only deltas that were already merged, the services can skip them too
+            write_applied_deltas(applied_names, spell_checker_follower.position, applied_deltas_path)
+        return 0
+
+    spell_checker.save_snapshot(monogram_pkl_path)
+    query_suggestion.save_words(words_path)
+    write_applied_deltas(
+        spell_checker_follower.applied_names, spell_checker_follower.position, applied_deltas_path
+    )
+    if compact_dawg_path and os.path.exists(compact_dawg_path):
+        from compact_dawg import build_compact_dawg
+
+        build_compact_dawg(monogram_pkl_path, words_path, compact_dawg_path)
+    return merged
@@ -0,0 +1,212 @@
+import os
+import sys
+import time
+import asyncio
+import contextvars
+from threading import Lock
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+sys.path.append(os.path.dirname(__file__))
+
+from dotenv import load_dotenv
+from constant import PROJECT_PATH
+from metrics import counter, gauge, histogram, record_stage, request_timings
+from sharded_cache import get_cache_stats, worker_cache_stats
+
+NUM_OF_CORES = os.cpu_count() or 1
+EXECUTOR_MODES = ("inline", "thread", "process")
+
+EXECUTOR_QUEUE_DEPTH = gauge(
+    "executor_queue_depth", "Calls waiting for a concurrency slot of the endpoint", ["endpoint"]
+)
+EXECUTOR_IN_FLIGHT = gauge(
+    "executor_in_flight", "Calls of the endpoint running in its executor", ["endpoint"]
+)
+EXECUTOR_WAIT_SECONDS = histogram(
+    "executor_wait_seconds", "Time calls waited for a concurrency slot", ["endpoint"]
+)
+EXECUTOR_RUN_SECONDS = histogram(
+    "executor_run_seconds", "Time calls spent in the executor, pool queueing included", ["endpoint", "mode"]
+)
+EXECUTOR_CALLS = counter(
+    "executor_calls_total", "Calls dispatched to the executors", ["endpoint", "mode"]
+)
+
+resource_factories: Dict[str, Callable] = {}
+"""resource name -> picklable factory, process workers call it once at startup"""
+optional_resources = set()
+"""resources loaded on first use instead of at startup"""
+resources = {}
+"""resource name -> loaded resource of the current process"""
+resource_locks: Dict[str, Lock] = {}
+resource_locks_lock = Lock()
+
+thread_pool: Optional[ThreadPoolExecutor] = None
+process_pool: Optional[ProcessPoolExecutor] = None
+endpoint_executors: Dict[str, "EndpointExecutor"] = {}
+
+
+def register_resource(name: str, factory: Callable, optional: bool = False):
+    """Register how to load a model, the factory must be picklable to reach the process pool"""
+    resource_factories[name] = factory
+    if optional:
+        optional_resources.add(name)
+
+
+def get_resource(name: str):
+    """Resource of the current process, loaded once even when first requested by several threads"""
+    if name not in resources:
+        with resource_locks_lock:
+            lock = resource_locks.setdefault(name, Lock())
+        with lock:
+            if name not in resources:
+                resources[name] = resource_factories[name]()
+    return resources[name]
+
+
+def call_resource(name: str, method: str, *args, **kwargs):
+    """Call `method` of a resource, picklable so that it also runs in the process pool"""
+    return getattr(get_resource(name), method)(*args, **kwargs)
+
+
+def _preload_resources(factories: Dict[str, Callable]):
+    """Process pool initializer, loads the models before the worker takes any call"""
+    resource_factories.update(factories)
+    for name in factories:
+        get_resource(name)
+
+
+def _run_in_worker(func: Callable, *args):
+    """
+    Process pool call, returns the stage timings of the call and the cache stats of the worker
+    along with its result, so that the server process reports them
+    """
+    timings = {}
+    token = request_timings.set(timings)
+    try:
+        return func(*args), timings, os.getpid(), get_cache_stats()
+    finally:
+        request_timings.reset(token)
+
+
+def get_thread_pool() -> ThreadPoolExecutor:
+    global thread_pool
+    if thread_pool is None:
+        max_workers = int(os.getenv("EXECUTOR_THREAD_WORKERS", min(32, NUM_OF_CORES + 4)))
+        thread_pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="endpoint")
+    return thread_pool
+
+
+def get_process_pool() -> ProcessPoolExecutor:
+    """Shared process pool, its workers preload the resources of every process mode endpoint"""
+    global process_pool
+    if process_pool is None:
+        max_workers = int(os.getenv("EXECUTOR_PROCESS_WORKERS", NUM_OF_CORES))
+        preload = {
+            name: resource_factories[name]
+            for executor in endpoint_executors.values()
+            if executor.mode == "process"
+            for name in executor.resources
+            if name in resource_factories and name not in optional_resources
+        }
+        process_pool = ProcessPoolExecutor(
+            max_workers=max_workers, initializer=_preload_resources, initargs=(preload,)
+        )
+    return process_pool
+
+
+class EndpointExecutor:
+    """Runs the blocking work of an endpoint off the event loop, at most `max_concurrency` calls at once"""
+
+    def __init__(
+        self,
+        name: str,
+        mode: str = "thread",
+        max_concurrency: int = NUM_OF_CORES,
+        resources: List[str] = (),
+    ):
+        assert mode in EXECUTOR_MODES, f"Invalid executor mode: {mode}"
+        self.name = name
+        self.mode = mode
+        self.max_concurrency = max_concurrency
+        self.resources = list(resources)
+        self._semaphore = None
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        # created on first use so it belongs to the running event loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    async def run(self, func: Callable, *args):
+        EXECUTOR_QUEUE_DEPTH.inc(endpoint=self.name)
+        wait_start_time = time.perf_counter()
+        try:
+            await self.semaphore.acquire()
+        finally:
+            EXECUTOR_QUEUE_DEPTH.dec(endpoint=self.name)
+        EXECUTOR_WAIT_SECONDS.observe(time.perf_counter() - wait_start_time, endpoint=self.name)
+
+        EXECUTOR_IN_FLIGHT.inc(endpoint=self.name)
+        EXECUTOR_CALLS.inc(endpoint=self.name, mode=self.mode)
+        run_start_time = time.perf_counter()
+        try:
+            if self.mode == "inline":
+                return func(*args)
+            loop = asyncio.get_running_loop()
+            if self.mode == "thread":
+                # keep the request context so the stage timings of the call are recorded
+                context = contextvars.copy_context()
+                return await loop.run_in_executor(get_thread_pool(), context.run, func, *args)
+            # the stage timings and the cache stats of the worker are reported by this process
+            result, timings, pid, cache_stats = await loop.run_in_executor(
+                get_process_pool(), _run_in_worker, func, *args
+            )
+            for stage, elapsed in timings.items():
+                record_stage(stage, elapsed)
+            worker_cache_stats[pid] = cache_stats
+            return result
+        finally:
+            EXECUTOR_RUN_SECONDS.observe(
+                time.perf_counter() - run_start_time, endpoint=self.name, mode=self.mode
+            )
+            EXECUTOR_IN_FLIGHT.dec(endpoint=self.name)
+            self.semaphore.release()
+
+    async def call_resource(self, name: str, method: str, *args):
+        """Call `method` of the resource loaded in the process the call runs in"""
+        return await self.run(call_resource, name, method, *args)
+
+
+def get_endpoint_executor(
+    name: str,
+    default_mode: str = "thread",
+    resources: List[str] = (),
+) -> EndpointExecutor:
+    """
+    Executor of an endpoint, configured from the environment:
+    EXECUTOR_<NAME>_MODE (inline, thread or process) and EXECUTOR_<NAME>_CONCURRENCY.
+    """
+    if name not in endpoint_executors:
+        load_dotenv(dotenv_path=os.path.join(PROJECT_PATH, ".env"))
+        env_name = name.upper().replace("-", "_")
+        endpoint_executors[name] = EndpointExecutor(
+            name,
+            mode=os.getenv(f"EXECUTOR_{env_name}_MODE", default_mode).lower(),
+            max_concurrency=int(os.getenv(f"EXECUTOR_{env_name}_CONCURRENCY", NUM_OF_CORES)),
+            resources=resources,
+        )
+    return endpoint_executors[name]
+
+
+def shutdown_executors():
+    global thread_pool, process_pool
+    if thread_pool is not None:
+        thread_pool.shutdown(wait=False)
+        thread_pool = None
+    if process_pool is not None:
+        process_pool.shutdown(wait=False)
+        process_pool = None
+        worker_cache_stats.clear()
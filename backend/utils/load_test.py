@@ -0,0 +1,265 @@
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import importlib
+import contextlib
+import orjson
+import httpx
+import numpy as np
+from typing import Callable, Dict, List, Optional
+
+sys.path.append(os.path.dirname(__file__))
+
+from constant import PROJECT_PATH
+
+PERCENTILES = [50, 95, 99]
+DEFAULT_QUERIES = [
+    "Comic Relief",
+    "Donald Trump and Biden in 2024 USA",
+    "united kingdom",
+    "climate change",
+    "premier league football",
+    "interest rates",
+    "ukraine war",
+    "general election",
+    "bidan vs trumpp uneted stetes of amurica",
+    "artifical inteligence",
+]
+
+
+def boolean_request(query: str) -> dict:
+    return {"method": "GET", "url": "/search/boolean", "params": {"q": query}}
+
+
+def tfidf_request(query: str) -> dict:
+    return {"method": "GET", "url": "/search/tfidf", "params": {"q": query}}
+
+
+def spellcheck_request(query: str) -> dict:
+    return {"method": "GET", "url": "/search/spellcheck", "params": {"q": query}}
+
+
+def suggestion_request(query: str) -> dict:
+    return {"method": "POST", "url": "/search/expand-query/", "json": {"query": query}}
+
+
+def expansion_request(query: str) -> dict:
+    return {"method": "GET", "url": "/search/query-expansion", "params": {"q": query}}
+
+
+ENDPOINTS: Dict[str, Callable[[str], dict]] = {
+    "boolean": boolean_request,
+    "tfidf": tfidf_request,
+    "spellcheck": spellcheck_request,
+    "expand-query": suggestion_request,
+    "query-expansion": expansion_request,
+}
+
+
+def load_queries(file_path: Optional[str]) -> List[str]:
+    """One query per line, the built-in queries are used without a file"""
+    if file_path is None:
+        return DEFAULT_QUERIES
+    with open(file_path, "r") as f:
+        queries = [line.strip() for line in f if line.strip()]
+    assert queries, f"{file_path} has no queries"
+    return queries
+
+
+def load_app(app_path: str):
+    """The `module:app` to serve in this process"""
+    # the app modules import each other from the backend directory
+    sys.path.insert(0, PROJECT_PATH)
+    module_name, app_name = app_path.split(":")
+    return getattr(importlib.import_module(module_name), app_name)
+
+
+def get_client(app, base_url: Optional[str], timeout: float) -> httpx.AsyncClient:
+    """Client for a running server at `base_url`, or for the `app` served in this process"""
+    if base_url is not None:
+        return httpx.AsyncClient(base_url=base_url, timeout=timeout)
+    return httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=app), base_url="http://load-test", timeout=timeout
+    )
+
+
+async def wait_until_ready(client: httpx.AsyncClient, timeout: float, interval: float = 0.5):
+    """Poll the readiness probe until the models are loaded, the first runs would time the loading otherwise"""
+    deadline = time.perf_counter() + timeout
+    while True:
+        try:
+            response = await client.get("/health/ready")
+            if response.status_code == 200:
+                return
+            state = response.json()
+        except Exception as e:
+            state = {"status": repr(e)}
+        if state.get("status") == "failed":
+            raise RuntimeError(f"Startup failed: {state.get('resources')}")
+        if time.perf_counter() > deadline:
+            raise TimeoutError(f"Not ready after {timeout} seconds: {state}")
+        await asyncio.sleep(interval)
+
+
+async def warm_up(client: httpx.AsyncClient, endpoints: List[str], queries: List[str]):
+    """One request per endpoint before measuring, it loads the optional models left to their first call"""
+    for endpoint in endpoints:
+        try:
+            await client.request(**ENDPOINTS[endpoint](queries[0]))
+        except Exception:
+            pass
+
+
+async def sample_event_loop_lag(stop: asyncio.Event, interval: float = 0.01) -> List[float]:
+    """Sleep for `interval` repeatedly, any extra delay is time the loop was blocked"""
+    lags = []
+    while not stop.is_set():
+        start_time = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(max(time.perf_counter() - start_time - interval, 0.0))
+    return lags
+
+
+def summarise(values: List[float]) -> Dict[str, float]:
+    """Percentiles and max of durations in seconds, reported in milliseconds"""
+    if not values:
+        return {f"p{percentile}_ms": 0.0 for percentile in PERCENTILES} | {"max_ms": 0.0}
+    values_ms = np.array(values) * 1000
+    summary = {
+        f"p{percentile}_ms": float(value)
+        for percentile, value in zip(PERCENTILES, np.percentile(values_ms, PERCENTILES))
+    }
+    summary["max_ms"] = float(values_ms.max())
+    return summary
+
+
+async def run_load(
+    client: httpx.AsyncClient,
+    endpoints: List[str],
+    queries: List[str],
+    concurrency: int,
+    duration: float,
+    seed: int = 0,
+) -> Dict[str, dict]:
+    """Closed loop: `concurrency` users send requests back to back for `duration` seconds"""
+    rng = random.Random(seed)
+    latencies = {endpoint: [] for endpoint in endpoints}
+    errors = {endpoint: 0 for endpoint in endpoints}
+    error_samples = {endpoint: [] for endpoint in endpoints}
+    stop = asyncio.Event()
+    deadline = time.perf_counter() + duration
+
+    async def user():
+        while time.perf_counter() < deadline:
+            endpoint = rng.choice(endpoints)
+            request = ENDPOINTS[endpoint](rng.choice(queries))
+            start_time = time.perf_counter()
+            try:
+                response = await client.request(**request)
+                failed = response.status_code >= 400
+                reason = f"HTTP {response.status_code}"
+            except Exception as e:
+                failed = True
+                reason = repr(e)
+            latencies[endpoint].append(time.perf_counter() - start_time)
+            if failed:
+                errors[endpoint] += 1
+                if len(error_samples[endpoint]) < 5:
+                    error_samples[endpoint].append(reason)
+
+    lag_task = asyncio.create_task(sample_event_loop_lag(stop))
+    start_time = time.perf_counter()
+    await asyncio.gather(*[user() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start_time
+    stop.set()
+    lags = await lag_task
+
+    results = {}
+    for endpoint in endpoints:
+        requests = len(latencies[endpoint])
+        results[endpoint] = {
+            "requests": requests,
+            "errors": errors[endpoint],
+            "error_rate": errors[endpoint] / requests if requests else 0.0,
+            "throughput_rps": requests / elapsed,
+            **summarise(latencies[endpoint]),
+            "error_samples": error_samples[endpoint],
+        }
+    results["event_loop_lag"] = summarise(lags)
+    return results
+
+
+def print_results(name: str, results: Dict[str, dict]):
+    print(f"== {name}")
+    for endpoint, summary in results.items():
+        if endpoint == "event_loop_lag":
+            continue
+        print(
+            f"{endpoint:>16}: {summary['requests']:>6} req {summary['throughput_rps']:8.1f} req/s "
+            f"p50 {summary['p50_ms']:8.2f}ms p95 {summary['p95_ms']:8.2f}ms "
+            f"p99 {summary['p99_ms']:8.2f}ms errors {summary['error_rate']:.1%}"
+        )
+        for reason in summary["error_samples"]:
+            print(f"{'':>18}{reason}")
+    lag = results["event_loop_lag"]
+    print(
+        f"{'event loop lag':>16}: p50 {lag['p50_ms']:.2f}ms p99 {lag['p99_ms']:.2f}ms "
+        f"max {lag['max_ms']:.2f}ms"
+    )
+
+
+async def main(args):
+    queries = load_queries(args.queries)
+    app = None if args.url else load_app(args.app)
+    # ASGITransport sends no lifespan events, run the lifespan of the in-process app here
+    # so that the models are loaded in the background and the executors shut down after
+    lifespan = app.router.lifespan_context(app) if app is not None else contextlib.nullcontext()
+    report = {
+        "target": args.url or args.app,
+        "concurrency": args.concurrency,
+        "duration": args.duration,
+        "runs": {},
+    }
+    async with lifespan, get_client(app, args.url, args.timeout) as client:
+        await wait_until_ready(client, args.ready_timeout)
+        await warm_up(client, args.endpoints, queries)
+        # every endpoint on its own, then all of them together when asked to
+        runs = {endpoint: [endpoint] for endpoint in args.endpoints}
+        if args.mixed:
+            runs["mixed"] = args.endpoints
+        for name, endpoints in runs.items():
+            results = await run_load(
+                client, endpoints, queries, args.concurrency, args.duration, args.seed
+            )
+            report["runs"][name] = results
+            print_results(name, results)
+
+    if args.output:
+        with open(args.output, "wb") as f:
+            f.write(orjson.dumps(report, option=orjson.OPT_INDENT_2))
+        print(f"Saved results to {args.output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the search endpoints")
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument("--app", default="main:app", help="module:app served in this process")
+    target.add_argument(
+        "--url",
+        help="base url of a running server, e.g. http://127.0.0.1:8001, the event loop lag is then the client's",
+    )
+    parser.add_argument("--endpoints", nargs="+", choices=list(ENDPOINTS), default=list(ENDPOINTS))
+    parser.add_argument("--mixed", action="store_true", help="also run all endpoints together")
+    parser.add_argument("--queries", help="file with one query per line")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per run")
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument(
+        "--ready-timeout", type=float, default=600.0, help="seconds to wait for the models to load"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="json file for the results")
+    asyncio.run(main(parser.parse_args()))
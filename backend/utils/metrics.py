@@ -0,0 +1,227 @@
+import os
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock
+from typing import Dict, List, Optional, Tuple
+
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+registry = {}
+"""metric name -> metric, rendered in registration order by generate_latest"""
+
+request_timings: ContextVar[Optional[Dict[str, float]]] = ContextVar(
+    "request_timings", default=None
+)
+"""stage -> seconds of the request being served, None outside a request"""
+
+
+def _format_labels(label_names: Tuple[str, ...], label_values: Tuple[str, ...], extra: str = "") -> str:
+    labels = [f'{name}="{value}"' for name, value in zip(label_names, label_values)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+class Histogram:
+    """Prometheus histogram with cumulative buckets, one series per label values"""
+
+    metric_type = "histogram"
+
+    def __init__(self, name: str, documentation: str, label_names: List[str] = (), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._series = {}  # label values -> [bucket counts..., sum, count]
+        self._lock = Lock()
+
+    def observe(self, value: float, **labels):
+        label_values = tuple(str(labels[name]) for name in self.label_names)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 2)
+            bucket = bisect_left(self.buckets, value)
+            if bucket < len(self.buckets):
+                series[bucket] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def collect(self) -> List[str]:
+        lines = []
+        with self._lock:
+            series_items = [(k, list(v)) for k, v in self._series.items()]
+        for label_values, series in series_items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, series):
+                cumulative += bucket_count
+                labels = _format_labels(self.label_names, label_values, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.label_names, label_values, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{labels} {series[-1]}")
+            labels = _format_labels(self.label_names, label_values)
+            lines.append(f"{self.name}_sum{labels} {series[-2]}")
+            lines.append(f"{self.name}_count{labels} {series[-1]}")
+        return lines
+
+
+class Gauge:
+    """Prometheus gauge, one value per label values"""
+
+    metric_type = "gauge"
+
+    def __init__(self, name: str, documentation: str, label_names: List[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = {}  # label values -> value
+        self._lock = Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        label_values = tuple(str(labels[name]) for name in self.label_names)
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        label_values = tuple(str(labels[name]) for name in self.label_names)
+        with self._lock:
+            self._values[label_values] = value
+
+    def collect(self) -> List[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return [
+            f"{self.name}{_format_labels(self.label_names, label_values)} {value}"
+            for label_values, value in values
+        ]
+
+
+class Counter(Gauge):
+    """Prometheus counter, a gauge that only goes up"""
+
+    metric_type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        assert amount >= 0, "Counters can only be increased"
+        super().inc(amount, **labels)
+
+
+class CallbackMetric:
+    """Metric read from `callback` when collected, for values counted elsewhere without locking here"""
+
+    def __init__(self, name: str, documentation: str, metric_type: str, label_names: List[str], callback):
+        self.name = name
+        self.documentation = documentation
+        self.metric_type = metric_type
+        self.label_names = tuple(label_names)
+        self.callback = callback  # returns {label values: value}
+
+    def collect(self) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(self.label_names, label_values)} {value}"
+            for label_values, value in self.callback().items()
+        ]
+
+
+def _get_or_register(metric_class, name: str, *args, **kwargs):
+    if name not in registry:
+        registry[name] = metric_class(name, *args, **kwargs)
+    return registry[name]
+
+
+def histogram(name: str, documentation: str, label_names: List[str] = (), buckets=DEFAULT_BUCKETS) -> Histogram:
+    """Get the histogram registered under `name`, registering it on first use"""
+    return _get_or_register(Histogram, name, documentation, label_names, buckets)
+
+
+def gauge(name: str, documentation: str, label_names: List[str] = ()) -> Gauge:
+    """Get the gauge registered under `name`, registering it on first use"""
+    return _get_or_register(Gauge, name, documentation, label_names)
+
+
+def counter(name: str, documentation: str, label_names: List[str] = ()) -> Counter:
+    """Get the counter registered under `name`, registering it on first use"""
+    return _get_or_register(Counter, name, documentation, label_names)
+
+
+def callback_metric(
+    name: str, documentation: str, metric_type: str, label_names: List[str], callback
+) -> CallbackMetric:
+    """Get the callback metric registered under `name`, registering it on first use"""
+    return _get_or_register(CallbackMetric, name, documentation, metric_type, label_names, callback)
+
+
+def generate_latest() -> str:
+    """Render every registered metric in the Prometheus text exposition format"""
+    lines = []
+    for metric in list(registry.values()):
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.metric_type}")
+        lines.extend(metric.collect())
+    return "\n".join(lines) + "\n"
+
+
+QUERY_STAGE_SECONDS = histogram(
+    "search_query_stage_seconds", "Time spent in each stage of a search query", ["stage"]
+)
+HTTP_REQUEST_SECONDS = histogram(
+    "http_request_seconds", "Time spent serving HTTP requests", ["method", "route", "status"]
+)
+
+
+@contextmanager
+def time_stage(stage: str):
+    """Record the time spent in the block under `stage` for the histogram and the request"""
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start_time)
+
+
+def record_stage(stage: str, elapsed: float):
+    """Record `elapsed` seconds under `stage`, for the stages timed in another process"""
+    QUERY_STAGE_SECONDS.observe(elapsed, stage=stage)
+    timings = request_timings.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + elapsed
+
+
+def is_server_timing_enabled() -> bool:
+    return os.getenv("SERVER_TIMING", "false").lower() == "true"
+
+
+def server_timing_header(timings: Dict[str, float]) -> str:
+    """Stages running concurrently are summed, so they can add up to more than the total"""
+    return ", ".join(f"{stage};dur={seconds * 1000:.2f}" for stage, seconds in timings.items())
+
+
+async def server_timing_middleware(request, call_next):
+    """HTTP middleware timing every request, adding a Server-Timing header if SERVER_TIMING=true"""
+    timings = {}
+    token = request_timings.set(timings)
+    start_time = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        request_timings.reset(token)
+    elapsed = time.perf_counter() - start_time
+
+    route = request.scope.get("route")
+    HTTP_REQUEST_SECONDS.observe(
+        elapsed,
+        method=request.method,
+        route=route.path if route is not None else "unmatched",
+        status=response.status_code,
+    )
+    if is_server_timing_enabled():
+        timings["total"] = elapsed
+        response.headers["Server-Timing"] = server_timing_header(timings)
+    return response
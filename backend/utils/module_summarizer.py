@@ -2,84 +2,109 @@ import re
 import pandas as pd
 import numpy as np
 from collections import Counter
-from math import log
+from functools import lru_cache
+from scipy.sparse import csr_matrix
 import orjson
 import warnings
 import pandas as pd
 from tqdm import tqdm
-from typing import List
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Dict, Iterator, List, Optional, Tuple
 import os, sys
 
 BASEPATH = os.path.dirname(__file__)
 sys.path.append(BASEPATH)
 
-from common import get_preprocessed_words
+from common import get_stop_words, stemmer, tokenize
 
-def compute_tf(text: str) -> dict:
-    """Calculate term frequency for a given text."""
-    tf_text = Counter(text)
-    for i in tf_text:
-        tf_text[i] = tf_text[i] / float(len(text))
-    return tf_text
+STEM_CACHE_SIZE = 100000
 
 
-# Helper function to calculate inverse document frequency
-def compute_idf(word: str, corpus: list) -> float:
-    """Calculate inverse document frequency for a given word in a corpus."""
-    return log(len(corpus) / sum([1.0 for i in corpus if word in i]))
+@lru_cache(maxsize=STEM_CACHE_SIZE)
+def _stem(word: str) -> str:
+    return stemmer.stem(word)
 
 
-# Calculate cosine similarity between title and each sentence
-def cosine_similarity(vector1, vector2) -> float:
-    """Calculate cosine similarity between two vectors."""
-    dot_product = np.dot(vector1, vector2)
-    norm_a = np.linalg.norm(vector1)
-    norm_b = np.linalg.norm(vector2)
-    if norm_a == 0 or norm_b == 0:  # Avoid division by zero
-        return 0.0
-    return dot_product / (norm_a * norm_b)
+_stop_words = None
+
+
+def _preprocess(text: str) -> List[str]:
+    """
+    get_preprocessed_words with stopping and stemming, with the stop words in a set and
+    the stems of the words cached across articles
+    """
+    global _stop_words
+    if _stop_words is None:
+        _stop_words = set(get_stop_words())
+    return [
+        _stem(token)
+        for token in (token.lower() for token in tokenize(text))
+        if token not in _stop_words
+    ]
+
+
+def _substring_document_frequencies(vocabulary: List[str], presence: csr_matrix) -> np.ndarray:
+    """
+    The number of texts containing every word of the vocabulary as a substring, like
+    `word in text` on the texts joined with spaces: a word is in a text when it is part of
+    one of its words. presence is the binary text-word matrix.
+    """
+    joined = " ".join(vocabulary)
+    starts = np.cumsum([0] + [len(word) + 1 for word in vocabulary[:-1]])
+    rows, cols = [], []
+    for col, word in enumerate(vocabulary):
+        position = joined.find(word)
+        while position != -1:
+            # words have no spaces, so every match is inside a single word
+            rows.append(int(np.searchsorted(starts, position, side="right")) - 1)
+            cols.append(col)
+            position = joined.find(word, position + 1)
+    containment = csr_matrix(
+        (np.ones(len(rows), dtype=np.float64), (rows, cols)), shape=(len(vocabulary), len(vocabulary))
+    )
+    return np.asarray(((presence @ containment) > 0).sum(axis=0)).ravel()
 
 
 def get_summary_sentence(
     title: str, content: str, number_of_initial_sentences_to_skip: int
 ) -> str:
-    """Get the most relevant sentence from the article content setences based on the title."""
+    """
+    Get the most relevant sentence from the article content setences based on the title.
+    The title and sentences are TF-IDF vectors in one sparse matrix, compared with the title
+    in one product.
+    """
     split_regex = r"[.!?]"
     article_sentences = re.split(split_regex, content)
     article_sentences_lower = [x.lower() for x in article_sentences if x]
 
     # Preprocess title and sentences
-    preprocessed_title = " ".join(get_preprocessed_words(title))
-    preprocessed_sentences = [
-        " ".join(get_preprocessed_words(sentence))
-        for sentence in article_sentences_lower
-    ]
-
-    # Combine title and adjusted sentences for manual TF-IDF vectorization
-    texts = [preprocessed_title] + preprocessed_sentences[
-        number_of_initial_sentences_to_skip:
-    ]
-
-    # Create a set of all unique words
-    vocabulary = set(word for text in texts for word in text.split())
-
-    # Calculate TF for each document
-    tfs = [compute_tf(text.split()) for text in texts]
-
-    # Calculate IDF for each word in the vocabulary
-    idfs = {word: compute_idf(word, texts) for word in vocabulary}
-
-    # Calculate TF-IDF vectors
-    tfidf_vectors = []
-    for tf in tfs:
-        tfidf_vectors.append(
-            np.array([tf.get(word, 0) * idfs[word] for word in vocabulary])
-        )
+    texts = [_preprocess(title)] + [
+        _preprocess(sentence) for sentence in article_sentences_lower
+    ][number_of_initial_sentences_to_skip:]
+
+    # term frequencies of the words of every text, a column per word of the vocabulary
+    vocabulary_index = {}
+    rows, cols, values = [], [], []
+    for row, words in enumerate(texts):
+        for word, count in Counter(words).items():
+            rows.append(row)
+            cols.append(vocabulary_index.setdefault(word, len(vocabulary_index)))
+            values.append(count / float(len(words)))
+    shape = (len(texts), len(vocabulary_index))
+    tfs = csr_matrix((values, (rows, cols)), shape=shape)
+    presence = csr_matrix((np.ones(len(values)), (rows, cols)), shape=shape)
+
+    # the IDF of a word counts the texts it is a substring of, like it always has
+    idfs = np.log(len(texts) / _substring_document_frequencies(list(vocabulary_index), presence))
+    tfidf_vectors = tfs.multiply(idfs[None, :]).tocsr()
 
     # Compute similarities
-    similarities = [
-        cosine_similarity(tfidf_vectors[0], vec) for vec in tfidf_vectors[1:]
-    ]
+    norms = np.sqrt(np.asarray(tfidf_vectors.multiply(tfidf_vectors).sum(axis=1)).ravel())
+    dot_products = np.asarray(tfidf_vectors[1:] @ tfidf_vectors[0].T.toarray()).ravel()
+    with np.errstate(divide="ignore", invalid="ignore"):
+        similarities = np.where(
+            (norms[1:] == 0) | (norms[0] == 0), 0.0, dot_products / (norms[1:] * norms[0])
+        )
 
     # Find the most similar sentence index
     most_similar_sentence_index = (
@@ -110,19 +135,99 @@ def get_summaries_of_csv_file(
                 f"Duplicate doc_id found: {current_doc_id}. Overwriting the previous entry!"
             )
 
-        try:
-            current_summary = get_summary_sentence(
-                current_title, current_content, number_of_initial_sentences_to_skip
-            )
-            summaries_dictionary[str(current_doc_id)] = current_summary.strip()
-
-        except Exception as e:
-            summaries_dictionary[str(current_doc_id)] = None
-            continue
+        summaries_dictionary[str(current_doc_id)] = get_summary(
+            current_title, current_content, number_of_initial_sentences_to_skip
+        )
 
     return summaries_dictionary
 
 
+def get_summary(title, content, number_of_initial_sentences_to_skip=2) -> Optional[str]:
+    """The summary sentence of an article, None when it has none"""
+    try:
+        return get_summary_sentence(
+            title, content, number_of_initial_sentences_to_skip
+        ).strip()
+    except Exception as e:
+        return None
+
+
+def summarize_rows(
+    rows: List[Tuple[str, str, str]], number_of_initial_sentences_to_skip: int = 2
+) -> List[Tuple[str, Optional[str]]]:
+    """(doc_id, summary) of (doc_id, title, content) rows"""
+    return [
+        (doc_id, get_summary(title, content, number_of_initial_sentences_to_skip))
+        for doc_id, title, content in rows
+    ]
+
+
+def read_summary_checkpoint(checkpoint_path: str) -> Dict[str, Optional[str]]:
+    """
+    The summaries of a JSONL checkpoint of [doc_id, summary] lines. A line cut by a crash
+    is removed, so that the next results are appended after the last complete one.
+    """
+    summaries = {}
+    if not os.path.exists(checkpoint_path):
+        return summaries
+    with open(checkpoint_path, "rb+") as file:
+        data = file.read()
+        complete_size = data.rfind(b"\n") + 1
+        if complete_size < len(data):
+            file.truncate(complete_size)
+    for line in data[:complete_size].splitlines():
+        doc_id, summary = orjson.loads(line)
+        summaries[doc_id] = summary
+    return summaries
+
+
+def iter_article_chunks(
+    csv_paths: List[str], chunk_size: int, skipped_doc_ids=()
+) -> Iterator[List[Tuple[str, str, str]]]:
+    """(doc_id, title, content) rows of the csv files, `chunk_size` rows read at a time"""
+    for csv_path in csv_paths:
+        for df in pd.read_csv(csv_path, usecols=["doc_id", "title", "content"], chunksize=chunk_size):
+            rows = [
+                (str(doc_id), title, content)
+                for doc_id, title, content in zip(df["doc_id"], df["title"], df["content"])
+                if str(doc_id) not in skipped_doc_ids
+            ]
+            if rows:
+                yield rows
+
+
+def summarize_csv_files(
+    csv_paths: List[str],
+    checkpoint_path: str,
+    workers: int = os.cpu_count() or 1,
+    chunk_size: int = 500,
+    number_of_initial_sentences_to_skip: int = 2,
+) -> Iterator[Tuple[str, Optional[str]]]:
+    """
+    Summarize the articles of the csv files in chunks on a process pool, and yield the
+    (doc_id, summary) of every chunk once it is appended to the JSONL checkpoint.
+    The articles already in the checkpoint are skipped, so an interrupted run resumes.
+    """
+    done_doc_ids = set(read_summary_checkpoint(checkpoint_path))
+    with open(checkpoint_path, "ab") as checkpoint, ProcessPoolExecutor(max_workers=workers) as executor:
+
+        def write_finished(futures) -> Iterator[Tuple[str, Optional[str]]]:
+            for future in futures:
+                results = future.result()
+                checkpoint.write(b"".join(orjson.dumps(result) + b"\n" for result in results))
+                checkpoint.flush()
+                yield from results
+
+        # a few chunks per worker are queued, the articles are not all read ahead
+        pending = set()
+        for rows in iter_article_chunks(csv_paths, chunk_size, done_doc_ids):
+            pending.add(executor.submit(summarize_rows, rows, number_of_initial_sentences_to_skip))
+            if len(pending) >= 2 * workers:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                yield from write_finished(finished)
+        yield from write_finished(pending)
+
+
 def process_directories_and_write_summary_dictionary(
     data_path: str,
     outlet_folders: List[str],
@@ -0,0 +1,152 @@
+import os
+import sys
+import time
+import argparse
+import numpy as np
+from typing import Dict, List, Optional
+
+sys.path.append(os.path.dirname(__file__))
+
+from dotenv import load_dotenv
+from constant import ONNX_MODEL_PATH, PROJECT_PATH
+from common import get_logger
+
+logger = get_logger(__name__)
+
+SENTIMENT_MODEL_NAME = "mrm8488/distilroberta-finetuned-financial-news-sentiment-analysis"
+FILL_MASK_MODEL_NAME = "roberta-base"
+# the exported models, by the name of their folder in ONNX_MODEL_PATH
+ONNX_MODELS = {
+    "sentiment": (SENTIMENT_MODEL_NAME, "sequence-classification"),
+    "fill-mask": (FILL_MASK_MODEL_NAME, "masked-lm"),
+}
+MODEL_FILE = "model.onnx"
+
+
+def get_inference_backend() -> str:
+    """INFERENCE_BACKEND, torch by default or onnx to run the exported models on onnxruntime"""
+    load_dotenv(dotenv_path=os.path.join(PROJECT_PATH, ".env"))
+    return os.getenv("INFERENCE_BACKEND", "torch").lower()
+
+
+def get_onnx_model_dir(name: str) -> str:
+    return os.path.join(ONNX_MODEL_PATH, name)
+
+
+def has_onnx_model(name: str) -> bool:
+    return os.path.exists(os.path.join(get_onnx_model_dir(name), MODEL_FILE))
+
+
+def use_onnx_model(name: str) -> bool:
+    """Whether the onnx backend is set and the model was exported, the torch model is used otherwise"""
+    if get_inference_backend() != "onnx":
+        return False
+    if not has_onnx_model(name):
+        logger.warning("No onnx %s model in %s, using torch", name, get_onnx_model_dir(name))
+        return False
+    return True
+
+
+def export_onnx_model(name: str, quantize: bool = False, opset: int = 14) -> str:
+    """
+    Export a model and its tokenizer to ONNX_MODEL_PATH/name. With quantize, the weights of
+    the exported graph are quantized to int8 and the float graph is kept as model.fp32.onnx.
+    """
+    import torch
+    from transformers import AutoTokenizer, AutoModelForMaskedLM, AutoModelForSequenceClassification
+
+    model_name, task = ONNX_MODELS[name]
+    model_class = AutoModelForSequenceClassification if task == "sequence-classification" else AutoModelForMaskedLM
+    output_dir = get_onnx_model_dir(name)
+    os.makedirs(output_dir, exist_ok=True)
+
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = model_class.from_pretrained(model_name, return_dict=False).eval()
+    tokenizer.save_pretrained(output_dir)
+
+    model_path = os.path.join(output_dir, MODEL_FILE)
+    float_model_path = os.path.join(output_dir, "model.fp32.onnx") if quantize else model_path
+    inputs = tokenizer("An example sentence.", return_tensors="pt")
+    with torch.inference_mode():
+        torch.onnx.export(
+            model,
+            (inputs["input_ids"], inputs["attention_mask"]),
+            float_model_path,
+            input_names=["input_ids", "attention_mask"],
+            output_names=["logits"],
+            dynamic_axes={
+                "input_ids": {0: "batch", 1: "sequence"},
+                "attention_mask": {0: "batch", 1: "sequence"},
+                "logits": {0: "batch", 1: "sequence"} if task == "masked-lm" else {0: "batch"},
+            },
+            opset_version=opset,
+        )
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        quantize_dynamic(float_model_path, model_path, weight_type=QuantType.QInt8)
+    return model_path
+
+
+def load_onnx_session(name: str, num_threads: Optional[int] = None):
+    """An onnxruntime session of an exported model on the CPU provider"""
+    import onnxruntime
+
+    options = onnxruntime.SessionOptions()
+    if num_threads:
+        options.intra_op_num_threads = num_threads
+    return onnxruntime.InferenceSession(
+        os.path.join(get_onnx_model_dir(name), MODEL_FILE),
+        sess_options=options,
+        providers=["CPUExecutionProvider"],
+    )
+
+
+def softmax(logits: np.ndarray) -> np.ndarray:
+    exp = np.exp(logits - logits.max(axis=-1, keepdims=True))
+    return exp / exp.sum(axis=-1, keepdims=True)
+
+
+class OnnxFillMask:
+    """The fill-mask pipeline of transformers for one mask, on the exported model"""
+
+    def __init__(self, name: str = "fill-mask", num_threads: Optional[int] = None):
+        from transformers import AutoTokenizer
+
+        self.tokenizer = AutoTokenizer.from_pretrained(get_onnx_model_dir(name))
+        self.session = load_onnx_session(name, num_threads)
+
+    def __call__(self, text: str, top_k: int = 5) -> List[Dict]:
+        inputs = self.tokenizer(text, return_tensors="np")
+        input_ids = inputs["input_ids"].astype(np.int64)
+        (logits,) = self.session.run(
+            ["logits"], {"input_ids": input_ids, "attention_mask": inputs["attention_mask"].astype(np.int64)}
+        )
+        mask_position = int(np.flatnonzero(input_ids[0] == self.tokenizer.mask_token_id)[0])
+        probabilities = softmax(logits[0, mask_position])
+        suggestions = []
+        for token_id in np.argsort(-probabilities)[:top_k]:
+            tokens = input_ids[0].copy()
+            tokens[mask_position] = token_id
+            suggestions.append(
+                {
+                    "score": float(probabilities[token_id]),
+                    "token": int(token_id),
+                    "token_str": self.tokenizer.decode([int(token_id)]),
+                    "sequence": self.tokenizer.decode(tokens, skip_special_tokens=True),
+                }
+            )
+        return suggestions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the transformer models to onnx for INFERENCE_BACKEND=onnx")
+    parser.add_argument("--models", nargs="+", choices=list(ONNX_MODELS), default=list(ONNX_MODELS))
+    parser.add_argument("--quantize", action="store_true", help="quantize the weights to int8")
+    parser.add_argument("--opset", type=int, default=14)
+    args = parser.parse_args()
+
+    for name in args.models:
+        start_time = time.time()
+        model_path = export_onnx_model(name, args.quantize, args.opset)
+        print(f"Exported {name} to {model_path} in {time.time() - start_time:.2f} seconds")
@@ -11,9 +11,16 @@ sys.path.append(BASEPATH)
 # from redis_utils import get_redis_config, update_doc_size, batch_push
 from common import read_binary_file
 from basetype import InvertedIndex
-from redis_utils import initialize_async_redis, update_index, get_redis_config, update_tfidf_index
-from constant import CHILD_INDEX_PATH
-from build_index import merge_inverted_indices
+from redis_utils import (
+    initialize_async_redis,
+    update_index,
+    get_redis_config,
+    update_tfidf_index,
+    add_shard,
+    is_index_sharding_enabled,
+)
+from constant import CHILD_INDEX_PATH, SHARD_SIZE
+from build_index import merge_inverted_indices, split_index_by_doc_range
 from typing import Tuple, Dict
 
 def load_index(path_index="result/inverted_index.json"):
@@ -42,7 +49,14 @@ def get_tf(inverted_index: InvertedIndex) -> Dict[str, Dict[str, int]]:
             tf_index[term][doc_id] = len(positions)
     return tf_index
 
-async def push_inverted_indices_to_redis(batch_size=10):
+async def push_sharded_index(inverted_index: InvertedIndex, shard_size: int = SHARD_SIZE):
+    """Push the index into the doc-id range shards, new shards are registered as they appear"""
+    for shard_id, shard_index in split_index_by_doc_range(inverted_index, shard_size).items():
+        await update_index(shard_index, shard_id=shard_id)
+        await update_tfidf_index(shard_index, shard_id=shard_id)
+        await add_shard(shard_id)
+
+async def push_inverted_indices_to_redis(batch_size=10, sharded=False):
     files = os.listdir(CHILD_INDEX_PATH)
     file_batches = [files[i:i+batch_size] for i in range(0, len(files), batch_size)]
     for idx, batch in enumerate(file_batches):
@@ -54,10 +68,14 @@ async def push_inverted_indices_to_redis(batch_size=10):
             parent_inverted_index.meta.document_size += child_inverted_index.meta.document_size
             parent_inverted_index.meta.doc_ids_list.extend(child_inverted_index.meta.doc_ids_list)
         
-        await update_index(parent_inverted_index)
-        print(f"\r{' '*100}\r IDX: {idx+1}/{len(file_batches)} for positional inverted index", end="")
-        await update_tfidf_index(parent_inverted_index)
-        print(f"\r{' '*100}\r IDX: {idx+1}/{len(file_batches)} for tfidf index", end="")
+        if sharded:
+            await push_sharded_index(parent_inverted_index)
+            print(f"\r{' '*100}\r IDX: {idx+1}/{len(file_batches)} for sharded index", end="")
+        else:
+            await update_index(parent_inverted_index)
+            print(f"\r{' '*100}\r IDX: {idx+1}/{len(file_batches)} for positional inverted index", end="")
+            await update_tfidf_index(parent_inverted_index)
+            print(f"\r{' '*100}\r IDX: {idx+1}/{len(file_batches)} for tfidf index", end="")
         
         # free memory
         del parent_inverted_index
@@ -72,4 +90,4 @@ if __name__ == "__main__":
     #     inverted_index = InvertedIndex.model_validate_json(inverted_index_str)
     #     asyncio.run(update_index(inverted_index))
     #     print(f"\r{' '*100}\r IDX: {idx}", end="")
-    asyncio.run(push_inverted_indices_to_redis(10))
\ No newline at end of file
+    asyncio.run(push_inverted_indices_to_redis(10, sharded=is_index_sharding_enabled()))
\ No newline at end of file
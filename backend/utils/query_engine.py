@@ -6,15 +6,20 @@ import math
 import asyncio
 import sys
 import heapq
+from itertools import islice
 sys.path.append(os.path.dirname(__file__))
 from nltk.stem import PorterStemmer
-from typing import DefaultDict, Dict, List, Tuple, Set
-from common import read_file, get_stop_words, get_preprocessed_words
+from typing import DefaultDict, Dict, List, Tuple, Set, Optional
+from common import read_file, get_stop_words, get_preprocessed_words, get_logger
+from metrics import time_stage
+from executors import get_endpoint_executor
 from redis_utils import (
     get_doc_size,
     get_tfidf_doc_size,
     get_tfs,
     get_doc_ids_list,
+    get_dfs,
+    get_shard_ids,
     get_json_values,
     is_key_exists,
     get_json_value,
@@ -25,6 +30,7 @@ from concurrent.futures import ProcessPoolExecutor
 
 # STOP_WORDS_FILE = "ttds_2023_english_stop_words.txt"
 
+logger = get_logger(__name__)
 CURRENT_DIR = os.path.dirname(os.path.realpath(__file__))
 NUM_OF_CORES = os.cpu_count()
 SPECIAL_PATTERN = {
@@ -55,52 +61,59 @@ def preprocess_match(
     return word
 
 
-def load_queries(file_name: str) -> list:
-    query_lines = read_file(file_name).split("\n")
+def parse_queries(content: str) -> List[Tuple[str, str]]:
+    """Parse "query_id: query" lines into (query_id, query) pairs"""
     queries = []
-    for line in query_lines:
-        if line == "":
+    for line in content.split("\n"):
+        if line.strip() == "":
             continue
-        query_id, query_text = line.split(":")
-        queries.append(query_text.strip())
+        query_id, query_text = line.split(":", 1)
+        queries.append((query_id.strip(), query_text.strip()))
     return queries
 
 
+def load_queries(file_name: str) -> list:
+    return [query_text for _, query_text in parse_queries(read_file(file_name))]
+
+
 def handle_binary_operator(operator: str, left: list, right: list) -> list:
     # print("handle binary operator", operator, left, right)
     left = [] if left is None else left
     right = [] if right is None else right
     if operator == "AND":
-        print("AND operation")
+        logger.debug("AND operation")
         return list(set(left) & set(right))
     elif operator == "OR":
-        print("OR operation")
+        logger.debug("OR operation")
         return list(set(left) | set(right))
 
 
 def handle_not_operator(operand: List[int], doc_ids_list: List[int]) -> List[int]:
-    print("NOT operation")
+    logger.debug("NOT operation")
     if operand is None:
         return doc_ids_list
     return list(set(doc_ids_list) - set(operand))
 
 
-async def get_doc_ids_from_string(string: str) -> List[int]:
+async def get_doc_ids_from_string(string: str, shard_id: Optional[int] = None) -> List[int]:
     # check if string is a phrase bounded by double quotes
-    if await is_key_exists(RedisKeys.index(string)):
-        term_index = await get_json_value(RedisKeys.index(string))
+    term_key = RedisKeys.shard(shard_id, RedisKeys.index(string))
+    if await is_key_exists(term_key):
+        term_index = await get_json_value(term_key)
         return list(map(int, term_index.keys()))
     else:
         return []
 
 
-async def get_doc_ids_from_pattern(pattern: str) -> List[int]:
+async def get_doc_ids_from_pattern(pattern: str, shard_id: Optional[int] = None) -> List[int]:
     # pattern is of the form "A B"/"A B C" etc
     # retrieve words from the pattern
     doc_ids = []
     words = re.findall(r"\w+", pattern)
     # check if the word are in consecutive positions
-    words_index = await get_json_values([RedisKeys.index(word) for word in words])
+    words_index = await get_json_values(
+        [RedisKeys.shard(shard_id, RedisKeys.index(word)) for word in words]
+    )
     for doc_id in words_index[0]:
         positions = delta_decode_list(words_index[0][doc_id])
         for pos in positions:
@@ -139,12 +152,19 @@ async def process_doc_id(doc_id, values, n):
     except:
         pass
 
-async def evaluate_proximity_pattern(n: int, w1: str, w2: str) -> List[int]:
+async def evaluate_proximity_pattern(
+    n: int, w1: str, w2: str, shard_id: Optional[int] = None
+) -> List[int]:
     # find all the doc_ids for w1 and w2
-    doc_ids_for_w1 = await get_doc_ids_from_string(w1)
+    doc_ids_for_w1 = await get_doc_ids_from_string(w1, shard_id)
     # find the doc_ids that satisfy the condition
     doc_ids = []
-    values = await get_json_values([RedisKeys.index(w1), RedisKeys.index(w2)])
+    values = await get_json_values(
+        [
+            RedisKeys.shard(shard_id, RedisKeys.index(w1)),
+            RedisKeys.shard(shard_id, RedisKeys.index(w2)),
+        ]
+    )
     tasks = []
     for doc_id in doc_ids_for_w1:
         tasks.append(process_doc_id(doc_id, values, n))
@@ -154,7 +174,9 @@ async def evaluate_proximity_pattern(n: int, w1: str, w2: str) -> List[int]:
 
 
 async def evaluate_subquery(
-    subquery: str, special_patterns: Dict[str, re.Pattern]
+    subquery: str,
+    special_patterns: Dict[str, re.Pattern],
+    shard_id: Optional[int] = None,
 ) -> List[int]:
 
     proximity_match = re.match(special_patterns["proximity"], subquery)
@@ -163,15 +185,15 @@ async def evaluate_subquery(
         n = proximity_match.group(1)
         w1 = proximity_match.group(2)
         w2 = proximity_match.group(3)
-        print("Handle proximity pattern", n, w1, w2)
-        return await evaluate_proximity_pattern(n, w1, w2)
+        logger.debug("Handle proximity pattern %s %s %s", n, w1, w2)
+        return await evaluate_proximity_pattern(n, w1, w2, shard_id)
     else:
         if exact_match:
-            print("handle phrase", subquery[1:-1])
-            return await get_doc_ids_from_pattern(subquery[1:-1])
+            logger.debug("handle phrase %s", subquery[1:-1])
+            return await get_doc_ids_from_pattern(subquery[1:-1], shard_id)
         else:
-            print("handle word(s)", subquery)
-            return await get_doc_ids_from_string(subquery)
+            logger.debug("handle word(s) %s", subquery)
+            return await get_doc_ids_from_string(subquery, shard_id)
 
 
 def calculate_tf_idf(
@@ -183,7 +205,8 @@ def calculate_tf_idf(
 ) -> float:
     tf_idf_score = 0
     for token in tokens:
-        doc_tf = word_freq[token].get(doc_id, 0)
+        # terms missing from the index have no postings
+        doc_tf = word_freq.get(token, {}).get(doc_id, 0)
         if doc_tf == 0:
             continue
         tf = 1 + math.log10(doc_tf)
@@ -264,20 +287,20 @@ def is_valid_query(query: str) -> bool:
         elif token == ")":
             parentheses_count -= 1
             if parentheses_count < 0:
-                print("Parentheses count is less than 0")
+                logger.debug("Parentheses count is less than 0")
                 return False
         elif token == "NOT":
             if prev_token and (not is_operator(prev_token) and prev_token != "("):
-                print("Invalid NOT position")
+                logger.debug("Invalid NOT position")
                 return False
         elif is_operator(token):
             if prev_token and (prev_token == "(" or is_operator(prev_token)):
-                print("Invalid operator position")
+                logger.debug("Invalid operator position")
                 return False
         else:
             # token is an operand
             if prev_token and prev_token == ")":
-                print("Invalid operand position")
+                logger.debug("Invalid operand position")
                 return False
         prev_token = token
     if parentheses_count != 0:
@@ -296,21 +319,24 @@ async def evaluate_boolean_query(
     stopping: bool = True,
     stemming: bool = True,
     special_patterns: Dict[str, re.Pattern] = SPECIAL_PATTERN,
+    shard_id: Optional[int] = None,
 ) -> List:
     # query = " ".join([token.lower() if token not in ["AND", "OR", "NOT"] else token for token in query.split("\w+ ")])
-    query = re.sub(r"(\w+)", lambda x: preprocess_match(x, stopping, stemming), query)
+    with time_stage("preprocess"):
+        query = re.sub(r"(\w+)", lambda x: preprocess_match(x, stopping, stemming), query)
     # print(query)
-    if not is_valid_query(query):
-        print("Invalid query: ", query)
-        return []
+    with time_stage("parse"):
+        if not is_valid_query(query):
+            logger.debug("Invalid query: %s", query)
+            return []
 
-    postfix = infix_to_postfix(query, special_patterns["spliter"])
+        postfix = infix_to_postfix(query, special_patterns["spliter"])
     # print("postfix", postfix)
 
     # evalute the value for the stuff first
     results = []
     tasks = [
-        evaluate_subquery(token, special_patterns)
+        evaluate_subquery(token, special_patterns, shard_id)
         for token in postfix
         if not is_operator(token)
     ]
@@ -319,21 +345,22 @@ async def evaluate_boolean_query(
         if not is_operator(token):
             postfix[idx] = results.pop(0)
     try:
-        stack = []
-        for token in postfix:
-            if is_operator(token):
-                if token == "NOT":
-                    right = stack.pop()
-                    result = handle_not_operator(right, doc_ids_list)
+        with time_stage("evaluate"):
+            stack = []
+            for token in postfix:
+                if is_operator(token):
+                    if token == "NOT":
+                        right = stack.pop()
+                        result = handle_not_operator(right, doc_ids_list)
+                    else:
+                        right = stack.pop()
+                        left = stack.pop()
+                        result = handle_binary_operator(token, left, right)
+                    stack.append(result)
                 else:
-                    right = stack.pop()
-                    left = stack.pop()
-                    result = handle_binary_operator(token, left, right)
-                stack.append(result)
-            else:
-                # token is an operand
-                stack.append(token)
-        return stack.pop()
+                    # token is an operand
+                    stack.append(token)
+            return stack.pop()
 
     except:
         # print the processing error term
@@ -346,26 +373,56 @@ async def evaluate_ranked_query(
     docs_size: int,
     stopping: bool = True,
     stemming: bool = True,
+    shard_id: Optional[int] = None,
+    doc_freq: Optional[Dict[str, int]] = None,
+    top_k: Optional[int] = None,
 ) -> List[Tuple[int, float]]:
+    """
+    Rank the documents for the query by tf-idf.
+
+    When searching a single shard, `docs_size` and `doc_freq` should be the
+    collection-wide statistics so that the scores of different shards are comparable.
+    With `top_k`, only the best `top_k` (doc_id, score) pairs are returned.
+    """
     words = get_preprocessed_words(query, stopping, stemming)
-    doc_ids = set()
-    doc_freq = dict()
-    tfs = await get_tfs(words)
+    tfs = await get_tfs(words, shard_id)
     
     if not tfs:
         return []
-    
+
+    # scoring is pure Python, run it in the process pool to keep the event loop free and use
+    # every core. Pickling tfs to the worker costs about a third to a quarter of the scoring
+    # (17 ms against 109 ms for 3 terms of 20k postings), EXECUTOR_SCORING_MODE=thread avoids it
+    scoring_executor = get_endpoint_executor("scoring", default_mode="process")
+    return await scoring_executor.run(rank_documents, words, docs_size, tfs, doc_freq, top_k)
+
+
+def rank_documents(
+    words: List[str],
+    docs_size: int,
+    tfs: Dict[str, Dict[str, int]],
+    doc_freq: Optional[Dict[str, int]] = None,
+    top_k: Optional[int] = None,
+) -> List[Tuple[int, float]]:
+    """Score and sort the documents of the fetched term frequencies, free of any IO"""
+    doc_ids = set()
+    shard_doc_freq = dict()
     for word, tf in tfs.items():
         doc_ids = doc_ids.union(tf.keys())
-        doc_freq[word] = len(tf)
-    
-    scores = []
-    score_results = []
-    for doc_id in doc_ids:
-        score_results.append(calculate_tf_idf(words, doc_id, docs_size, tfs, doc_freq))
+        shard_doc_freq[word] = len(tf)
+    if doc_freq is None:
+        doc_freq = shard_doc_freq
+    else:
+        doc_freq = {word: doc_freq.get(word, df) for word, df in shard_doc_freq.items()}
     
-    for idx, doc_id in enumerate(doc_ids):
-        scores.append((doc_id, score_results[idx]))
+    with time_stage("score"):
+        scores = []
+        score_results = []
+        for doc_id in doc_ids:
+            score_results.append(calculate_tf_idf(words, doc_id, docs_size, tfs, doc_freq))
+        
+        for idx, doc_id in enumerate(doc_ids):
+            scores.append((doc_id, score_results[idx]))
     
     # sort by the score and the doc_id
     # scores.sort(key=lambda x: (-x[1], x[0]))
@@ -373,14 +430,50 @@ async def evaluate_ranked_query(
 
     # sort the scores in chunks using the process pool executor
     # check if the length of the scores is greater than 1000
-    # if len(scores) > 1000:
-    #     scores = heapq.nlargest(1000, scores, key=lambda x: x[1])
-    # else:
-    scores = sorted(scores, key=lambda x: (-x[1]))
-    
+    with time_stage("sort"):
+        if top_k is not None:
+            scores = heapq.nlargest(top_k, scores, key=lambda x: x[1])
+        else:
+            scores = sorted(scores, key=lambda x: (-x[1]))
+
     return scores
 
 
+async def sharded_boolean_search(query: str) -> List[int]:
+    """Evaluate the boolean query on every shard concurrently and merge the doc_ids in order"""
+    shard_ids = await get_shard_ids()
+    doc_ids_lists = await asyncio.gather(
+        *[get_doc_ids_list(shard_id) for shard_id in shard_ids]
+    )
+    shard_results = await asyncio.gather(
+        *[
+            evaluate_boolean_query(query, doc_ids_list, shard_id=shard_id)
+            for shard_id, doc_ids_list in zip(shard_ids, doc_ids_lists)
+        ]
+    )
+    return list(heapq.merge(*[sorted(result) for result in shard_results]))
+
+
+async def sharded_ranked_search(query: str, top_k: Optional[int] = None) -> List[Tuple[int, float]]:
+    """Score the query on every shard concurrently and merge the per-shard top_k with a heap"""
+    shard_ids = await get_shard_ids()
+    words = get_preprocessed_words(query)
+    if not shard_ids or not words:
+        return []
+    docs_size = await get_tfidf_doc_size()
+    doc_freq = await get_dfs(words)
+    shard_results = await asyncio.gather(
+        *[
+            evaluate_ranked_query(
+                query, docs_size, shard_id=shard_id, doc_freq=doc_freq, top_k=top_k
+            )
+            for shard_id in shard_ids
+        ]
+    )
+    merged = heapq.merge(*shard_results, key=lambda x: -x[1])
+    return list(islice(merged, top_k))
+
+
 async def boolean_test(
     boolean_queries: List[str] = ["\"Comic Relief\" AND (NOT wtf OR #1(Comic, Relief))"],
 ) -> List[List[int]]:
@@ -393,11 +486,12 @@ async def boolean_test(
 
 async def ranked_test(
     ranked_queries: List[str] = ["Comic Relief"],
+    top_k: Optional[int] = None,
 ) -> List[List[Tuple[int, float]]]:
     doc_size = await get_tfidf_doc_size()
     results = []
     for query in ranked_queries:
-        results.append(await evaluate_ranked_query(query, doc_size))
+        results.append(await evaluate_ranked_query(query, doc_size, top_k=top_k))
     return results
 
 
@@ -2,12 +2,17 @@ import pandas as pd
 import numpy as np
 import os
 from tqdm import tqdm
-from typing import List, Tuple
-from gensim.models import Word2Vec
+from typing import Dict, List, Tuple
 import pickle
 from common import get_preprocessed_words
 import os, sys
 from constant import QUERY_EXPANSION_MODEL_PATH
+from sharded_cache import create_cache
+from word_vector_index import WordVectorIndex, get_index_path
+from word_vectors import WordVectors, has_exported_vectors, is_up_to_date
+
+NEIGHBOUR_CACHE_SIZE = 4096
+STEM_CACHE_SIZE = 16384
 
 class QueryExpander:
     """
@@ -18,15 +23,16 @@ class QueryExpander:
     def __init__(
         self, model_path: str = "word2vec_200_10.model"
     ) -> None:
-        self.model = Word2Vec.load(os.path.join(QUERY_EXPANSION_MODEL_PATH, model_path))
-        self.words = self.model.wv.index_to_key
-        self.vectors = self.model.wv.vectors
+        self._neighbour_cache = create_cache("query-expansion-neighbours", NEIGHBOUR_CACHE_SIZE)
+        self._stem_cache = create_cache("query-expansion-stems", STEM_CACHE_SIZE)
+        self.load_model(os.path.join(QUERY_EXPANSION_MODEL_PATH, model_path))
 
     def create_all_document_csv(
         self, data_path: str, outlet_folders: List[str], output_path: str
     ) -> None:
         """
         Create a single CSV file containing all the articles from the given outlet folders.
+        word2vec_training.py trains from the csv files directly, without this file.
         """
         articles = []
         for outlet_folder in outlet_folders:
@@ -41,13 +47,9 @@ class QueryExpander:
                 file_path = os.path.join(folder_path, file_name)
                 # Ensure the file is a CSV before attempting to read it
                 if file_path.endswith(".csv"):
-                    df = pd.read_csv(file_path)
-                    for index, row in df.iterrows():
-                        articles.append(
-                            {"doc_id": row["doc_id"], "content": row["content"]}
-                        )
+                    articles.append(pd.read_csv(file_path, usecols=["doc_id", "content"]))
 
-        output_df = pd.DataFrame(articles)
+        output_df = pd.concat(articles, ignore_index=True)
 
         # save_output_csv
         output_df.to_csv(
@@ -61,14 +63,14 @@ class QueryExpander:
         """
         Create a pickle file containing a list of preprocessed documents without stemming.
         """
-        df = pd.read_csv(data_csv_path)
+        df = pd.read_csv(data_csv_path, usecols=["content"])
 
         processed_documents_unstemmed = []
 
-        for index in tqdm(range(0, len(df["doc_id"]))):
+        for content in tqdm(df["content"]):
             try:
                 processed_documents_unstemmed.append(
-                    get_preprocessed_words(df.iloc[index]["content"], stemming=False)
+                    get_preprocessed_words(content, stemming=False)
                 )
             except:
                 pass
@@ -90,6 +92,9 @@ class QueryExpander:
         where the model will be saved.
         """
 
+        from gensim.models import Word2Vec
+        from word2vec_training import get_default_workers
+
         with open(data_pickle_path, "rb") as f:
             processed_documents_unstemmed = pickle.load(f)
 
@@ -98,7 +103,7 @@ class QueryExpander:
             vector_size=vector_size,
             window=window_size,
             min_count=1,
-            workers=min(1, os.cpu_count() - 2),
+            workers=get_default_workers(),
         )
 
         model.save(
@@ -112,37 +117,86 @@ class QueryExpander:
 
     def load_model(self, model_path: str) -> None:
         """
-        Load a word2vec model from the given path.
+        Load the word vectors of a word2vec model from the given path, memory-mapped from the
+        files exported by word_vectors.py when there are some, otherwise from the full model.
+        """
+        if has_exported_vectors(model_path):
+            self.word_vectors = WordVectors.load(model_path)
+        else:
+            from gensim.models import Word2Vec
+
+            self.word_vectors = WordVectors.from_keyed_vectors(Word2Vec.load(model_path).wv)
+        self.words = self.word_vectors.index_to_key
+        self.key_to_index = self.word_vectors.key_to_index
+        # built offline by word_vector_index.py, every vector is compared without it or when
+        # the model was trained again after it was built
+        index_path = get_index_path(model_path)
+        self.index = WordVectorIndex.load(index_path) if is_up_to_date(index_path, model_path) else None
+        self._neighbour_cache.clear()
+
+    def _get_stems(self, word: str) -> List[str]:
+        stems = self._stem_cache.get(word)
+        if stems is None:
+            stems = get_preprocessed_words(word, stopping=True, stemming=True)
+            self._stem_cache.set(word, stems)
+        return stems
+
+    def most_similar_terms(
+        self, terms: List[str], top_n: int = 3
+    ) -> Dict[str, List[Tuple[str, float]]]:
+        """
+        The most similar words of the terms in the vocabulary, like wv.most_similar: from the
+        exact neighbours of the frequent words kept in the index, and from one approximate
+        search of the index for all the other terms.
         """
-        self.model = Word2Vec.load(model_path)
-        self.words = self.model.wv.index_to_key
-        self.vectors = self.model.wv.vectors
+        similar_words = {}
+        missing_terms = []
+        for term in dict.fromkeys(terms):
+            index = self.key_to_index.get(term)
+            if index is None:
+                continue
+            cached = self._neighbour_cache.get((term, top_n))
+            if cached is None and self.index is not None:
+                neighbours = self.index.get_cached_neighbours(index, top_n)
+                if neighbours is not None:
+                    cached = [(self.words[i], similarity) for i, similarity in neighbours]
+            if cached is None:
+                missing_terms.append(term)
+            else:
+                similar_words[term] = cached
+
+        if not missing_terms:
+            return similar_words
+        indices = [self.key_to_index[term] for term in missing_terms]
+        if self.index is None:
+            all_neighbours = self.word_vectors.most_similar(indices, top_n)
+        else:
+            all_neighbours = self.index.search(
+                self.word_vectors.get_vectors(indices), self.word_vectors, top_n, exclude=indices
+            )
+        for term, neighbours in zip(missing_terms, all_neighbours):
+            similar_words[term] = [(self.words[i], similarity) for i, similarity in neighbours]
+            self._neighbour_cache.set((term, top_n), similar_words[term])
+        return similar_words
 
     def expand_query(self, query: str, top_n: int = 3) -> Tuple[str, List[str]]:
         query_terms = get_preprocessed_words(query, stopping=True, stemming=False)
         expanded_query_terms = []
         preprocessed_terms_set = set()  # To store preprocessed versions for comparison
+        # the terms that are not in the vocabulary have no similar words
+        similar_words_of_terms = self.most_similar_terms(query_terms, top_n)
 
         for term in query_terms:
-            preprocessed_term = get_preprocessed_words(
-                term, stopping=True, stemming=True
-            )
+            preprocessed_term = self._get_stems(term)
             if not preprocessed_terms_set.intersection(set(preprocessed_term)):
                 expanded_query_terms.append(term)
                 preprocessed_terms_set.update(preprocessed_term)
 
-            try:
-                similar_words = self.model.wv.most_similar(term, topn=top_n)
-                for word, similarity in similar_words:
-                    preprocessed_word = get_preprocessed_words(
-                        word, stopping=True, stemming=True
-                    )
-                    if not preprocessed_terms_set.intersection(set(preprocessed_word)):
-                        expanded_query_terms.append(word)
-                        preprocessed_terms_set.update(preprocessed_word)
-            except KeyError:
-                # Skip if the word is not in the vocabulary
-                pass
+            for word, similarity in similar_words_of_terms.get(term, []):
+                preprocessed_word = self._get_stems(word)
+                if not preprocessed_terms_set.intersection(set(preprocessed_word)):
+                    expanded_query_terms.append(word)
+                    preprocessed_terms_set.update(preprocessed_word)
 
         added_terms = [term for term in expanded_query_terms if term not in query_terms]
 
@@ -0,0 +1,145 @@
+import os
+import re
+import sys
+import time
+import asyncio
+import threading
+from collections import Counter
+from typing import Callable, Dict, List
+
+sys.path.append(os.path.dirname(__file__))
+
+from dotenv import load_dotenv
+from constant import PROJECT_PATH
+from common import get_logger, get_stop_words
+from redis_utils import get_query_popularity, push_query_popularity
+
+logger = get_logger(__name__)
+
+# the weight of a search doubles every half life instead of the older ones decaying,
+# so the stored scores only have to be rewritten when the weight gets too large (forward
+# decay). 2 ** 1023 is the largest float, so every REBASE_HALF_LIVES the stored scores are
+# scaled down and the epoch moved forward, see push_query_popularity.
+POPULARITY_EPOCH = 1704067200  # 2024-01-01, until the first rebase
+REBASE_HALF_LIVES = 64
+POPULARITY_HALF_LIFE_DAYS = 7
+POPULARITY_CAPACITY = 10000
+FLUSH_SECONDS = 10
+FLUSH_SIZE = 1000
+POPULARITY_POLL_SECONDS = 60
+
+
+def _get_env_settings():
+    load_dotenv(dotenv_path=os.path.join(PROJECT_PATH, ".env"))
+    return (
+        float(os.getenv("QUERY_POPULARITY_HALF_LIFE_DAYS", POPULARITY_HALF_LIFE_DAYS)) * 86400,
+        int(os.getenv("QUERY_POPULARITY_CAPACITY", POPULARITY_CAPACITY)),
+    )
+
+
+def get_search_terms(query: str, stop_words) -> List[str]:
+    """The words of a query and their bigrams, in the form of the suggestion words"""
+    words = [
+        word for word in re.findall(r"\w+", query.lower())
+        if word not in stop_words and not word.isdigit()
+    ]
+    return words + [f"{first} {second}" for first, second in zip(words, words[1:])]
+
+
+class QueryPopularityRecorder:
+    """
+    Counts the searched words and bigrams of this process and adds them to the popularity
+    in redis in batches, every FLUSH_SECONDS or FLUSH_SIZE terms.
+    Redis only keeps the most popular terms, so the rarely searched ones are forgotten.
+    """
+
+    def __init__(self, flush_seconds: float = FLUSH_SECONDS, flush_size: int = FLUSH_SIZE):
+        self.flush_seconds = flush_seconds
+        self.flush_size = flush_size
+        self.half_life_seconds, self.capacity = _get_env_settings()
+        self._stop_words = set(get_stop_words())
+        self._counts = Counter()
+        self._last_flush_time = time.monotonic()
+        self._flushing = False
+        # the event loop only keeps weak references to its tasks
+        self._tasks = set()
+
+    def record(self, query: str):
+        """Count a search, from the event loop"""
+        self._counts.update(get_search_terms(query, self._stop_words))
+        if self._flushing:
+            return
+        if len(self._counts) >= self.flush_size or time.monotonic() - self._last_flush_time >= self.flush_seconds:
+            self._flushing = True
+            task = asyncio.create_task(self.flush())
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def flush(self):
+        counts, self._counts = self._counts, Counter()
+        self._last_flush_time = time.monotonic()
+        try:
+            if counts:
+                await push_query_popularity(
+                    counts,
+                    self.capacity,
+                    time.time(),
+                    self.half_life_seconds,
+                    POPULARITY_EPOCH,
+                    REBASE_HALF_LIVES,
+                )
+        except Exception:
+            # the searches are not slowed down or failed by the popularity
+            logger.exception("Failed to push the query popularity")
+        finally:
+            self._flushing = False
+
+
+def get_popularity_scores(top_k: int = POPULARITY_CAPACITY) -> Dict[str, float]:
+    """The most popular searched terms with their counts decayed to now"""
+    half_life_seconds, _ = _get_env_settings()
+    epoch, entries = get_query_popularity(top_k)
+    # the inverse weight, it goes to 0 instead of overflowing when there were no searches for long
+    scale = 2 ** -((time.time() - (epoch or POPULARITY_EPOCH)) / half_life_seconds)
+    return {term: score * scale for term, score in entries}
+
+
+class QueryPopularityFollower:
+    """Gives the popularity scores in redis to a resource with an apply_popularity method"""
+
+    def __init__(self, resource, poll_seconds: float = POPULARITY_POLL_SECONDS):
+        self.resource = resource
+        self.poll_seconds = poll_seconds
+        self._stopped = threading.Event()
+
+    def poll(self):
+        self.resource.apply_popularity(get_popularity_scores())
+
+    def _run(self):
+        while True:
+            try:
+                self.poll()
+            except Exception:
+                # redis may be down, the resource keeps the scores it has
+                logger.exception("Failed to apply the query popularity")
+            if self._stopped.wait(self.poll_seconds):
+                return
+
+    def start(self):
+        threading.Thread(target=self._run, name="query-popularity", daemon=True).start()
+
+    def stop(self):
+        self._stopped.set()
+
+
+def load_following_query_popularity(factory: Callable):
+    """
+    Load a resource and keep giving it the popularity scores, usable as a picklable factory.
+    QUERY_POPULARITY_POLL_SECONDS sets how often redis is checked, 0 disables it.
+    """
+    load_dotenv(dotenv_path=os.path.join(PROJECT_PATH, ".env"))
+    poll_seconds = float(os.getenv("QUERY_POPULARITY_POLL_SECONDS", POPULARITY_POLL_SECONDS))
+    resource = factory()
+    if poll_seconds > 0:
+        QueryPopularityFollower(resource, poll_seconds).start()
+    return resource
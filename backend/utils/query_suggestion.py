@@ -7,19 +7,26 @@ import string
 from collections import defaultdict, deque
 from itertools import islice
 from enum import Enum
-from threading import Lock
+from threading import Lock, RLock
 from symspellpy import SymSpell
 import re
+import heapq
+from array import array
+from bisect import bisect_left
 from collections import Counter
+from collections.abc import Mapping
 import orjson
-from typing import List
+from typing import List, Optional, Tuple
 
 from constant import (
     STOP_WORDS_FILE_PATH,
     MONOGRAM_PKL_PATH,
     MONOGRAM_AND_BIGRAM_DICTIONARY_PATH,
     FULL_TXT_CORPUS_PATH,
+    COMPACT_DAWG_PATH,
+    DICTIONARY_MIN_FREQUENCY,
 )
+from sharded_cache import create_cache
 
 try:
     import termios
@@ -34,195 +41,7 @@ with open(STOP_WORDS_FILE_PATH, "r") as file:
     FULL_STOP_WORDS = file.read().split("\n")
 
 
-class CacheNode:
-    """
-    LFU cache Written by Shane Wang, modified by Sep Dehpour
-    """
-
-    def __init__(self, key, value, freq_node, pre, nxt):
-        self.key = key
-        self.value = value
-        self.freq_node = freq_node
-        self.pre = pre  # previous CacheNode
-        self.nxt = nxt  # next CacheNode
-
-    def free_myself(self):
-        if self.freq_node.cache_head == self.freq_node.cache_tail:
-            self.freq_node.cache_head = self.freq_node.cache_tail = None
-        elif self.freq_node.cache_head == self:
-            self.nxt.pre = None
-            self.freq_node.cache_head = self.nxt
-        elif self.freq_node.cache_tail == self:
-            self.pre.nxt = None
-            self.freq_node.cache_tail = self.pre
-        else:
-            self.pre.nxt = self.nxt
-            self.nxt.pre = self.pre
-
-        self.pre = None
-        self.nxt = None
-        self.freq_node = None
-
-
-class FreqNode:
-    def __init__(self, freq, pre, nxt):
-        self.freq = freq
-        self.pre = pre  # previous FreqNode
-        self.nxt = nxt  # next FreqNode
-        self.cache_head = None  # CacheNode head under this FreqNode
-        self.cache_tail = None  # CacheNode tail under this FreqNode
-
-    def count_caches(self):
-        if self.cache_head is None and self.cache_tail is None:
-            return 0
-        elif self.cache_head == self.cache_tail:
-            return 1
-        else:
-            return "2+"
-
-    def remove(self):
-        if self.pre is not None:
-            self.pre.nxt = self.nxt
-        if self.nxt is not None:
-            self.nxt.pre = self.pre
-
-        pre = self.pre
-        nxt = self.nxt
-        self.pre = self.nxt = self.cache_head = self.cache_tail = None
-
-        return (pre, nxt)
-
-    def pop_head_cache(self):
-        if self.cache_head is None and self.cache_tail is None:
-            return None
-        elif self.cache_head == self.cache_tail:
-            cache_head = self.cache_head
-            self.cache_head = self.cache_tail = None
-            return cache_head
-        else:
-            cache_head = self.cache_head
-            self.cache_head.nxt.pre = None
-            self.cache_head = self.cache_head.nxt
-            return cache_head
-
-    def append_cache_to_tail(self, cache_node):
-        cache_node.freq_node = self
-
-        if self.cache_head is None and self.cache_tail is None:
-            self.cache_head = self.cache_tail = cache_node
-        else:
-            cache_node.pre = self.cache_tail
-            cache_node.nxt = None
-            self.cache_tail.nxt = cache_node
-            self.cache_tail = cache_node
-
-    def insert_after_me(self, freq_node):
-        freq_node.pre = self
-        freq_node.nxt = self.nxt
-
-        if self.nxt is not None:
-            self.nxt.pre = freq_node
-
-        self.nxt = freq_node
-
-    def insert_before_me(self, freq_node):
-        if self.pre is not None:
-            self.pre.nxt = freq_node
-
-        freq_node.pre = self.pre
-        freq_node.nxt = self
-        self.pre = freq_node
-
-
-class LFUCache:
-
-    def __init__(self, capacity):
-        self.cache = {}  # {key: cache_node}
-        self.capacity = capacity
-        self.freq_link_head = None
-        self.lock = Lock()
-
-    def get(self, key):
-        with self.lock:
-            if key in self.cache:
-                cache_node = self.cache[key]
-                freq_node = cache_node.freq_node
-                value = cache_node.value
-
-                self.move_forward(cache_node, freq_node)
-
-                return value
-            else:
-                return -1
-
-    def set(self, key, value):
-        with self.lock:
-            if self.capacity <= 0:
-                return -1
-
-            if key not in self.cache:
-                if len(self.cache) >= self.capacity:
-                    self.dump_cache()
-
-                self.create_cache_node(key, value)
-            else:
-                cache_node = self.cache[key]
-                freq_node = cache_node.freq_node
-                cache_node.value = value
-
-                self.move_forward(cache_node, freq_node)
-
-    def move_forward(self, cache_node, freq_node):
-        if freq_node.nxt is None or freq_node.nxt.freq != freq_node.freq + 1:
-            target_freq_node = FreqNode(freq_node.freq + 1, None, None)
-            target_empty = True
-        else:
-            target_freq_node = freq_node.nxt
-            target_empty = False
-
-        cache_node.free_myself()
-        target_freq_node.append_cache_to_tail(cache_node)
-
-        if target_empty:
-            freq_node.insert_after_me(target_freq_node)
-
-        if freq_node.count_caches() == 0:
-            if self.freq_link_head == freq_node:
-                self.freq_link_head = target_freq_node
-
-            freq_node.remove()
-
-    def dump_cache(self):
-        head_freq_node = self.freq_link_head
-        self.cache.pop(head_freq_node.cache_head.key)
-        head_freq_node.pop_head_cache()
-
-        if head_freq_node.count_caches() == 0:
-            self.freq_link_head = head_freq_node.nxt
-            head_freq_node.remove()
-
-    def create_cache_node(self, key, value):
-        cache_node = CacheNode(key, value, None, None, None)
-        self.cache[key] = cache_node
-
-        if self.freq_link_head is None or self.freq_link_head.freq != 0:
-            new_freq_node = FreqNode(0, None, None)
-            new_freq_node.append_cache_to_tail(cache_node)
-
-            if self.freq_link_head is not None:
-                self.freq_link_head.insert_before_me(new_freq_node)
-
-            self.freq_link_head = new_freq_node
-        else:
-            self.freq_link_head.append_cache_to_tail(cache_node)
-
-    def get_sorted_cache_keys(self):
-        result = [(i, freq.freq_node.freq) for i, freq in self.cache.items()]
-        result.sort(key=lambda x: -x[1])
-        return result
-
-
-_normalized_lfu_cache = LFUCache(NORMALIZED_CACHE_SIZE)
+_normalized_cache = create_cache("normalized-node-name", NORMALIZED_CACHE_SIZE)
 
 
 class FileNotFound(ValueError):
@@ -362,10 +181,10 @@ class Normalizer:
             return ""
         name = name[:MAX_WORD_LENGTH]
         key = name if extra_chars is None else f"{name}{extra_chars}"
-        result = _normalized_lfu_cache.get(key)
-        if result == -1:
+        result = _normalized_cache.get(key)
+        if result is None:
             result = self._get_normalized_node_name(name, extra_chars=extra_chars)
-            _normalized_lfu_cache.set(key, result)
+            _normalized_cache.set(key, result)
         return result
 
     def _remove_invalid_chars(self, x):
@@ -410,14 +229,6 @@ class Normalizer:
         return "".join(result).strip()
 
 
-try:
-    from Levenshtein import distance as levenshtein_distance
-except ImportError:
-    try:
-        from pylev import levenshtein as levenshtein_distance
-    except ImportError:
-        raise RuntimeError()
-
 DELIMITER = "__"
 ORIGINAL_KEY = "original_key"
 INF = float("inf")
@@ -427,115 +238,107 @@ class NodeNotFound(ValueError):
     pass
 
 
-class FindStep(Enum):
-    start = 0
-    descendants_only = 1
-    fuzzy_try = 2
-    fuzzy_found = 3
-    rest_of_fuzzy_round2 = 4
-    not_enough_results_add_some_descandants = 5
-
-
-class _DawgNode:
+class FuzzyWordIndex:
     """
-    The Dawg data structure keeps a set of words, organized with one node for
-    each letter. Each node has a branch for each letter that may follow it in the
-    set of words.
+    Levenshtein search over the words dictionary without scanning it.
+    The sorted keys are used as an implicit trie: the keys sharing a prefix are a range
+    found by binary search, and the edits of the searched word are only tried against
+    the letters that follow the prefix in some key.
     """
 
-    __slots__ = ("word", "original_key", "children", "count")
-
-    def __init__(self):
-        self.word = None
-        self.original_key = None
-        self.children = {}
-        self.count = 0
-
-    def __getitem__(self, key):
-        return self.children[key]
+    def __init__(self, words):
+        self.words = words
+        if hasattr(words, "sorted_keys"):
+            # the compact words already store their keys sorted
+            self.sorted_keys, self.ranks = words.sorted_keys()
+        else:
+            keys = list(words)
+            order = sorted(range(len(keys)), key=keys.__getitem__)
+            self.sorted_keys = [keys[i] for i in order]
+            self.ranks = array("I", order)
+
+    def find(self, word: str, max_distance: int) -> List[Tuple[int, str, int]]:
+        """(position in the words dictionary, key, distance) of the keys within `max_distance`, in dictionary order"""
+        distances = {}
+        if max_distance >= 0 and self.sorted_keys:
+            self._search(0, len(self.sorted_keys), "", word, 0, max_distance, distances)
+        return sorted(
+            (self.ranks[index], self.sorted_keys[index], distance)
+            for index, distance in distances.items()
+        )
 
-    def __repr__(self):
-        return f"<DawgNode children={list(self.children.keys())}, {self.word}>"
+    def _search(self, low, high, prefix, rest, distance, budget, distances):
+        """Keys in [low, high) start with `prefix`, the rest of their letters are matched against `rest`"""
+        sorted_keys = self.sorted_keys
+        # the rest of the word unchanged
+        target = prefix + rest
+        index = bisect_left(sorted_keys, target, low, high)
+        if index < high and sorted_keys[index] == target:
+            if distance < distances.get(index, INF):
+                distances[index] = distance
+        if budget == 0:
+            return
+        # delete the next letter of the word
+        if rest:
+            self._search(low, high, prefix, rest[1:], distance + 1, budget - 1, distances)
+        depth = len(prefix)
+        if sorted_keys[low] == prefix:
+            low += 1
+        while low < high:
+            letter = sorted_keys[low][depth]
+            child = prefix + letter
+            end = bisect_left(sorted_keys, prefix + chr(ord(letter) + 1), low, high)
+            if rest and rest[0] == letter:
+                self._search(low, end, child, rest[1:], distance, budget, distances)
+            elif rest:
+                # substitute the next letter of the word
+                self._search(low, end, child, rest[1:], distance + 1, budget - 1, distances)
+            # insert the letter
+            self._search(low, end, child, rest, distance + 1, budget - 1, distances)
+            low = end
+
+
+class WordsOverlay(Mapping):
+    """
+    The words with the changes of the merged dictionary deltas on top of them, so the words
+    (memory-mapped from a compact dawg) are not copied for every delta, only the changes are.
+    The new words come after the others, in the order they were added.
+    """
 
-    @property
-    def value(self):
-        return self.original_key or self.word
+    def __init__(self, words):
+        if isinstance(words, WordsOverlay):
+            self.base, self.changes, self.new_words = words.base, dict(words.changes), list(words.new_words)
+        else:
+            self.base, self.changes, self.new_words = words, {}, []
 
-    def insert(
-        self,
-        word,
-        normalized_word,
-        add_word=True,
-        original_key=None,
-        count=0,
-        insert_count=True,
-    ):
-        node = self
-        for letter in normalized_word:
-            if letter not in node.children:
-                node.children[letter] = _DawgNode()
+    def __getitem__(self, word):
+        if word in self.changes:
+            return self.changes[word]
+        return self.base[word]
 
-            node = node.children[letter]
+    def __setitem__(self, word, value):
+        if word not in self:
+            self.new_words.append(word)
+        self.changes[word] = value
 
-        if add_word:
-            node.word = word
-            node.original_key = original_key
-            if insert_count:
-                node.count = int(count)  # converts any str to int
-        return node
+    def __contains__(self, word):
+        return word in self.changes or word in self.base
 
-    def get_descendants_nodes(
-        self, size, should_traverse=True, full_stop_words=None, insert_count=True
-    ):
-        if insert_count is True:
-            size = INF
+    def __iter__(self):
+        yield from self.base
+        yield from self.new_words
 
-        que = deque()
-        unique_nodes = {self}
-        found_nodes_set = set()
-        full_stop_words = full_stop_words if full_stop_words else set()
+    def __len__(self):
+        return len(self.base) + len(self.new_words)
 
-        for letter, child_node in self.children.items():
-            if child_node not in unique_nodes:
-                unique_nodes.add(child_node)
-                que.append((letter, child_node))
 
-        while que:
-            letter, child_node = que.popleft()
-            child_value = child_node.value
-            if child_value:
-                if child_value in full_stop_words:
-                    should_traverse = False
-                if child_value not in found_nodes_set:
-                    found_nodes_set.add(child_value)
-                    yield child_node
-                    if len(found_nodes_set) > size:
-                        break
-
-            if should_traverse:
-                for letter, grand_child_node in child_node.children.items():
-                    if grand_child_node not in unique_nodes:
-                        unique_nodes.add(grand_child_node)
-                        que.append((letter, grand_child_node))
-
-    def get_descendants_words(
-        self, size, should_traverse=True, full_stop_words=None, insert_count=True
-    ):
-        found_nodes_gen = self.get_descendants_nodes(
-            size,
-            should_traverse=should_traverse,
-            full_stop_words=full_stop_words,
-            insert_count=insert_count,
-        )
-
-        if insert_count is True:
-            found_nodes = sorted(
-                found_nodes_gen, key=lambda node: node.count, reverse=True
-            )[: size + 1]
-        else:
-            found_nodes = islice(found_nodes_gen, size)
-
-        return map(lambda word: word.value, found_nodes)
+class FindStep(Enum):
+    start = 0
+    descendants_only = 1
+    fuzzy_try = 2
+    fuzzy_found = 3
+    rest_of_fuzzy_round2 = 4
+    not_enough_results_add_some_descandants = 5
 
 
 def generate_bigrams(text):
@@ -556,10 +359,88 @@ def calculate_bigram_frequencies(file_path):
     return bigram_counter
 
 
+def select_suggestion_monograms(symspell_words, full_stop_words):
+    """Monograms worth suggesting from the SymSpell word counts"""
+    return {
+        key: {"count": int(value / 10)}
+        for key, value in symspell_words.items()
+        if len(key) > 3 and value > 7 and key not in full_stop_words
+    }
+
+
+def _has_quote(word):
+    return "'" in word or "’" in word or '"' in word
+
+
+def build_monogram_and_bigram_dictionary(monograms, bigram_frequencies, full_stop_words):
+    """
+    The words dictionary of the suggestions: the monograms without quotes, and the bigrams seen
+    more than once made of two such monograms, none of them full stop words
+    """
+    monogram_and_bigram_dictionary = {}
+    for monogram, info in monograms.items():
+        if not _has_quote(monogram) and monogram not in full_stop_words:
+            monogram_and_bigram_dictionary[monogram] = {"count": info["count"]}
+
+    for bigram, freq in bigram_frequencies.items():
+        if (
+            freq > 1
+            and bigram[0] not in full_stop_words
+            and bigram[1] not in full_stop_words
+            and bigram[0] in monograms.keys()
+            and bigram[1] in monograms.keys()
+            and not _has_quote(bigram[0])
+            and not _has_quote(bigram[1])
+        ):
+            bigram_text = " ".join(
+                bigram
+            )  # Join the bigram tuple into a single string
+            monogram_and_bigram_dictionary[bigram_text] = {"count": freq}
+    return monogram_and_bigram_dictionary
+
+
+def is_compact_dawg_up_to_date(compact_dawg_path: str, *source_paths: str) -> bool:
+    """Whether the compact dawg exists, is in the current format and was built after its source files changed"""
+    if not compact_dawg_path or not os.path.exists(compact_dawg_path):
+        return False
+    from compact_dawg import is_current_version
+
+    if not is_current_version(compact_dawg_path):
+        return False
+    built_time = os.path.getmtime(compact_dawg_path)
+    return all(
+        os.path.getmtime(path) <= built_time for path in source_paths if os.path.exists(path)
+    )
+
+
+def load_query_suggestion(
+    monogram_pkl_path: str = MONOGRAM_PKL_PATH,
+    words_path: str = MONOGRAM_AND_BIGRAM_DICTIONARY_PATH,
+    compact_dawg_path: Optional[str] = COMPACT_DAWG_PATH,
+) -> "QuerySuggestion":
+    """
+    Build the suggester with the monogram and bigram dictionary, usable as a picklable factory.
+    The prebuilt compact dawg (see compact_dawg.py) is memory-mapped instead when it is up to date.
+    """
+    if is_compact_dawg_up_to_date(compact_dawg_path, monogram_pkl_path, words_path):
+        query_suggestion = QuerySuggestion(compact_dawg_path=compact_dawg_path)
+    else:
+        query_suggestion = QuerySuggestion(monogram_pkl_path=monogram_pkl_path)
+        query_suggestion.load_words(words_path=words_path)
+    # built while loading rather than by the first fuzzy query
+    query_suggestion.get_fuzzy_index()
+    return query_suggestion
+
+
 class QuerySuggestion:
 
     CACHE_SIZE = 2048
+    CACHE_TTL = None
     SHOULD_INCLUDE_COUNT = True
+    # added to the count of a word for each of its recent searches, see query_popularity.py
+    POPULARITY_WEIGHT = 10
+    # relative change of the popularity of a term before its raise is applied again
+    POPULARITY_MIN_CHANGE = 0.25
 
     def __init__(
         self,
@@ -570,6 +451,7 @@ class QuerySuggestion:
         valid_chars_for_string=None,
         valid_chars_for_integer=None,
         valid_chars_for_node_name=None,
+        compact_dawg_path: Optional[str] = None,
     ):
         """
         Initializes the Autocomplete module
@@ -577,11 +459,20 @@ class QuerySuggestion:
         # :param words: A dictionary of words mapped to their context
         :param synonyms: (optional) A dictionary of words to their synonyms.
                          The synonym words should only be here and not repeated in words parameter.
+        :param compact_dawg_path: (optional) A prebuilt compact dawg file. The dawg and the words
+                         are memory-mapped from it instead of being built from the monogram pickle.
         """
         self._lock = Lock()
+        # held by the searches and by the merges of the dictionary deltas from another thread
+        self._update_lock = RLock()
         self._dwg = None
+        self._fuzzy_index = None
+        self._has_stop_word_nodes = False
+        self._popularity = {}
+        self._popularity_targets = {}
+        self._popularity_offsets = {}
         self._raw_synonyms = synonyms or {}
-        self._lfu_cache = LFUCache(self.CACHE_SIZE)
+        self._completion_cache = create_cache("query-suggestion", self.CACHE_SIZE, self.CACHE_TTL)
         self._clean_synonyms, self._partial_synonyms = (
             self._get_clean_and_partial_synonyms()
         )
@@ -589,69 +480,43 @@ class QuerySuggestion:
         self._full_stop_words = set(full_stop_words) if full_stop_words else None
         self.logger = logger
 
-        spell_checker = SymSpell()
-        spell_checker.load_pickle(monogram_pkl_path)
-        symspell_words = spell_checker.words
-        self.words = {
-            key: {"count": int(value / 10)}
-            for key, value in symspell_words.items()
-            if len(key) > 3 and value > 7 and key not in self._full_stop_words
-        }
-
         self.normalizer = Normalizer(
             valid_chars_for_string=valid_chars_for_string,
             valid_chars_for_integer=valid_chars_for_integer,
             valid_chars_for_node_name=valid_chars_for_node_name,
         )
+
+        if compact_dawg_path:
+            from compact_dawg import CompactDawg
+
+            # the partial synonyms were added to the words when the file was built
+            compact_dawg = CompactDawg(compact_dawg_path)
+            self._dwg = compact_dawg.root
+            self.words = compact_dawg.words
+            self._has_stop_word_nodes = self._find_stop_word_nodes()
+            return
+
+        spell_checker = SymSpell()
+        spell_checker.load_pickle(monogram_pkl_path)
+        self.words = select_suggestion_monograms(spell_checker.words, self._full_stop_words)
+
         new_words = self._get_partial_synonyms_to_words()
         self.words.update(new_words)
         self._populate_dwg()
+        self._has_stop_word_nodes = self._find_stop_word_nodes()
 
     def create_monogram_and_bigram_dictionary(
         self,
         full_corpus_txt_path: str = FULL_TXT_CORPUS_PATH,
         output_path: str = MONOGRAM_AND_BIGRAM_DICTIONARY_PATH,
     ):
-        monograms = self.words
-
         print("Creating bigrams...")
         bigram_frequencies = calculate_bigram_frequencies(full_corpus_txt_path)
 
-        # monogram_and_bigram_dictionary = {
-        #     monogram: {"count": info["count"]}
-        #     for monogram, info in monograms.items()
-        #     if "'" not in monogram and monogram not in self._full_stop_words
-        # }
-
-        monogram_and_bigram_dictionary = {}
-        for monogram, info in monograms.items():
-            if (
-                "'" not in monogram
-                and "’" not in monogram
-                and '"' not in monogram
-                and monogram not in self._full_stop_words
-            ):
-                monogram_and_bigram_dictionary[monogram] = {"count": info["count"]}
-
         print("Creating monogram and bigram dictionary...")
-        for bigram, freq in bigram_frequencies.items():
-            if (
-                freq > 1
-                and bigram[0] not in self._full_stop_words
-                and bigram[1] not in self._full_stop_words
-                and bigram[0] in monograms.keys()
-                and bigram[1] in monograms.keys()
-                and "'" not in bigram[0]
-                and "'" not in bigram[1]
-                and "’" not in bigram[0]
-                and "’" not in bigram[1]
-                and '"' not in bigram[0]
-                and '"' not in bigram[1]
-            ):
-                bigram_text = " ".join(
-                    bigram
-                )  # Join the bigram tuple into a single string
-                monogram_and_bigram_dictionary[bigram_text] = {"count": freq}
+        monogram_and_bigram_dictionary = build_monogram_and_bigram_dictionary(
+            self.words, bigram_frequencies, self._full_stop_words
+        )
 
         with open(
             output_path,
@@ -667,6 +532,14 @@ class QuerySuggestion:
         with open(words_path, "r", encoding="utf-8") as file:
             self.words = orjson.loads(file.read())
 
+    def get_fuzzy_index(self) -> FuzzyWordIndex:
+        """Index of the current words for the fuzzy matching, rebuilt when the words are replaced"""
+        if self._fuzzy_index is None or self._fuzzy_index.words is not self.words:
+            with self._lock:
+                if self._fuzzy_index is None or self._fuzzy_index.words is not self.words:
+                    self._fuzzy_index = FuzzyWordIndex(self.words)
+        return self._fuzzy_index
+
     def _get_clean_and_partial_synonyms(self):
         """
         Synonyms are words that should produce the same results.
@@ -749,6 +622,25 @@ class QuerySuggestion:
                                     count=count,
                                 )
 
+    def _find_stop_word_nodes(self):
+        """Whether a full stop word is the value of a node, it stops the descendants traversals"""
+        for stop_word in self._full_stop_words or ():
+            node = self._dwg
+            for letter in self.normalizer.normalize_node_name(stop_word):
+                node = node.children.get(letter)
+                if node is None:
+                    break
+            else:
+                if node.value in self._full_stop_words:
+                    return True
+        return False
+
+    def _can_use_top_descendants(self):
+        """The best-first descendants give the same results without synonyms and stop word nodes"""
+        return not (
+            self._clean_synonyms or self._partial_synonyms or self._has_stop_word_nodes
+        )
+
     def insert_word_callback(self, word):
         """
         Once word is inserted, run this.
@@ -778,6 +670,10 @@ class QuerySuggestion:
         if not normalized_word:
             return
         last_char = normalized_word[-1]
+        if self._full_stop_words and (
+            word in self._full_stop_words or original_key in self._full_stop_words
+        ):
+            self._has_stop_word_nodes = True
 
         if leaf_node:
             temp_leaf_node = self._dwg.insert(
@@ -794,6 +690,7 @@ class QuerySuggestion:
             # otherwise merge into the leaf node
             else:
                 temp_leaf_node.children[last_char] = leaf_node
+                self._dwg.raise_max_count(normalized_word, leaf_node.max_count)
         else:
             leaf_node = self._dwg.insert(
                 word=word,
@@ -810,8 +707,16 @@ class QuerySuggestion:
         results, find_steps = self._find(word, max_cost, size)
         results_keys = list(results.keys())
         results_keys.sort()
+        popularity = self._popularity
         for key in results_keys:
-            for output_items in results[key]:
+            key_results = results[key]
+            if popularity:
+                # the most searched first among the results of the same distance
+                key_results = sorted(
+                    key_results,
+                    key=lambda output_items: -sum(popularity.get(item, 0) for item in output_items),
+                )
+            for output_items in key_results:
                 for i, item in enumerate(output_items):
                     reversed_item = self._reverse_synonyms.get(item)
                     if reversed_item:
@@ -852,13 +757,52 @@ class QuerySuggestion:
         if not word:
             return []
         key = f"{word}-{max_cost}-{size}"
-        result = self._lfu_cache.get(key)
-        if result == -1:
-            result = list(self._find_and_sort(word, max_cost, size))
-            self._lfu_cache.set(key, result)
+        result = self._completion_cache.get(key)
+        if result is None:
+            with self._update_lock:
+                result = self._find_from_shorter_prefix(word, max_cost, size)
+                if result is not None:
+                    self._completion_cache.record_prefix_hit(key)
+                else:
+                    result = list(self._find_and_sort(word, max_cost, size))
+                self._completion_cache.set(key, result)
         # return self.filter_single_word_results(result)
         return result
 
+    def _find_from_shorter_prefix(self, word, max_cost, size):
+        """
+        Completions of a word being typed, filtered from the cached completions of the same
+        word without its last letter. Only used when it gives the same results as searching:
+        both are the beginning of a single word, so their completions are the descendants with
+        the highest counts, and the shorter word had all of them cached or all still match.
+        """
+        if len(word) < 2 or " " in word or not self._can_use_top_descendants():
+            return None
+        shorter_word = word[:-1]
+        cached_result = self._completion_cache.peek(f"{shorter_word}-{max_cost}-{size}")
+        if cached_result is None:
+            return None
+        # reached letter by letter, and neither is a word itself
+        shorter_word_node = self._dwg
+        for letter in shorter_word:
+            shorter_word_node = shorter_word_node.children.get(letter)
+            if shorter_word_node is None:
+                return None
+        word_node = shorter_word_node.children.get(word[-1])
+        if word_node is None or shorter_word_node.word or word_node.word:
+            return None
+
+        result = []
+        for output_items in cached_result:
+            if len(output_items) != 1:
+                return None
+            path = self.normalizer.normalize_node_name(output_items[0])
+            if path.startswith(word) and path != word:
+                result.append(output_items)
+        if len(cached_result) < size or len(result) == len(cached_result):
+            return result
+        return None
+
     def filter_single_word_results(self, original_list):
         filtered_list = []
         appeared_strings = set()
@@ -934,17 +878,15 @@ class QuerySuggestion:
                 new_word = f"{new_word} {word_chunks.popleft()}"
             fuzzy_rest_of_word = " ".join(word_chunks)
 
-            for _word in self.words:
-                if abs(len(_word) - len(new_word)) > max_cost:
-                    continue
-                dist = levenshtein_distance(new_word, _word)
-                if dist < max_cost:
-                    fuzzy_matches_len += 1
-                    _value = self.words[_word].get(ORIGINAL_KEY, _word)
-                    fuzzy_matches[dist].append(_value)
-                    fuzzy_min_distance = min(fuzzy_min_distance, dist)
-                    if fuzzy_matches_len >= size or dist < 2:
-                        break
+            # the matches come in the order of the words, as a scan of the words would find them
+            fuzzy_index = self.get_fuzzy_index()
+            for _, _word, dist in fuzzy_index.find(new_word, max_distance=max_cost - 1):
+                fuzzy_matches_len += 1
+                _value = self.words[_word].get(ORIGINAL_KEY, _word)
+                fuzzy_matches[dist].append(_value)
+                fuzzy_min_distance = min(fuzzy_min_distance, dist)
+                if fuzzy_matches_len >= size or dist < 2:
+                    break
             if fuzzy_matches_len:
                 find_steps.append(FindStep.fuzzy_found)
                 if fuzzy_rest_of_word:
@@ -1164,11 +1106,14 @@ class QuerySuggestion:
     def _add_descendants_words_to_results(
         self, node, size, matched_words, results, distance, should_traverse=True
     ):
-        descendant_words = list(
-            node.get_descendants_words(
-                size, should_traverse, full_stop_words=self._full_stop_words
+        if should_traverse and self._can_use_top_descendants():
+            descendant_words = list(node.get_top_descendants_words(size))
+        else:
+            descendant_words = list(
+                node.get_descendants_words(
+                    size, should_traverse, full_stop_words=self._full_stop_words
+                )
             )
-        )
         extended = _extend_and_repeat(matched_words, descendant_words)
         if extended:
             results[distance].extend(extended)
@@ -1222,15 +1167,145 @@ class QuerySuggestion:
             if offset:
                 with self._lock:
                     node.count += offset
+                    self._raise_max_count(word, node)
             elif count:
                 with self._lock:
                     node.count = count
+                    self._raise_max_count(word, node)
         else:
             raise NodeNotFound(f"Unable to find a node for word {word}")
         return node.count
 
+    def update_counts_of_words(self, offsets):
+        """
+        Add the offsets to the counts of the words in one go, the words that are not in the
+        dwg are skipped. Returns the offsets that were applied.
+        """
+        applied = {}
+        with self._update_lock:
+            nodes = {word: self._get_word_node(word) for word, offset in offsets.items() if offset}
+            with self._lock:
+                for word, node in nodes.items():
+                    if node is not None:
+                        node.count += offsets[word]
+                        applied[word] = offsets[word]
+                        # the max counts stay an upper bound when a count goes down
+                        if offsets[word] > 0:
+                            self._raise_max_count(word, node)
+            if applied:
+                self._completion_cache.clear()
+        return applied
+
+    def apply_popularity(self, scores):
+        """
+        Blend the popularity of the searched words and bigrams (see query_popularity.py) into
+        the suggestions: their counts are raised by the popularity of the words, replacing the
+        previous raise, and the most searched come first among the results of the same distance.
+        """
+        with self._update_lock:
+            # the scores decay a little between two polls, every re-apply empties the completion
+            # cache so only the terms that moved by POPULARITY_MIN_CHANGE are applied again
+            targets = {term: int(self.POPULARITY_WEIGHT * score) for term, score in scores.items()}
+            applied = self._popularity_targets
+            changed = {}
+            for term in set(targets) | set(applied):
+                target, previous = targets.get(term, 0), applied.get(term, 0)
+                # the terms that appear or go away always change, a step of one is rounding
+                if (not target) != (not previous) or abs(target - previous) > max(
+                    self.POPULARITY_MIN_CHANGE * previous, 1
+                ):
+                    changed[term] = target
+            if not changed:
+                return
+            offsets = {
+                word: target - self._popularity_offsets.get(word, 0)
+                for word, target in changed.items()
+                if " " not in word
+            }
+            for word, offset in self.update_counts_of_words(offsets).items():
+                self._popularity_offsets[word] = self._popularity_offsets.get(word, 0) + offset
+                if not self._popularity_offsets[word]:
+                    del self._popularity_offsets[word]
+            applied = {**applied, **changed}
+            self._popularity_targets = {term: target for term, target in applied.items() if target}
+            # the results are ordered by the applied targets, like the counts they were raised by
+            self._popularity = self._popularity_targets
+            self._completion_cache.clear()
+
+    def _raise_max_count(self, word, node):
+        path_node = self._dwg.raise_max_count(
+            self.normalizer.normalize_node_name(word), node.count
+        )
+        # the node was not reached through the path of the word, recompute them all
+        if path_node != node:
+            self._dwg.update_max_counts()
+
     def get_count_of_word(self, word):
         return self.update_count_of_word(word)
+
+    def _get_word_node(self, word):
+        """The node of `word` in the dwg, None when it is not one of the words"""
+        node = self._dwg
+        for letter in self.normalizer.normalize_node_name(word):
+            node = node.children.get(letter)
+            if node is None:
+                return None
+        return node if node.word == word else None
+
+    def merge_dictionary_delta(self, delta, min_frequency: int = DICTIONARY_MIN_FREQUENCY):
+        """
+        Add the counts of a dictionary delta (see dictionary_updates.py) to the dwg and the words.
+        Every entry of the delta is [count, total] with the total count over the deltas.
+        New words are inserted once their total is above `min_frequency`, when the spell checker
+        takes them too, and new bigrams of known words once seen twice, like the words were built.
+        """
+        stop_words = self._full_stop_words or ()
+        with self._update_lock:
+            # the searches keep the words they started with, the changes go to a new overlay
+            words = WordsOverlay(self.words)
+            for word, (count, total) in delta["monograms"].items():
+                # the counts of the monograms are a tenth of their spell checking counts
+                offset = total // 10 - (total - count) // 10
+                node = self._get_word_node(word)
+                if node is not None:
+                    if offset:
+                        with self._lock:
+                            node.count += offset
+                            self._raise_max_count(word, node)
+                        if word in words:
+                            words[word] = {**words[word], "count": node.count}
+                elif len(word) > 3 and word not in stop_words and total > min_frequency:
+                    leaf_node = self.insert_word_branch(word, count=total // 10)
+                    if leaf_node and self._clean_synonyms:
+                        for synonym in self._clean_synonyms.get(word, []):
+                            self.insert_word_branch(
+                                synonym, leaf_node=leaf_node, add_word=False, count=total // 10
+                            )
+                    if not _has_quote(word):
+                        words[word] = {"count": total // 10}
+
+            for bigram, (count, total) in delta["bigrams"].items():
+                if bigram in words:
+                    words[bigram] = {**words[bigram], "count": words[bigram]["count"] + count}
+                    continue
+                first, second = bigram.split(" ")
+                if total > 1 and first in words and second in words and not _has_quote(bigram):
+                    words[bigram] = {"count": total}
+
+            with self._lock:
+                # the fuzzy index only has to be rebuilt for new words
+                if len(words) == len(self.words) and self._fuzzy_index is not None:
+                    if self._fuzzy_index.words is self.words:
+                        self._fuzzy_index.words = words
+                self.words = words
+            self._completion_cache.clear()
+
+    def save_words(self, words_path: str = MONOGRAM_AND_BIGRAM_DICTIONARY_PATH):
+        """Save the words with the merged deltas, in the format of load_words"""
+        with self._update_lock:
+            words = self.words
+        with open(words_path, "wb") as file:
+            file.write(orjson.dumps(dict(words)))
     
     def modify_lists_allow_first_repeat(self, lists):
         """
@@ -1296,13 +1371,15 @@ class _DawgNode:
     set of words.
     """
 
-    __slots__ = ("word", "original_key", "children", "count")
+    __slots__ = ("word", "original_key", "children", "count", "max_count")
 
     def __init__(self):
         self.word = None
         self.original_key = None
         self.children = {}
         self.count = 0
+        # highest count of the node and its descendants, an upper bound once counts decrease
+        self.max_count = 0
 
     def __getitem__(self, key):
         return self.children[key]
@@ -1323,8 +1400,12 @@ class _DawgNode:
         count=0,
         insert_count=True,
     ):
+        count = int(count)  # converts any str to int
+        raise_max_count = add_word and insert_count
         node = self
         for letter in normalized_word:
+            if raise_max_count and node.max_count < count:
+                node.max_count = count
             if letter not in node.children:
                 node.children[letter] = _DawgNode()
 
@@ -1334,9 +1415,43 @@ class _DawgNode:
             node.word = word
             node.original_key = original_key
             if insert_count:
-                node.count = int(count)  # converts any str to int
+                node.count = count
+                if node.max_count < count:
+                    node.max_count = count
+        return node
+
+    def raise_max_count(self, normalized_word, count):
+        """
+        Raise the max count of the nodes on the path of `normalized_word` to `count`.
+        Returns the last node of the path, None when the path is not in the dawg.
+        """
+        node = self
+        for letter in normalized_word:
+            if node.max_count < count:
+                node.max_count = count
+            node = node.children.get(letter)
+            if node is None:
+                return None
+        if node.max_count < count:
+            node.max_count = count
         return node
 
+    def update_max_counts(self):
+        """Recompute the max counts of the whole dawg under this node"""
+        max_counts = {}
+        stack = [(self, False)]
+        while stack:
+            node, is_expanded = stack.pop()
+            if node in max_counts:
+                continue
+            children = node.children.values()
+            if is_expanded:
+                max_count = max([node.count] + [max_counts[child] for child in children])
+                max_counts[node] = node.max_count = max_count
+            else:
+                stack.append((node, True))
+                stack.extend((child, False) for child in children if child not in max_counts)
+
     def get_descendants_nodes(
         self, size, should_traverse=True, full_stop_words=None, insert_count=True
     ):
@@ -1390,10 +1505,48 @@ class _DawgNode:
 
         return map(lambda word: word.value, found_nodes)
 
+    def get_top_descendants_nodes(self, size):
+        """
+        The `size` descendants with the highest counts, in the same order as sorting
+        every node found by get_descendants_nodes by count, ties in breadth-first order.
+        Best-first search: a subtree is only opened while its max count can still beat
+        the nodes already found, instead of traversing all of it.
+        The values of the descendants are assumed unique and without full stop words,
+        as in a dawg built without synonyms.
+        """
+        # (-count, depth, path of child positions, is value, node): the depth and the path
+        # order the nodes breadth-first, a subtree sorts before the value of its own root
+        heap = [
+            (-child.max_count, 1, (position,), False, child)
+            for position, child in enumerate(self.children.values())
+        ]
+        heapq.heapify(heap)
+        unique_nodes = {self}
+        found_nodes_set = set()
+        while heap and len(found_nodes_set) < size:
+            _, depth, path, is_value, node = heapq.heappop(heap)
+            if is_value:
+                if node.value not in found_nodes_set:
+                    found_nodes_set.add(node.value)
+                    yield node
+                continue
+            if node in unique_nodes:
+                continue
+            unique_nodes.add(node)
+            if node.value:
+                heapq.heappush(heap, (-node.count, depth, path, True, node))
+            for position, child in enumerate(node.children.values()):
+                if child not in unique_nodes:
+                    heapq.heappush(heap, (-child.max_count, depth + 1, path + (position,), False, child))
+
+    def get_top_descendants_words(self, size):
+        """Same words as get_descendants_words with insert_count, without visiting every descendant"""
+        return map(lambda word: word.value, self.get_top_descendants_nodes(size + 1))
+
 
 
 # if __name__ == "__main__":
 
 #     dictionary_path = "C:/Users/Asus/Desktop/ttds-proj/backend/utils/spell_checking_and_autocomplete_files/symspell_dictionary.pkl"
 #     query_suggestion = QuerySuggestion(dictionary_path=dictionary_path)
-#     query_suggestion.search("ed")
\ No newline at end of file
+#     query_suggestion.search("ed")
@@ -7,11 +7,14 @@ import time
 from tqdm import tqdm
 from typing import Tuple
 from basetype import InvertedIndex, RedisKeys, RedisDocKeys, NewsArticleData
-from typing import List, Dict
+from typing import List, Dict, Optional
 from dotenv import load_dotenv
 from constant import PROJECT_PATH
+from metrics import time_stage
+from common import get_logger
 
 BASEPATH = os.path.dirname(__file__)
+logger = get_logger(__name__)
 
 # redis_async_connection = None
 redis_async_connection = {
@@ -37,6 +40,16 @@ def get_redis_config(is_async=True, db=0):
 
     return config_redis
 
+def is_index_sharding_enabled() -> bool:
+    """Whether the index is split into doc-id range shards (INDEX_SHARDING=true)"""
+    load_dotenv(dotenv_path=os.path.join(PROJECT_PATH, ".env"))
+    return os.getenv("INDEX_SHARDING", "false").lower() == "true"
+
+def get_tfidf_max_results() -> int:
+    """Most documents returned by a tf-idf search (TFIDF_MAX_RESULTS), the shards only rank their best ones"""
+    load_dotenv(dotenv_path=os.path.join(PROJECT_PATH, ".env"))
+    return int(os.getenv("TFIDF_MAX_RESULTS", 1000))
+
 # Redis Functions
 def initialize_sync_redis(db=0):
     global redis_connection
@@ -102,8 +115,10 @@ async def get_doc_size() -> int:
         return 0
 
 @do_check_async_redis_connection(db=3)
-async def get_tfidf_doc_size() -> int:
-    doc_size = await redis_async_connection[3].get(RedisKeys.document_size)
+async def get_tfidf_doc_size(shard_id: Optional[int] = None) -> int:
+    doc_size = await redis_async_connection[3].get(
+        RedisKeys.shard(shard_id, RedisKeys.document_size)
+    )
     if doc_size:
         return int(doc_size)
     else:
@@ -140,14 +155,16 @@ async def get_doc_fields(doc_id: int, fields_list: List[str]) -> List[str]:
 async def get_docs_fields(doc_ids: List[int], fields_list: List[str]) -> List[str]:
     keys = [RedisKeys.document(doc_id) for doc_id in doc_ids]
     
-    pipe = redis_async_connection[1].pipeline()
-    for key in keys:
-        pipe.hmget(key, *fields_list)
-    
-    results = await pipe.execute()
+    with time_stage("doc_fields"):
+        pipe = redis_async_connection[1].pipeline()
+        for key in keys:
+            pipe.hmget(key, *fields_list)
+        
+        results = await pipe.execute()
 
-    for idx, result in enumerate(results):
-        results[idx] = {fields_list[i]: value.decode() for i, value in enumerate(result)}
+    with time_stage("decode"):
+        for idx, result in enumerate(results):
+            results[idx] = {fields_list[i]: value.decode() for i, value in enumerate(result)}
     return results
 
 @do_check_async_redis_connection(db=1)
@@ -163,9 +180,22 @@ async def get_doc_info() -> int:
     return int(doc_size)
 
 @do_check_async_redis_connection(db=0)
-async def get_doc_ids_list() -> List[int]:
-    doc_ids_list = await redis_async_connection[0].get(RedisKeys.doc_ids_list)
-    return orjson.loads(doc_ids_list)
+async def get_doc_ids_list(shard_id: Optional[int] = None) -> List[int]:
+    with time_stage("redis_fetch"):
+        doc_ids_list = await redis_async_connection[0].get(
+            RedisKeys.shard(shard_id, RedisKeys.doc_ids_list)
+        )
+    with time_stage("decode"):
+        return orjson.loads(doc_ids_list)
+
+@do_check_async_redis_connection(db=0)
+async def add_shard(shard_id: int):
+    await redis_async_connection[0].sadd(RedisKeys.shards, shard_id)
+
+@do_check_async_redis_connection(db=0)
+async def get_shard_ids() -> List[int]:
+    shard_ids = await redis_async_connection[0].smembers(RedisKeys.shards)
+    return sorted(int(shard_id) for shard_id in shard_ids)
 
 @do_check_redis_connection(db=0)
 def get_val(key):
@@ -173,7 +203,7 @@ def get_val(key):
     value = redis_connection.get(key)
     value = value.decode()
     value = eval(value)
-    print(f"Time taken to get {key}: {time.time() - start_time}")
+    logger.debug("Time taken to get %s: %.4f", key, time.time() - start_time)
     return value
 
 
@@ -234,6 +264,14 @@ async def set_news_data(article: NewsArticleData):
 async def set_news_data_col(doc_id: str, colname: RedisDocKeys, value: str):
     await redis_async_connection[1].hset(doc_id, colname, value)
 
+@do_check_async_redis_connection(db=1)
+async def set_news_data_cols(values: Dict[str, str], colname: RedisDocKeys):
+    """Set a column of many documents in one pipeline, {doc_id: value}"""
+    pipe = redis_async_connection[1].pipeline()
+    for doc_id, value in values.items():
+        pipe.hset(RedisKeys.document(doc_id), colname, value)
+    await pipe.execute()
+
 @do_check_async_redis_connection(db=1)
 async def batch_push_news_data(news_batch):
     # Define keys and values to set
@@ -247,10 +285,10 @@ async def batch_push_news_data(news_batch):
     await asyncio.gather(*tasks)
 
 @do_check_async_redis_connection(db=0)
-async def update_index(inverted_index: InvertedIndex, term_batch_size=1000):
+async def update_index(inverted_index: InvertedIndex, term_batch_size=1000, shard_id: Optional[int] = None):
     tasks = []
     for idx, term in enumerate(inverted_index.index):
-        tasks.append(update_index_term(term, inverted_index))
+        tasks.append(update_index_term(term, inverted_index, shard_id))
         if idx % term_batch_size == 0 and idx != 0:
             await asyncio.gather(*tasks)
             tasks = []
@@ -258,8 +296,10 @@ async def update_index(inverted_index: InvertedIndex, term_batch_size=1000):
     if tasks:
         await asyncio.gather(*tasks)
     
-    doc_size = await redis_async_connection[0].get(RedisKeys.document_size) 
-    doc_ids_list = await redis_async_connection[0].get(RedisKeys.doc_ids_list) 
+    document_size_key = RedisKeys.shard(shard_id, RedisKeys.document_size)
+    doc_ids_list_key = RedisKeys.shard(shard_id, RedisKeys.doc_ids_list)
+    doc_size = await redis_async_connection[0].get(document_size_key)
+    doc_ids_list = await redis_async_connection[0].get(doc_ids_list_key)
     if not doc_size:
         doc_size = inverted_index.meta.document_size
     else:
@@ -273,12 +313,13 @@ async def update_index(inverted_index: InvertedIndex, term_batch_size=1000):
         doc_ids_list.extend(inverted_index.meta.doc_ids_list)
     
     await redis_async_connection[0].mset({
-        RedisKeys.document_size: doc_size,
-        RedisKeys.doc_ids_list: orjson.dumps(doc_ids_list)
+        document_size_key: doc_size,
+        doc_ids_list_key: orjson.dumps(doc_ids_list)
     })
             
-async def update_index_term(term, inverted_index: InvertedIndex):
-    db_value = await redis_async_connection[0].get(RedisKeys.index(term))
+async def update_index_term(term, inverted_index: InvertedIndex, shard_id: Optional[int] = None):
+    term_key = RedisKeys.shard(shard_id, RedisKeys.index(term))
+    db_value = await redis_async_connection[0].get(term_key)
     if not db_value:
         db_value = {}
     else:
@@ -287,17 +328,17 @@ async def update_index_term(term, inverted_index: InvertedIndex):
     for doc_id, pos in inverted_index.index[term].items():
         db_value[doc_id] = pos
     
-    await redis_async_connection[0].set(RedisKeys.index(term), orjson.dumps(db_value))
+    await redis_async_connection[0].set(term_key, orjson.dumps(db_value))
     
     # free memory
     del db_value
 
 @do_check_async_redis_connection(db=3)
-async def update_tfidf_index(inverted_index: InvertedIndex, term_batch_size=15000):
-    print("Updating tf")
+async def update_tfidf_index(inverted_index: InvertedIndex, term_batch_size=15000, shard_id: Optional[int] = None):
+    logger.debug("Updating tf")
     tasks = []
     for idx, term in enumerate(inverted_index.index):
-        tasks.append(update_tf_index_term(term, inverted_index))
+        tasks.append(update_tf_index_term(term, inverted_index, shard_id))
         if idx % term_batch_size == 0 and idx != 0:
             asyncio.gather(*tasks)
             tasks = []
@@ -305,49 +346,71 @@ async def update_tfidf_index(inverted_index: InvertedIndex, term_batch_size=1500
 
     if tasks:
         await asyncio.gather(*tasks)
-    print("Updating size")
+    logger.debug("Updating size")
     
-    # set the document size
-    doc_size = await redis_async_connection[3].get(RedisKeys.document_size)
-    if not doc_size:
-        doc_size = inverted_index.meta.document_size
-    else:
-        doc_size = int(doc_size) + inverted_index.meta.document_size
-    await redis_async_connection[3].set(RedisKeys.document_size, doc_size)
+    # set the document size, a shard also counts towards the size of the whole collection
+    document_size_keys = {RedisKeys.document_size, RedisKeys.shard(shard_id, RedisKeys.document_size)}
+    for document_size_key in document_size_keys:
+        doc_size = await redis_async_connection[3].get(document_size_key)
+        if not doc_size:
+            doc_size = inverted_index.meta.document_size
+        else:
+            doc_size = int(doc_size) + inverted_index.meta.document_size
+        await redis_async_connection[3].set(document_size_key, doc_size)
 
 @do_check_async_redis_connection(db=3)
-async def update_tf_index_term(term, inverted_index: InvertedIndex):
-    db_value = await redis_async_connection[3].get(RedisKeys.tf(term))
+async def update_tf_index_term(term, inverted_index: InvertedIndex, shard_id: Optional[int] = None):
+    term_key = RedisKeys.shard(shard_id, RedisKeys.tf(term))
+    db_value = await redis_async_connection[3].get(term_key)
     if not db_value:
         db_value = {}
     else:
         db_value = orjson.loads(db_value)
     
+    new_doc_count = len(inverted_index.index[term].keys() - db_value.keys())
     for doc_id, pos in inverted_index.index[term].items():
         db_value[doc_id] = len(pos)
     
-    await redis_async_connection[3].set(RedisKeys.tf(term), orjson.dumps(db_value))
+    await redis_async_connection[3].set(term_key, orjson.dumps(db_value))
+    if shard_id is not None:
+        # shards only hold part of the postings, so keep the collection-wide df
+        await redis_async_connection[3].incrby(RedisKeys.df(term), new_doc_count)
     
     # free memory
     del db_value
 
 @do_check_async_redis_connection(db=3)
-async def get_tfs(term: List[str]) -> Dict[str, Dict[str, int]]:
-    kv_pairs = await redis_async_connection[3].mget(*[RedisKeys.tf(t) for t in term])
+async def get_tfs(term: List[str], shard_id: Optional[int] = None) -> Dict[str, Dict[str, int]]:
+    with time_stage("redis_fetch"):
+        kv_pairs = await redis_async_connection[3].mget(
+            *[RedisKeys.shard(shard_id, RedisKeys.tf(t)) for t in term]
+        )
     if not kv_pairs:
         return {}
-    kv_pairs = [orjson.loads(pair) for pair in kv_pairs if pair]
-    return dict(zip(term, kv_pairs))
+    # keep the terms aligned with their values when some of them are missing
+    with time_stage("decode"):
+        return {t: orjson.loads(pair) for t, pair in zip(term, kv_pairs) if pair}
+
+@do_check_async_redis_connection(db=3)
+async def get_dfs(term: List[str]) -> Dict[str, int]:
+    with time_stage("redis_fetch"):
+        values = await redis_async_connection[3].mget(*[RedisKeys.df(t) for t in term])
+    return {t: int(value) for t, value in zip(term, values) if value}
 
 @do_check_async_redis_connection(db=0)
 async def get_json_value(key: str) -> Dict:
-    value = await redis_async_connection[0].get(key)
-    return orjson.loads(value)
+    with time_stage("redis_fetch"):
+        value = await redis_async_connection[0].get(key)
+    with time_stage("decode"):
+        return orjson.loads(value)
 
 @do_check_async_redis_connection(db=0)
 async def get_json_values(keys: List[str]) -> List[Dict]:
-    values_list = await redis_async_connection[0].mget(*keys)
-    values_list = [orjson.loads(value) for value in values_list]
+    with time_stage("redis_fetch"):
+        values_list = await redis_async_connection[0].mget(*keys)
+    # a term can be missing from a shard even when it exists in the collection
+    with time_stage("decode"):
+        values_list = [orjson.loads(value) if value else {} for value in values_list]
     return values_list
 
 @do_check_async_redis_connection(db=0)
@@ -362,29 +425,31 @@ def clear_redis():
 
 @do_check_async_redis_connection(db=0)
 async def is_key_exists(key):
-    return await redis_async_connection[0].exists(key)
+    with time_stage("redis_fetch"):
+        return await redis_async_connection[0].exists(key)
 
 @do_check_async_redis_connection(db=2)
 async def set_cache(key: str, doc_ids_list: List[int], **kwargs):
     if await check_cache_exists(key):
         return
     
-    doc_data = await get_docs_fields(doc_ids_list,
-                                    [RedisDocKeys.title,
-                                    RedisDocKeys.topic,
-                                    RedisDocKeys.url, 
-                                    RedisDocKeys.source, 
-                                    RedisDocKeys.date, 
-                                    RedisDocKeys.sentiment, 
-                                    RedisDocKeys.summary])
-    response_data = {
-        "results": doc_data,
-    }
-    for k, v in kwargs.items():
-        response_data[k] = v
-        
-    # set expiration time to 5 minutes
-    await redis_async_connection[2].setex(key, 300, orjson.dumps(response_data))
+    with time_stage("cache_write"):
+        doc_data = await get_docs_fields(doc_ids_list,
+                                        [RedisDocKeys.title,
+                                        RedisDocKeys.topic,
+                                        RedisDocKeys.url, 
+                                        RedisDocKeys.source, 
+                                        RedisDocKeys.date, 
+                                        RedisDocKeys.sentiment, 
+                                        RedisDocKeys.summary])
+        response_data = {
+            "results": doc_data,
+        }
+        for k, v in kwargs.items():
+            response_data[k] = v
+            
+        # set expiration time to 5 minutes
+        await redis_async_connection[2].setex(key, 300, orjson.dumps(response_data))
 
 @do_check_async_redis_connection(db=2)
 async def caching_query_result(method: str, query: str, page_doc_ids_dict: Dict[int, List[int]], **kwargs):
@@ -397,18 +462,121 @@ async def caching_query_result(method: str, query: str, page_doc_ids_dict: Dict[
         elif "total_pages" in kwargs:
             asyncio.create_task(set_cache(key, doc_ids_list, total_pages=kwargs["total_pages"]))
         else:
-            print(kwargs)
+            logger.error("Invalid kwargs for caching query result: %s", kwargs)
             raise ValueError("Invalid kwargs")
 
 @do_check_async_redis_connection(db=2)
 async def check_cache_exists(key: str):
-    return await redis_async_connection[2].exists(key)
+    with time_stage("cache_read"):
+        return await redis_async_connection[2].exists(key)
 
 @do_check_async_redis_connection(db=2)
 async def get_cache(key: str):
     asyncio.create_task(redis_async_connection[2].expire(key, 300))
-    print(f"Getting cache for {key}")
-    return orjson.loads(await redis_async_connection[2].get(key))
+    logger.debug(f"Getting cache for {key}")
+    with time_stage("cache_read"):
+        return orjson.loads(await redis_async_connection[2].get(key))
+
+@do_check_redis_connection(db=0)
+def push_dictionary_delta(name: str, monograms: Dict[str, int], bigrams: Dict[str, int], batch_size=10000) -> bool:
+    """
+    Add the word and bigram counts of new articles to the totals and push them as a delta,
+    with the total of every entry: {"name", "monograms": {word: [count, total]}, "bigrams": {...}}.
+    A delta is pushed once by name, returns whether it was pushed.
+    The totals are read while watched and updated with the delta in one transaction, retried
+    when another delta was pushed in between, so the totals and the deltas always agree.
+    """
+    watched_keys = (RedisKeys.dictionary_delta_names, RedisKeys.monogram_totals, RedisKeys.bigram_totals)
+    with redis_connection.pipeline() as pipe:
+        while True:
+            try:
+                pipe.watch(*watched_keys)
+                if pipe.sismember(RedisKeys.dictionary_delta_names, name):
+                    return False
+
+                delta = {"name": name, "monograms": {}, "bigrams": {}}
+                for totals_key, counts, entries in (
+                    (RedisKeys.monogram_totals, monograms, delta["monograms"]),
+                    (RedisKeys.bigram_totals, bigrams, delta["bigrams"]),
+                ):
+                    keys = list(counts)
+                    for i in range(0, len(keys), batch_size):
+                        batch = keys[i : i + batch_size]
+                        for key, total in zip(batch, pipe.hmget(totals_key, batch)):
+                            entries[key] = [counts[key], int(total or 0) + counts[key]]
+
+                pipe.multi()
+                for totals_key, counts in (
+                    (RedisKeys.monogram_totals, monograms),
+                    (RedisKeys.bigram_totals, bigrams),
+                ):
+                    for key, count in counts.items():
+                        pipe.hincrby(totals_key, key, count)
+                pipe.rpush(RedisKeys.dictionary_deltas, orjson.dumps(delta))
+                pipe.sadd(RedisKeys.dictionary_delta_names, name)
+                pipe.execute()
+                return True
+            except redis.WatchError:
+                logger.info(f"The dictionary totals changed while pushing {name}, retrying")
+
+@do_check_redis_connection(db=0)
+def get_dictionary_deltas(start: int = 0) -> List[Dict]:
+    """The dictionary deltas pushed from position `start` on"""
+    return [orjson.loads(delta) for delta in redis_connection.lrange(RedisKeys.dictionary_deltas, start, -1)]
+
+@do_check_async_redis_connection(db=0)
+async def push_query_popularity(
+    counts: Dict[str, int],
+    capacity: int,
+    now: float,
+    half_life_seconds: float,
+    default_epoch: float,
+    max_half_lives: float,
+):
+    """
+    Add the searched terms with the forward decay weight of `now` and keep the `capacity` most
+    popular ones. Once the weight is above 2 ** `max_half_lives`, the counts are first scaled
+    down and the epoch moved to `now`, in the same script so no weights of the old epoch are added.
+    """
+    lua_script = """
+        local epoch = tonumber(redis.call('get', KEYS[2]) or ARGV[3])
+        local half_lives = (tonumber(ARGV[1]) - epoch) / tonumber(ARGV[2])
+        if half_lives > tonumber(ARGV[4]) then
+            local scale = 2 ^ -half_lives
+            local entries = redis.call('zrange', KEYS[1], 0, -1, 'withscores')
+            for i = 1, #entries, 2 do
+                redis.call('zadd', KEYS[1], tonumber(entries[i + 1]) * scale, entries[i])
+            end
+            redis.call('set', KEYS[2], ARGV[1])
+            half_lives = 0
+        end
+        local weight = 2 ^ half_lives
+        for i = 6, #ARGV, 2 do
+            redis.call('zincrby', KEYS[1], tonumber(ARGV[i + 1]) * weight, ARGV[i])
+        end
+        redis.call('zremrangebyrank', KEYS[1], 0, -tonumber(ARGV[5]) - 1)
+    """
+    args = [repr(float(now)), repr(float(half_life_seconds)), repr(float(default_epoch)), max_half_lives, capacity]
+    for term, count in counts.items():
+        args.extend([term, count])
+    await redis_async_connection[0].eval(
+        lua_script, keys=[RedisKeys.query_popularity, RedisKeys.query_popularity_epoch], args=args
+    )
+
+@do_check_redis_connection(db=0)
+def get_query_popularity(top_k: int) -> Tuple[Optional[float], List[Tuple[str, float]]]:
+    """
+    The epoch of the forward decayed counts, None until they were first rebased, with the
+    `top_k` most popular searched terms and their counts
+    """
+    pipe = redis_connection.pipeline()
+    pipe.get(RedisKeys.query_popularity_epoch)
+    pipe.zrevrange(RedisKeys.query_popularity, 0, top_k - 1, withscores=True)
+    epoch, entries = pipe.execute()
+    return (
+        None if epoch is None else float(epoch),
+        [(term.decode(), score) for term, score in entries],
+    )
 
 @do_check_async_redis_connection(db=3)
 async def test():
@@ -1,19 +1,39 @@
+import os
+import sys
 from fastapi import HTTPException
-from transformers import pipeline
 from pydantic import BaseModel
 
+sys.path.append(os.path.dirname(__file__))
+
+from onnx_models import FILL_MASK_MODEL_NAME, OnnxFillMask, use_onnx_model
+
 
 class ExpansionQuery(BaseModel):
     query: str
     num_expansions: int = 5  # Default value set to 5
 
-model_name = "roberta-base"
-fill_mask = pipeline("fill-mask", model=model_name, tokenizer=model_name)
+model_name = FILL_MASK_MODEL_NAME
+fill_mask = None
+
+def get_fill_mask():
+    """
+    The pipeline downloads and loads roberta-base, so it is only built on first use.
+    With INFERENCE_BACKEND=onnx, the exported model is run by onnxruntime instead.
+    """
+    global fill_mask
+    if fill_mask is None:
+        if use_onnx_model("fill-mask"):
+            fill_mask = OnnxFillMask("fill-mask")
+        else:
+            from transformers import pipeline
+
+            fill_mask = pipeline("fill-mask", model=model_name, tokenizer=model_name)
+    return fill_mask
 
 def expand_query(query: str, num_expansions: int):
     try:
         query_with_mask = query + " <mask>"
-        suggestions = fill_mask(query_with_mask, top_k=num_expansions)
+        suggestions = get_fill_mask()(query_with_mask, top_k=num_expansions)
         
         expanded_queries = [suggestion["sequence"].replace("<s>", "").replace("</s>", "").strip() for suggestion in suggestions]
         return expanded_queries
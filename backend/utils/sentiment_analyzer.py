@@ -1,78 +1,55 @@
-### TO DO - MOVE THE MODEL, TOKENIZER, AND DEVICE DETERMINATION
-# TO THE INITIALIZATION OF THE MODULE
-
 import os
+import sys
 import warnings
 import pandas as pd
 from tqdm import tqdm
-import numpy as np
-import torch
-from transformers import AutoTokenizer, AutoModelForSequenceClassification
 import orjson
 
-DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-MODEL_NAME = "mrm8488/distilroberta-finetuned-financial-news-sentiment-analysis"
-TOKENIZER = AutoTokenizer.from_pretrained(MODEL_NAME)
-MODEL = AutoModelForSequenceClassification.from_pretrained(MODEL_NAME)
+sys.path.append(os.path.dirname(__file__))
+
+from sentiment_engine import load_sentiment_engine
 
+# the model, tokenizer and device are loaded once, with the settings of the .env
+ENGINE = load_sentiment_engine()
 
-def analyze_sentiment(text, model=MODEL, tokenizer=TOKENIZER, device=DEVICE):
+
+def analyze_sentiment(text, engine=ENGINE):
     """
     Analyzes sentiment for a single piece of text and returns rounded sentiment probabilities.
 
     Parameters:
         text (str): The text to analyze.
-        model: The pre-trained sentiment analysis model.
-        tokenizer: The tokenizer for the model.
-        device: The device to run the model on.
+        engine: The SentimentEngine holding the model and its tokenizer.
 
     Returns:
         list: A list containing the probabilities for [negative, neutral, positive] sentiments.
     """
     try:
-        inputs = tokenizer(
-            text, return_tensors="pt", truncation=True, max_length=512
-        ).to(device)
-        with torch.no_grad():
-            outputs = model(**inputs)
-        sentiments = (
-            torch.nn.functional.softmax(outputs.logits, dim=-1)
-            .to("cpu")[0]
-            .float()
-            .numpy()
-        )
-        # Round the first 2 elements and convert them to Python floats
-        rounded_sentiments = [float(np.round(sentiment, 2)) for sentiment in sentiments]
-        diff = 1.0 - sum(rounded_sentiments)
-        rounded_sentiments[-1] = float(np.round(rounded_sentiments[-1] + diff, 2))
-        return rounded_sentiments
+        return engine.analyze([text])[0]
     except Exception as e:
         return None
 
 
 def get_sentiment_dictionary_from_csv_path(
     csv_path,
-    device=DEVICE,
-    model=MODEL,
-    tokenizer=TOKENIZER,
+    engine=ENGINE,
     csv_sentiment_dictionary=None,
 ):
     """
     Returns {doc_id: [prob_negative, prob_neutral, prob_positive]}.
 
     If csv_sentiment_dictionary is None, a new dictionary will be created.
+    The articles are analyzed together in batches.
     """
     csv_dataframe = pd.read_csv(csv_path)
     content_series = csv_dataframe["content"]
     doc_id_series = csv_dataframe["doc_id"]
 
-    model.to(device)
-
     if csv_sentiment_dictionary is None:
         csv_sentiment_dictionary = {}
 
-    for index, text in enumerate(content_series):
-        sentiment_list = analyze_sentiment(text, model, tokenizer, device)
+    sentiment_lists = engine.analyze(list(content_series))
+    for index, sentiment_list in enumerate(sentiment_lists):
         doc_id = doc_id_series[index]
 
         if str(doc_id) in csv_sentiment_dictionary.keys():
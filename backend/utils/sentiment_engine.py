@@ -0,0 +1,305 @@
+import os
+import sys
+import multiprocessing
+import numpy as np
+from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Iterator, List, Optional, Tuple
+from transformers import AutoTokenizer
+
+sys.path.append(os.path.dirname(__file__))
+
+from dotenv import load_dotenv
+from constant import PROJECT_PATH
+from onnx_models import (
+    SENTIMENT_MODEL_NAME as MODEL_NAME,
+    get_onnx_model_dir,
+    load_onnx_session,
+    softmax,
+    use_onnx_model,
+)
+
+BATCH_SIZE = 32
+MAX_LENGTH = 512
+# one window is the first 512 tokens, like the articles used to be truncated
+MAX_WINDOWS = 1
+WINDOW_OVERLAP = 64
+WORKERS = 1
+
+# the engine of the parent, inherited by the forked workers instead of being pickled
+_worker_engine = None
+
+
+def round_sentiments(probabilities) -> List[float]:
+    """[negative, neutral, positive] rounded to 2 decimals, the last one takes the rounding error"""
+    rounded_sentiments = [float(np.round(probability, 2)) for probability in probabilities]
+    diff = 1.0 - sum(rounded_sentiments)
+    rounded_sentiments[-1] = float(np.round(rounded_sentiments[-1] + diff, 2))
+    return rounded_sentiments
+
+
+def split_windows(token_ids: List[int], window_size: int, overlap: int, max_windows: int) -> List[List[int]]:
+    """
+    Overlapping windows of `window_size` tokens covering the tokens. When there are more than
+    `max_windows`, evenly spaced ones are kept so the whole article is still sampled.
+    """
+    step = max(1, window_size - overlap)
+    starts = list(range(0, max(len(token_ids) - window_size, 0) + 1, step))
+    if starts[-1] + window_size < len(token_ids):
+        starts.append(len(token_ids) - window_size)
+    if len(starts) > max_windows:
+        starts = [starts[i] for i in np.linspace(0, len(starts) - 1, max_windows).round().astype(int)]
+    return [token_ids[start : start + window_size] for start in starts]
+
+
+class BaseSentimentEngine(ABC):
+    """
+    Batched sentiment inference. The texts are tokenized once, sorted by their number of tokens
+    and run in batches padded to their longest text, so the short articles are not padded to
+    the long ones.
+    An article longer than the model input is split into up to `max_windows` overlapping windows
+    run in the same batches, and its probabilities are the mean of the windows weighted by their
+    number of tokens.
+    The backends implement forward for a batch of token ids.
+    """
+
+    def __init__(
+        self,
+        tokenizer,
+        batch_size: int = BATCH_SIZE,
+        max_length: int = MAX_LENGTH,
+        max_windows: int = MAX_WINDOWS,
+        window_overlap: int = WINDOW_OVERLAP,
+    ):
+        self.tokenizer = tokenizer
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self.max_windows = max_windows
+        self.window_overlap = window_overlap
+
+    # whether the model runs on the CPU, so that it can be shared with forked workers
+    is_cpu = True
+
+    @abstractmethod
+    def get_num_threads(self) -> int:
+        pass
+
+    @abstractmethod
+    def set_num_threads(self, num_threads: int):
+        pass
+
+    @abstractmethod
+    def forward(self, sequences: List[List[int]]) -> np.ndarray:
+        """The probabilities of the labels of a batch of sequences of token ids"""
+
+    def encode_windows(self, texts: List[str]) -> List[List[List[int]]]:
+        """The windows of token ids of every text, with the special tokens of the model"""
+        if self.max_windows <= 1:
+            encoded = self.tokenizer(texts, truncation=True, max_length=self.max_length)
+            return [[ids] for ids in encoded["input_ids"]]
+        window_size = self.max_length - self.tokenizer.num_special_tokens_to_add()
+        return [
+            [
+                self.tokenizer.build_inputs_with_special_tokens(window)
+                for window in split_windows(ids, window_size, self.window_overlap, self.max_windows)
+            ]
+            for ids in self.tokenizer(texts, add_special_tokens=False, verbose=False)["input_ids"]
+        ]
+
+    def predict_token_ids(self, sequences: List[List[int]]) -> np.ndarray:
+        """The probabilities of the labels of every sequence of token ids"""
+        probabilities = None
+        order = sorted(range(len(sequences)), key=lambda i: len(sequences[i]))
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start : start + self.batch_size]
+            batch_probabilities = self.forward([sequences[i] for i in batch])
+            if probabilities is None:
+                probabilities = np.empty((len(sequences), batch_probabilities.shape[1]), dtype=np.float32)
+            probabilities[batch] = batch_probabilities
+        return probabilities
+
+    def analyze(self, texts: List[str]) -> List[Optional[List[float]]]:
+        """
+        The rounded [negative, neutral, positive] probabilities of every text,
+        None for the articles without content.
+        """
+        results = [None] * len(texts)
+        positions = [i for i, text in enumerate(texts) if isinstance(text, str)]
+        if not positions:
+            return results
+        text_windows = self.encode_windows([texts[i] for i in positions])
+        windows = [window for text_window in text_windows for window in text_window]
+        probabilities = self.predict_token_ids(windows)
+        lengths = np.array([len(window) for window in windows], dtype=np.float32)
+        start = 0
+        for position, text_window in zip(positions, text_windows):
+            end = start + len(text_window)
+            results[position] = round_sentiments(
+                np.average(probabilities[start:end], axis=0, weights=lengths[start:end])
+            )
+            start = end
+        return results
+
+
+class SentimentEngine(BaseSentimentEngine):
+    """The model run by torch, on the GPU when there is one"""
+
+    def __init__(self, model, tokenizer, device=None, **kwargs):
+        import torch
+
+        super().__init__(tokenizer, **kwargs)
+        self.device = device or torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.model = model.to(self.device).eval()
+
+    @classmethod
+    def from_pretrained(
+        cls,
+        model_name: str = MODEL_NAME,
+        quantize: bool = False,
+        num_threads: Optional[int] = None,
+        **kwargs,
+    ) -> "SentimentEngine":
+        """
+        quantize: bool
+            Run the linear layers in int8 with dynamic quantization, on CPU only.
+        num_threads: int
+            The intra-op threads of torch, all the cores by default.
+        """
+        import torch
+        from transformers import AutoModelForSequenceClassification
+
+        if num_threads:
+            torch.set_num_threads(num_threads)
+        tokenizer = AutoTokenizer.from_pretrained(model_name)
+        model = AutoModelForSequenceClassification.from_pretrained(model_name)
+        engine = cls(model, tokenizer, **kwargs)
+        if quantize and engine.is_cpu:
+            engine.model = torch.quantization.quantize_dynamic(
+                engine.model, {torch.nn.Linear}, dtype=torch.qint8
+            )
+        return engine
+
+    @property
+    def is_cpu(self) -> bool:
+        return self.device.type == "cpu"
+
+    def get_num_threads(self) -> int:
+        import torch
+
+        return torch.get_num_threads()
+
+    def set_num_threads(self, num_threads: int):
+        import torch
+
+        torch.set_num_threads(num_threads)
+
+    def forward(self, sequences: List[List[int]]) -> np.ndarray:
+        import torch
+
+        with torch.inference_mode():
+            inputs = self.tokenizer.pad({"input_ids": sequences}, return_tensors="pt").to(self.device)
+            logits = self.model(**inputs).logits
+            return torch.nn.functional.softmax(logits.float(), dim=-1).cpu().numpy()
+
+
+class OnnxSentimentEngine(BaseSentimentEngine):
+    """The model exported by onnx_models.py, run by onnxruntime on the CPU without torch"""
+
+    def __init__(self, name: str = "sentiment", num_threads: Optional[int] = None, **kwargs):
+        super().__init__(AutoTokenizer.from_pretrained(get_onnx_model_dir(name)), **kwargs)
+        self.name = name
+        self.num_threads = num_threads
+        self.session = load_onnx_session(name, num_threads)
+
+    def get_num_threads(self) -> int:
+        return self.num_threads or os.cpu_count() or 1
+
+    def set_num_threads(self, num_threads: int):
+        # the threads of a session are fixed when it is created
+        self.num_threads = num_threads
+        self.session = load_onnx_session(self.name, num_threads)
+
+    def forward(self, sequences: List[List[int]]) -> np.ndarray:
+        inputs = self.tokenizer.pad({"input_ids": sequences}, return_tensors="np")
+        (logits,) = self.session.run(
+            ["logits"],
+            {
+                "input_ids": inputs["input_ids"].astype(np.int64),
+                "attention_mask": inputs["attention_mask"].astype(np.int64),
+            },
+        )
+        return softmax(logits.astype(np.float32))
+
+
+def load_sentiment_engine(model_name: str = MODEL_NAME) -> BaseSentimentEngine:
+    """
+    The engine configured by SENTIMENT_BATCH_SIZE, SENTIMENT_QUANTIZE (true to run in int8),
+    SENTIMENT_NUM_THREADS, and SENTIMENT_MAX_WINDOWS with SENTIMENT_WINDOW_OVERLAP for the
+    number of windows of the long articles.
+    With INFERENCE_BACKEND=onnx, the exported model is run by onnxruntime, it is quantized
+    when it was exported.
+    """
+    load_dotenv(dotenv_path=os.path.join(PROJECT_PATH, ".env"))
+    num_threads = int(os.getenv("SENTIMENT_NUM_THREADS", 0)) or None
+    kwargs = dict(
+        batch_size=int(os.getenv("SENTIMENT_BATCH_SIZE", BATCH_SIZE)),
+        max_windows=int(os.getenv("SENTIMENT_MAX_WINDOWS", MAX_WINDOWS)),
+        window_overlap=int(os.getenv("SENTIMENT_WINDOW_OVERLAP", WINDOW_OVERLAP)),
+    )
+    if model_name == MODEL_NAME and use_onnx_model("sentiment"):
+        return OnnxSentimentEngine("sentiment", num_threads, **kwargs)
+    return SentimentEngine.from_pretrained(
+        model_name,
+        quantize=os.getenv("SENTIMENT_QUANTIZE", "false").lower() == "true",
+        num_threads=num_threads,
+        **kwargs,
+    )
+
+
+def get_sentiment_workers() -> int:
+    """The processes of iter_sentiments, set by SENTIMENT_WORKERS"""
+    load_dotenv(dotenv_path=os.path.join(PROJECT_PATH, ".env"))
+    return int(os.getenv("SENTIMENT_WORKERS", WORKERS))
+
+
+def _init_worker(num_threads: int):
+    _worker_engine.set_num_threads(num_threads)
+
+
+def _analyze_chunk(doc_ids: List, texts: List[str]) -> List[Tuple]:
+    return list(zip(doc_ids, _worker_engine.analyze(texts)))
+
+
+def iter_sentiments(
+    engine: BaseSentimentEngine, chunks: Iterable[Tuple[List, List[str]]], workers: int = WORKERS
+) -> Iterator[Tuple]:
+    """
+    (doc_id, sentiments) of the (doc_ids, texts) chunks, in their order.
+    With more than one worker, the chunks are analyzed by forked processes sharing the model
+    of the parent copy-on-write, each with its share of the intra-op threads. The parent must
+    not have run the model before, the threads of torch do not survive a fork. The workers of
+    the onnx backend create their own session with their threads.
+    """
+    if workers <= 1 or not engine.is_cpu:
+        for doc_ids, texts in chunks:
+            yield from zip(doc_ids, engine.analyze(texts))
+        return
+
+    global _worker_engine
+    _worker_engine = engine
+    num_threads = max(1, engine.get_num_threads() // workers)
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("fork"),
+        initializer=_init_worker,
+        initargs=(num_threads,),
+    ) as executor:
+        # a few chunks per worker are queued, the texts are not all read ahead
+        pending = deque()
+        for doc_ids, texts in chunks:
+            pending.append(executor.submit(_analyze_chunk, list(doc_ids), list(texts)))
+            if len(pending) >= 2 * workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
@@ -0,0 +1,167 @@
+import os
+import sys
+import time
+import weakref
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+sys.path.append(os.path.dirname(__file__))
+
+from dotenv import load_dotenv
+from constant import PROJECT_PATH
+from metrics import callback_metric
+
+_MISSING = object()
+STAT_NAMES = ("hit", "miss", "prefix_hit", "capacity", "expired")
+
+live_caches = weakref.WeakSet()
+"""every ShardedCache of the process, their counts are summed by name when the metrics are collected"""
+worker_cache_stats: Dict[int, Dict[str, Dict[str, int]]] = {}
+"""pid -> stats of the caches of a process pool worker by name, as of the last call it ran"""
+
+
+class _Shard:
+    __slots__ = ("entries", "lock", "stats")
+
+    def __init__(self):
+        self.entries = OrderedDict()  # key -> (expiry time or None, value), least recently used first
+        self.lock = Lock()
+        # counted under the lock of the shard, the metrics add them up when collected
+        self.stats = dict.fromkeys(STAT_NAMES, 0)
+
+
+class ShardedCache:
+    """
+    LRU cache with an optional time to live, split into shards by key hash so that
+    concurrent calls mostly take different locks. The capacity is shared evenly by the shards.
+    """
+
+    def __init__(self, name: str, capacity: int, ttl: Optional[float] = None, shards: int = 16):
+        self.name = name
+        self.capacity = capacity
+        self.ttl = ttl or None
+        self._shards = [_Shard() for _ in range(max(1, shards))]
+        self._shard_capacity = -(-capacity // len(self._shards)) if capacity > 0 else 0
+        live_caches.add(self)
+
+    def _get_shard(self, key: Hashable) -> _Shard:
+        return self._shards[hash(key) % len(self._shards)]
+
+    def _lookup(self, key: Hashable, stat: Optional[str]):
+        shard = self._get_shard(key)
+        with shard.lock:
+            entry = shard.entries.get(key, _MISSING)
+            if entry is not _MISSING:
+                expires_at, value = entry
+                if expires_at is not None and expires_at <= time.monotonic():
+                    del shard.entries[key]
+                    shard.stats["expired"] += 1
+                    entry = _MISSING
+            if entry is _MISSING:
+                if stat:
+                    shard.stats["miss"] += 1
+                return _MISSING
+            shard.entries.move_to_end(key)
+            if stat:
+                shard.stats["hit"] += 1
+            return value
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        value = self._lookup(key, stat="hit")
+        return default if value is _MISSING else value
+
+    def peek(self, key: Hashable, default: Any = None) -> Any:
+        """Like get, without counting a hit or a miss, for the lookups of derived entries"""
+        value = self._lookup(key, stat=None)
+        return default if value is _MISSING else value
+
+    def record_prefix_hit(self, key: Hashable):
+        """Count the miss of `key` as answered from the entry of a shorter prefix"""
+        shard = self._get_shard(key)
+        with shard.lock:
+            shard.stats["miss"] -= 1
+            shard.stats["prefix_hit"] += 1
+
+    def set(self, key: Hashable, value: Any):
+        if self._shard_capacity <= 0:
+            return
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        shard = self._get_shard(key)
+        with shard.lock:
+            shard.entries[key] = (expires_at, value)
+            shard.entries.move_to_end(key)
+            while len(shard.entries) > self._shard_capacity:
+                shard.entries.popitem(last=False)
+                shard.stats["capacity"] += 1
+
+    def clear(self):
+        for shard in self._shards:
+            with shard.lock:
+                shard.entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        """Lookups by result, evictions by reason and the number of entries"""
+        totals = dict.fromkeys(STAT_NAMES, 0)
+        entries = 0
+        for shard in self._shards:
+            with shard.lock:
+                for stat, value in shard.stats.items():
+                    totals[stat] += value
+                entries += len(shard.entries)
+        totals["entries"] = entries
+        return totals
+
+    def __len__(self):
+        return sum(len(shard.entries) for shard in self._shards)
+
+
+def create_cache(name: str, capacity: int, ttl: Optional[float] = None, shards: int = 16) -> ShardedCache:
+    """
+    New cache with its defaults overridden from the environment:
+    CACHE_<NAME>_CAPACITY, CACHE_<NAME>_TTL (seconds, 0 for no expiry) and CACHE_<NAME>_SHARDS.
+    Caches with the same name are reported together in the metrics.
+    """
+    load_dotenv(dotenv_path=os.path.join(PROJECT_PATH, ".env"))
+    env_name = name.upper().replace("-", "_")
+    return ShardedCache(
+        name,
+        capacity=int(os.getenv(f"CACHE_{env_name}_CAPACITY", capacity)),
+        ttl=float(os.getenv(f"CACHE_{env_name}_TTL", ttl or 0)),
+        shards=int(os.getenv(f"CACHE_{env_name}_SHARDS", shards)),
+    )
+
+
+def get_cache_stats() -> Dict[str, Dict[str, int]]:
+    """The stats of the caches of this process, summed by name"""
+    cache_stats = {}
+    for cache in list(live_caches):
+        totals = cache_stats.setdefault(cache.name, {})
+        for stat, value in cache.stats().items():
+            totals[stat] = totals.get(stat, 0) + value
+    return cache_stats
+
+
+def _collect_stats(stat_names: Tuple[str, ...]) -> Dict[Tuple[str, ...], int]:
+    """The stats of this process and of the process pool workers, see executors.py"""
+    totals = {}
+    for cache_stats in [get_cache_stats(), *list(worker_cache_stats.values())]:
+        for name, stats in cache_stats.items():
+            for stat in stat_names:
+                label_values = (name, stat) if len(stat_names) > 1 else (name,)
+                totals[label_values] = totals.get(label_values, 0) + stats[stat]
+    return totals
+
+
+callback_metric(
+    "cache_requests_total", "Cache lookups by result: hit, miss or prefix_hit", "counter",
+    ["cache", "result"], lambda: _collect_stats(("hit", "miss", "prefix_hit")),
+)
+callback_metric(
+    "cache_evictions_total", "Entries removed from the caches by reason: capacity or expired", "counter",
+    ["cache", "reason"], lambda: _collect_stats(("capacity", "expired")),
+)
+callback_metric(
+    "cache_entries", "Entries currently in the caches", "gauge",
+    ["cache"], lambda: _collect_stats(("entries",)),
+)
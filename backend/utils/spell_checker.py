@@ -1,18 +1,59 @@
-from typing import List
+from typing import Dict, List
 from collections import Counter
+from threading import RLock
 import re
+import sys
 from symspellpy import SymSpell, Verbosity
+from symspellpy import helpers
+from symspellpy.suggest_item import SuggestItem
 import os
 import pandas as pd
 from tqdm import tqdm
 
+sys.path.append(os.path.dirname(__file__))
+
+from constant import DICTIONARY_MIN_FREQUENCY
+from sharded_cache import create_cache
+
+QUERY_CACHE_SIZE = 4096
+TERM_CACHE_SIZE = 16384
+
+
+class _MemoizedSymSpell(SymSpell):
+    """
+    SymSpell with the lookups of single terms cached. lookup_compound looks up every term,
+    every pair of neighbouring terms and every split of the unknown terms.
+    """
+
+    def __init__(self, lookup_cache, **kwargs):
+        super().__init__(**kwargs)
+        self.lookup_cache = lookup_cache
+
+    def lookup(self, phrase, verbosity, max_edit_distance=None, include_unknown=False, **kwargs):
+        if kwargs:
+            return super().lookup(phrase, verbosity, max_edit_distance, include_unknown, **kwargs)
+        key = (phrase, verbosity, max_edit_distance, include_unknown)
+        items = self.lookup_cache.get(key)
+        if items is None:
+            items = tuple(
+                (item.term, item.distance, item.count)
+                for item in super().lookup(phrase, verbosity, max_edit_distance, include_unknown)
+            )
+            self.lookup_cache.set(key, items)
+        # new items every time, lookup_compound changes the distance of the ones it merges
+        return [SuggestItem(*item) for item in items]
+
 
 class SpellChecker:
     def __init__(
         self, dictionary_path: str = "spell_checking_files/symspell_dictionary.pkl"
     ) -> None:
 
-        self.sym_spell = SymSpell()
+        # the dictionary deltas are merged from another thread (see dictionary_updates.py)
+        self._lock = RLock()
+        self._query_cache = create_cache("spellcheck-query", QUERY_CACHE_SIZE)
+        self._term_cache = create_cache("spellcheck-term", TERM_CACHE_SIZE)
+        self.sym_spell = _MemoizedSymSpell(self._term_cache)
         if dictionary_path:
             self.sym_spell.load_pickle(dictionary_path)
 
@@ -81,30 +122,27 @@ class SpellChecker:
     def create_filtered_corpus(
         self, corpus_txt_path, filtered_corpus_path, min_frequency
     ):
-        """Create a new corpus file with words having a minimum frequency."""
-        print("Reading corpus file...")
+        """
+        Create a new corpus file with words having a minimum frequency.
+        The corpus is read line by line twice, to count and then to filter the words,
+        instead of holding all of its words in memory.
+        """
+        word_counts = Counter()
         with open(corpus_txt_path, "r", encoding="utf-8") as file:
-            corpus = file.read().lower()
-        print("Tokenizing corpus...")
-        words = re.findall(r"\w+", corpus)
-
-        print("Counting word frequencies...")
-        word_counts = Counter(words)
-
-        # Initialize tqdm progress bar
-        tqdm.pandas()
-
-        # Filter words by frequency using tqdm for progress indication
-        filtered_words = [
-            word
-            for word in tqdm(words, desc="Filtering words")
-            if word_counts[word] > min_frequency
-        ]
-
-        # Save filtered corpus with progress indication
-        with open(filtered_corpus_path, "w", encoding="utf-8") as file:
-            for word in tqdm(filtered_words, desc="Writing filtered corpus"):
-                file.write(f"{word} ")
+            for line in tqdm(file, desc="Counting word frequencies"):
+                word_counts.update(re.findall(r"\w+", line.lower()))
+
+        with open(corpus_txt_path, "r", encoding="utf-8") as file, open(
+            filtered_corpus_path, "w", encoding="utf-8"
+        ) as filtered_file:
+            for line in tqdm(file, desc="Writing filtered corpus"):
+                filtered_file.write(
+                    "".join(
+                        f"{word} "
+                        for word in re.findall(r"\w+", line.lower())
+                        if word_counts[word] > min_frequency
+                    )
+                )
 
     def create_and_save_spellcheck_dictionary(
         self,
@@ -132,7 +170,34 @@ class SpellChecker:
 
     def load_dictionary(self, dictionary_path: str) -> None:
         """Load the SymSpell dictionary from a pickle file."""
-        self.sym_spell.load_pickle(dictionary_path)
+        with self._lock:
+            self.sym_spell.load_pickle(dictionary_path)
+            self._clear_caches()
+
+    def _clear_caches(self) -> None:
+        self._query_cache.clear()
+        self._term_cache.clear()
+
+    def _correct_known_words(self, text: str, ignore_non_words: bool):
+        """
+        The correction of a query made only of dictionary words, numbers and acronyms,
+        without looking anything up: lookup_compound keeps all of them as they are.
+        None when a term would have to be looked up.
+        """
+        terms = helpers.parse_words(text)
+        cased_terms = helpers.parse_words(text, preserve_case=True) if ignore_non_words else None
+        words = self.sym_spell.words
+        corrected_terms = []
+        for i, term in enumerate(terms):
+            if ignore_non_words and helpers.try_parse_int64(term) is not None:
+                corrected_terms.append(term)
+            elif ignore_non_words and helpers.is_acronym(cased_terms[i]):
+                corrected_terms.append(cased_terms[i])
+            elif term in words:
+                corrected_terms.append(term)
+            else:
+                return None
+        return " ".join(corrected_terms)
 
     def correct_query(
         self, text: str, max_edit_distance: int = 2, ignore_non_words: bool = True
@@ -148,10 +213,52 @@ class SpellChecker:
             Whether to ignore non-words when correcting the query.
 
         """
-        suggestions = self.sym_spell.lookup_compound(
-            text, max_edit_distance=max_edit_distance, ignore_non_words=ignore_non_words
-        )
-        return suggestions[0].term if suggestions else text
+        key = (text, max_edit_distance, ignore_non_words)
+        corrected = self._query_cache.get(key)
+        if corrected is not None:
+            return corrected
+        with self._lock:
+            corrected = self._correct_known_words(text, ignore_non_words)
+            if corrected is None:
+                suggestions = self.sym_spell.lookup_compound(
+                    text, max_edit_distance=max_edit_distance, ignore_non_words=ignore_non_words
+                )
+                corrected = suggestions[0].term if suggestions else text
+            self._query_cache.set(key, corrected)
+        return corrected
+
+    def correct_queries(
+        self, texts: List[str], max_edit_distance: int = 2, ignore_non_words: bool = True
+    ) -> List[str]:
+        """Correct many queries at once, see correct_query."""
+        return [
+            self.correct_query(text, max_edit_distance, ignore_non_words) for text in texts
+        ]
+
+    def merge_dictionary_delta(
+        self, delta: Dict, min_frequency: int = DICTIONARY_MIN_FREQUENCY
+    ) -> None:
+        """
+        Add the word counts of a dictionary delta to the SymSpell dictionary.
+
+        delta: dict
+            {"monograms": {word: [count, total]}} with the total count of the word over the deltas.
+        min_frequency: int
+            New words are added once their total is above it, like the corpus was filtered.
+        """
+        with self._lock:
+            words = self.sym_spell.words
+            for word, (count, total) in delta["monograms"].items():
+                if word in words:
+                    self.sym_spell.create_dictionary_entry(word, count)
+                elif total > min_frequency:
+                    self.sym_spell.create_dictionary_entry(word, total)
+            self._clear_caches()
+
+    def save_snapshot(self, dictionary_path: str) -> None:
+        """Save the SymSpell dictionary with the merged deltas as a pickle file."""
+        with self._lock:
+            self.sym_spell.save_pickle(dictionary_path)
 
 
 def norvig_correction(word):
@@ -0,0 +1,99 @@
+import os
+import sys
+import time
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Awaitable
+
+sys.path.append(os.path.dirname(__file__))
+
+from common import get_logger
+from executors import (
+    endpoint_executors,
+    get_process_pool,
+    get_resource,
+    optional_resources,
+    resource_factories,
+    shutdown_executors,
+)
+
+logger = get_logger(__name__)
+
+startup_state = {
+    "status": "starting",
+    "started_at": time.time(),
+    "seconds": None,
+    "resources": {},
+}
+"""status is starting, ready or failed, with the loading state of every resource"""
+
+
+def is_ready() -> bool:
+    return startup_state["status"] == "ready"
+
+
+async def track_loading(name: str, loading: Awaitable):
+    resource_state = startup_state["resources"][name] = {"status": "loading"}
+    start_time = time.perf_counter()
+    try:
+        await loading
+    except Exception as e:
+        resource_state.update(status="failed", error=repr(e))
+        logger.exception("Failed to load %s", name)
+        raise
+    finally:
+        resource_state["seconds"] = time.perf_counter() - start_time
+    resource_state["status"] = "ready"
+    logger.info("Loaded %s in %.2f seconds", name, resource_state["seconds"])
+
+
+async def load_resources():
+    """
+    Load the required resources of every endpoint executor in parallel: in the process
+    pool workers for the process mode endpoints, in threads of this process otherwise.
+    Optional resources are left to be loaded by their first call.
+    """
+    start_time = time.perf_counter()
+    local_resources = set()
+    process_resources = set()
+    for executor in endpoint_executors.values():
+        required = [
+            name for name in executor.resources
+            if name in resource_factories and name not in optional_resources
+        ]
+        if executor.mode == "process":
+            process_resources.update(required)
+        else:
+            local_resources.update(required)
+    for name in optional_resources:
+        startup_state["resources"][name] = {"status": "lazy"}
+
+    tasks = []
+    if process_resources:
+        # the workers are forked by the first submit, before any loading thread starts,
+        # and run the preloading initializer before taking the call
+        future = get_process_pool().submit(int)
+        tasks.append(track_loading("process_pool", asyncio.wrap_future(future)))
+    for name in sorted(local_resources):
+        tasks.append(track_loading(name, asyncio.to_thread(get_resource, name)))
+
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    startup_state["seconds"] = time.perf_counter() - start_time
+    if any(isinstance(result, Exception) for result in results):
+        startup_state["status"] = "failed"
+    else:
+        startup_state["status"] = "ready"
+    logger.info(
+        "Startup %s in %.2f seconds", startup_state["status"], startup_state["seconds"]
+    )
+
+
+@asynccontextmanager
+async def lifespan(app):
+    """FastAPI lifespan: serve right away and load the models in the background"""
+    loading_task = asyncio.create_task(load_resources())
+    try:
+        yield
+    finally:
+        loading_task.cancel()
+        shutdown_executors()
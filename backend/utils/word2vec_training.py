@@ -0,0 +1,238 @@
+import os
+import sys
+import time
+import hashlib
+import argparse
+import orjson
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Iterator, List, Optional
+from tqdm import tqdm
+
+sys.path.append(os.path.dirname(__file__))
+
+from constant import DATA_PATH, QUERY_EXPANSION_MODEL_PATH, Source
+from common import get_preprocessed_words
+from corpus_statistics import get_csv_paths, read_articles
+from word_vector_index import build_word_vector_index, get_index_path
+from word_vectors import WordVectors, get_exported_paths
+
+SHARD_CACHE_PATH = os.path.join(QUERY_EXPANSION_MODEL_PATH, "corpus_shards")
+
+
+def get_default_workers() -> int:
+    # leave two cores to the rest of the machine, but always train with at least one worker
+    return max(1, (os.cpu_count() or 1) - 2)
+
+
+def get_shard_path(csv_path: str, shard_cache_path: str = SHARD_CACHE_PATH) -> str:
+    """The cached shard of a csv file, a changed csv file gets a new shard"""
+    stat = os.stat(csv_path)
+    key = f"{os.path.abspath(csv_path)}:{stat.st_size}:{stat.st_mtime_ns}"
+    name = os.path.splitext(os.path.basename(csv_path))[0]
+    return os.path.join(shard_cache_path, f"{name}-{hashlib.blake2b(key.encode(), digest_size=8).hexdigest()}.txt")
+
+
+def preprocess_csv_file(csv_path: str, shard_path: str, chunk_size: int = 1000) -> str:
+    """
+    Write the unstemmed words of every article of a csv file as one line of a shard, like
+    create_unstemmed_pickle_list. The shard is renamed into place once complete.
+    """
+    temporary_path = f"{shard_path}.{os.getpid()}.tmp"
+    with open(temporary_path, "w", encoding="utf-8") as file:
+        for articles in read_articles(csv_path, chunk_size):
+            for article in articles:
+                words = get_preprocessed_words(article, stemming=False)
+                if words:
+                    file.write(" ".join(words) + "\n")
+    os.replace(temporary_path, shard_path)
+    return shard_path
+
+
+def preprocess_corpus(
+    csv_paths: List[str],
+    shard_cache_path: str = SHARD_CACHE_PATH,
+    workers: int = get_default_workers(),
+    chunk_size: int = 1000,
+) -> List[str]:
+    """Preprocess the csv files without a cached shard in parallel, returns the shards of all of them"""
+    os.makedirs(shard_cache_path, exist_ok=True)
+    shard_paths = [get_shard_path(csv_path, shard_cache_path) for csv_path in csv_paths]
+    missing = [
+        (csv_path, shard_path)
+        for csv_path, shard_path in zip(csv_paths, shard_paths)
+        if not os.path.exists(shard_path)
+    ]
+    print(f"{len(csv_paths) - len(missing)} of {len(csv_paths)} csv files are already preprocessed")
+    if missing:
+        with ProcessPoolExecutor(max_workers=min(workers, len(missing))) as executor:
+            futures = [
+                executor.submit(preprocess_csv_file, csv_path, shard_path, chunk_size)
+                for csv_path, shard_path in missing
+            ]
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Preprocessing"):
+                future.result()
+    return shard_paths
+
+
+class ShardedCorpus:
+    """
+    The preprocessed articles of the shards, streamed from disk every time it is iterated,
+    so gensim can make several passes over it without the corpus being held in memory.
+    """
+
+    def __init__(self, shard_paths: List[str]):
+        self.shard_paths = shard_paths
+
+    def __iter__(self) -> Iterator[List[str]]:
+        for shard_path in self.shard_paths:
+            with open(shard_path, "r", encoding="utf-8") as file:
+                for line in file:
+                    yield line.split()
+
+
+def _read_checkpoint_state(checkpoint_path: str) -> Optional[dict]:
+    state_path = checkpoint_path + ".json"
+    if not os.path.exists(checkpoint_path) or not os.path.exists(state_path):
+        return None
+    with open(state_path, "rb") as file:
+        return orjson.loads(file.read())
+
+
+def _save_checkpoint(model, checkpoint_path: str, state: dict):
+    model.save(checkpoint_path)
+    # the state is written last, so it never points at a model that was not saved
+    with open(checkpoint_path + ".json", "wb") as file:
+        file.write(orjson.dumps(state))
+
+
+def remove_exported_files(model_path: str):
+    """Remove the exported vectors and the index of a model, they are stale once it is trained again"""
+    for path in get_exported_paths(model_path) + [get_index_path(model_path)]:
+        if os.path.exists(path):
+            os.remove(path)
+            print(f"Removed the stale {path}")
+
+
+def train_word2vec(
+    corpus: ShardedCorpus,
+    output_path: str,
+    vector_size: int = 200,
+    window_size: int = 10,
+    min_count: int = 1,
+    epochs: int = 5,
+    workers: int = get_default_workers(),
+    checkpoint_path: Optional[str] = None,
+    alpha: float = 0.025,
+    min_alpha: float = 0.0001,
+):
+    """
+    Train a word2vec model one epoch at a time, with the learning rate decayed from `alpha` to
+    `min_alpha` over all the epochs like a single train call does. The model is checkpointed after
+    the vocabulary and after every epoch, and a run with the same settings resumes from the last
+    checkpoint.
+    """
+    from gensim.models import Word2Vec
+
+    checkpoint_path = checkpoint_path or output_path + ".checkpoint"
+    settings = {
+        "vector_size": vector_size,
+        "window": window_size,
+        "min_count": min_count,
+        "epochs": epochs,
+        # train overwrites alpha, min_alpha and epochs of the model, the schedule uses these
+        "alpha": alpha,
+        "min_alpha": min_alpha,
+        "shards": corpus.shard_paths,
+    }
+    state = _read_checkpoint_state(checkpoint_path)
+    if state is not None and state["settings"] == settings:
+        model = Word2Vec.load(checkpoint_path)
+        model.workers = workers
+        print(f"Resuming from {checkpoint_path} after {state['completed_epochs']} epochs")
+    else:
+        model = Word2Vec(
+            vector_size=vector_size,
+            window=window_size,
+            min_count=min_count,
+            workers=workers,
+            epochs=epochs,
+            alpha=alpha,
+            min_alpha=min_alpha,
+        )
+        start_time = time.time()
+        model.build_vocab(corpus)
+        print(f"Built a vocabulary of {len(model.wv)} words in {time.time() - start_time:.2f} seconds")
+        state = {"settings": settings, "completed_epochs": 0}
+        _save_checkpoint(model, checkpoint_path, state)
+
+    alpha, min_alpha = state["settings"]["alpha"], state["settings"]["min_alpha"]
+    for epoch in range(state["completed_epochs"], epochs):
+        start_time = time.time()
+        model.train(
+            corpus,
+            total_examples=model.corpus_count,
+            epochs=1,
+            start_alpha=alpha - (alpha - min_alpha) * epoch / epochs,
+            end_alpha=alpha - (alpha - min_alpha) * (epoch + 1) / epochs,
+        )
+        model.alpha, model.min_alpha, model.epochs = alpha, min_alpha, epochs
+        state["completed_epochs"] = epoch + 1
+        _save_checkpoint(model, checkpoint_path, state)
+        print(f"Trained epoch {epoch + 1} of {epochs} in {time.time() - start_time:.2f} seconds")
+
+    model.save(output_path)
+    remove_exported_files(output_path)
+    return model
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train the word2vec model of the query expansion on the csv data")
+    parser.add_argument("--data-path", default=DATA_PATH)
+    parser.add_argument("--sources", nargs="+", choices=[source.value for source in Source])
+    parser.add_argument("--shard-cache", default=SHARD_CACHE_PATH, help="folder of the preprocessed csv files")
+    parser.add_argument("--vector-size", type=int, default=200)
+    parser.add_argument("--window-size", type=int, default=10)
+    parser.add_argument("--min-count", type=int, default=1)
+    parser.add_argument("--epochs", type=int, default=5)
+    parser.add_argument("--workers", type=int, default=get_default_workers())
+    parser.add_argument("--chunk-size", type=int, default=1000, help="csv rows read at a time")
+    parser.add_argument(
+        "--export-dtype",
+        choices=["float32", "float16", "int8"],
+        help="also export the vectors for memory mapping, see word_vectors.py",
+    )
+    parser.add_argument(
+        "--build-index",
+        action="store_true",
+        help="also build the nearest neighbour index with its defaults, see word_vector_index.py",
+    )
+    args = parser.parse_args()
+
+    output_path = os.path.join(
+        QUERY_EXPANSION_MODEL_PATH, f"word2vec_{args.vector_size}_{args.window_size}.model"
+    )
+    csv_paths = get_csv_paths(args.data_path, args.sources)
+    shard_paths = preprocess_corpus(csv_paths, args.shard_cache, args.workers, args.chunk_size)
+    model = train_word2vec(
+        ShardedCorpus(shard_paths),
+        output_path,
+        vector_size=args.vector_size,
+        window_size=args.window_size,
+        min_count=args.min_count,
+        epochs=args.epochs,
+        workers=args.workers,
+    )
+    print(f"Saved {output_path}")
+
+    word_vectors = WordVectors.from_keyed_vectors(model.wv)
+    if args.export_dtype:
+        word_vectors = word_vectors.quantize(args.export_dtype)
+        word_vectors.save(output_path)
+        print(f"Exported the {args.export_dtype} vectors of {output_path}")
+
+    if args.build_index:
+        start_time = time.time()
+        index = build_word_vector_index(word_vectors.get_vectors(np.arange(len(word_vectors.index_to_key))))
+        index.save(get_index_path(output_path))
+        print(f"Saved {get_index_path(output_path)} in {time.time() - start_time:.2f} seconds")
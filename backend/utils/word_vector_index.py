@@ -0,0 +1,219 @@
+import os
+import sys
+import time
+import argparse
+import numpy as np
+from typing import List, Optional, Tuple
+
+sys.path.append(os.path.dirname(__file__))
+
+from constant import QUERY_EXPANSION_MODEL_PATH
+
+INDEX_SUFFIX = ".ivf.npz"
+
+
+def get_index_path(model_path: str) -> str:
+    return model_path + INDEX_SUFFIX
+
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return (vectors / np.maximum(norms, 1e-12)).astype(np.float32)
+
+
+def _top_k(similarities: np.ndarray, k: int) -> np.ndarray:
+    """Positions of the k highest similarities of every row, highest first"""
+    k = min(k, similarities.shape[1])
+    if k <= 0:
+        return np.empty((similarities.shape[0], 0), dtype=np.int64)
+    top = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(similarities, top, axis=1), axis=1, kind="stable")
+    return np.take_along_axis(top, order, axis=1)
+
+
+class WordVectorIndex:
+    """
+    Approximate nearest neighbours of normalized word vectors with an inverted file:
+    the vectors are grouped by their closest centroid, and a query is only compared with the
+    vectors of the `nprobe` lists of its closest centroids.
+    The neighbours of the most frequent words are computed exactly when the index is built.
+    """
+
+    DEFAULT_NPROBE = 16
+
+    def __init__(
+        self,
+        centroids: np.ndarray,
+        list_offsets: np.ndarray,
+        list_items: np.ndarray,
+        neighbours: np.ndarray,
+        neighbour_similarities: np.ndarray,
+    ):
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_items = list_items
+        # row i holds the neighbours of the word i, for the words ranked under len(neighbours)
+        self.neighbours = neighbours
+        self.neighbour_similarities = neighbour_similarities
+
+    @classmethod
+    def load(cls, path: str) -> "WordVectorIndex":
+        with np.load(path) as data:
+            return cls(
+                data["centroids"],
+                data["list_offsets"],
+                data["list_items"],
+                data["neighbours"],
+                data["neighbour_similarities"],
+            )
+
+    def save(self, path: str):
+        with open(path, "wb") as file:
+            np.savez(
+                file,
+                centroids=self.centroids,
+                list_offsets=self.list_offsets,
+                list_items=self.list_items,
+                neighbours=self.neighbours,
+                neighbour_similarities=self.neighbour_similarities,
+            )
+
+    def get_cached_neighbours(self, index: int, topn: int) -> Optional[List[Tuple[int, float]]]:
+        """The exact neighbours of a frequent word, None when they were not computed"""
+        if index >= len(self.neighbours) or topn > self.neighbours.shape[1]:
+            return None
+        return list(
+            zip(self.neighbours[index, :topn].tolist(), self.neighbour_similarities[index, :topn].tolist())
+        )
+
+    def search(
+        self,
+        query_vectors: np.ndarray,
+        word_vectors,
+        topn: int,
+        nprobe: int = DEFAULT_NPROBE,
+        exclude: Optional[List[int]] = None,
+    ) -> List[List[Tuple[int, float]]]:
+        """
+        (word index, cosine similarity) of the `topn` approximate neighbours of every normalized
+        query vector, the queries of a batch are compared with the union of their probed lists.
+        `word_vectors` is the WordVectors of the vocabulary, only the probed vectors are read.
+        `exclude` gives a word index to leave out of the neighbours of every query.
+        """
+        nprobe = min(nprobe, len(self.centroids))
+        probes = _top_k(query_vectors @ self.centroids.T, nprobe)
+        candidates = np.concatenate(
+            [
+                self.list_items[self.list_offsets[list_id] : self.list_offsets[list_id + 1]]
+                for list_id in np.unique(probes)
+            ]
+        )
+        similarities = query_vectors @ word_vectors.get_vectors(candidates).T
+        if exclude is not None:
+            for row, index in enumerate(exclude):
+                if index is not None:
+                    similarities[row, candidates == index] = -np.inf
+        results = []
+        for row, top in enumerate(_top_k(similarities, topn)):
+            results.append(
+                [
+                    (int(candidates[position]), float(similarities[row, position]))
+                    for position in top
+                    if similarities[row, position] != -np.inf
+                ]
+            )
+        return results
+
+
+def train_centroids(
+    vectors: np.ndarray, nlist: int, iterations: int = 20, sample_size: int = 200000, seed: int = 0
+) -> np.ndarray:
+    """Spherical k-means on a sample of the normalized vectors"""
+    rng = np.random.default_rng(seed)
+    sample = vectors[rng.choice(len(vectors), min(sample_size, len(vectors)), replace=False)]
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+    for _ in range(iterations):
+        labels = assign_lists(sample, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, sample)
+        sizes = np.bincount(labels, minlength=nlist)
+        empty = sizes == 0
+        # restart the empty lists from random vectors
+        sums[empty] = sample[rng.choice(len(sample), int(empty.sum()), replace=False)]
+        centroids = normalize_rows(sums)
+    return centroids
+
+
+def assign_lists(vectors: np.ndarray, centroids: np.ndarray, chunk_size: int = 8192) -> np.ndarray:
+    return np.concatenate(
+        [
+            np.argmax(vectors[start : start + chunk_size] @ centroids.T, axis=1)
+            for start in range(0, len(vectors), chunk_size)
+        ]
+    )
+
+
+def exact_neighbours(
+    vectors: np.ndarray, num_words: int, topn: int, chunk_size: int = 1024
+) -> Tuple[np.ndarray, np.ndarray]:
+    """The `topn` neighbours of the first `num_words` normalized vectors, themselves excluded"""
+    num_words = min(num_words, len(vectors))
+    neighbours = np.empty((num_words, topn), dtype=np.int32)
+    similarities = np.empty((num_words, topn), dtype=np.float32)
+    for start in range(0, num_words, chunk_size):
+        end = min(start + chunk_size, num_words)
+        chunk_similarities = vectors[start:end] @ vectors.T
+        chunk_similarities[np.arange(end - start), np.arange(start, end)] = -np.inf
+        top = _top_k(chunk_similarities, topn)
+        neighbours[start:end] = top
+        similarities[start:end] = np.take_along_axis(chunk_similarities, top, axis=1)
+    return neighbours, similarities
+
+
+def build_word_vector_index(
+    vectors: np.ndarray,
+    nlist: Optional[int] = None,
+    iterations: int = 20,
+    frequent_words: int = 20000,
+    neighbours: int = 10,
+) -> WordVectorIndex:
+    """
+    Build the index of the word vectors, given in the order of the vocabulary.
+    The vocabulary of gensim is sorted by frequency, so the first words are the frequent ones.
+    """
+    vectors = normalize_rows(vectors)
+    nlist = nlist or max(1, min(len(vectors), int(4 * np.sqrt(len(vectors)))))
+    centroids = train_centroids(vectors, nlist, iterations)
+    labels = assign_lists(vectors, centroids)
+    list_items = np.argsort(labels, kind="stable").astype(np.int32)
+    list_offsets = np.concatenate([[0], np.cumsum(np.bincount(labels, minlength=nlist))]).astype(np.int64)
+    frequent_neighbours, frequent_similarities = exact_neighbours(vectors, frequent_words, neighbours)
+    return WordVectorIndex(centroids, list_offsets, list_items, frequent_neighbours, frequent_similarities)
+
+
+if __name__ == "__main__":
+    from gensim.models import Word2Vec
+    from word_vectors import WordVectors, has_exported_vectors
+
+    parser = argparse.ArgumentParser(description="Build the nearest neighbour index of a word2vec model")
+    parser.add_argument("--model", default="word2vec_200_10.model", help="model file in the word2vec folder")
+    parser.add_argument("--nlist", type=int, default=None, help="number of lists, 4 * sqrt(vocabulary) by default")
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--frequent-words", type=int, default=20000, help="words with exact neighbours")
+    parser.add_argument("--neighbours", type=int, default=10, help="exact neighbours kept per frequent word")
+    args = parser.parse_args()
+
+    model_path = os.path.join(QUERY_EXPANSION_MODEL_PATH, args.model)
+    start_time = time.time()
+    if has_exported_vectors(model_path):
+        word_vectors = WordVectors.load(model_path)
+    else:
+        word_vectors = WordVectors.from_keyed_vectors(Word2Vec.load(model_path).wv)
+    print(f"Loaded {len(word_vectors.index_to_key)} word vectors in {time.time() - start_time:.2f} seconds")
+
+    start_time = time.time()
+    index = build_word_vector_index(
+        word_vectors.get_vectors(np.arange(len(word_vectors.index_to_key))), args.nlist, args.iterations, args.frequent_words, args.neighbours
+    )
+    index.save(get_index_path(model_path))
+    print(f"Saved {get_index_path(model_path)} in {time.time() - start_time:.2f} seconds")
@@ -0,0 +1,146 @@
+import os
+import sys
+import time
+import argparse
+import numpy as np
+from typing import List, Optional, Tuple
+
+sys.path.append(os.path.dirname(__file__))
+
+from constant import QUERY_EXPANSION_MODEL_PATH
+
+VECTORS_SUFFIX = ".vectors.npy"
+SCALES_SUFFIX = ".scales.npy"
+VOCAB_SUFFIX = ".vocab.txt"
+
+
+def is_up_to_date(path: str, *source_paths: str) -> bool:
+    """Whether a file built from a model exists and was written after its source files changed"""
+    if not os.path.exists(path):
+        return False
+    built_time = os.path.getmtime(path)
+    return all(
+        os.path.getmtime(source_path) <= built_time for source_path in source_paths if os.path.exists(source_path)
+    )
+
+
+def get_exported_paths(model_path: str) -> List[str]:
+    return [model_path + suffix for suffix in (VECTORS_SUFFIX, SCALES_SUFFIX, VOCAB_SUFFIX)]
+
+
+def has_exported_vectors(model_path: str) -> bool:
+    """Whether the vectors of the model were exported, after the model was last saved"""
+    return is_up_to_date(model_path + VECTORS_SUFFIX, model_path) and is_up_to_date(
+        model_path + VOCAB_SUFFIX, model_path
+    )
+
+
+class WordVectors:
+    """
+    Normalized word vectors in the order of the vocabulary, stored in float32, float16, or in int8
+    with a float32 scale per word.
+    Exported vectors are memory-mapped read-only, so the processes of a server share the pages
+    of the file instead of holding their own copy.
+    """
+
+    def __init__(self, index_to_key: List[str], vectors: np.ndarray, scales: Optional[np.ndarray] = None):
+        self.index_to_key = index_to_key
+        self.key_to_index = {word: index for index, word in enumerate(index_to_key)}
+        self.vectors = vectors
+        self.scales = scales
+
+    @classmethod
+    def from_keyed_vectors(cls, wv) -> "WordVectors":
+        """The vectors of a gensim model, in memory"""
+        return cls(list(wv.index_to_key), wv.get_normed_vectors().astype(np.float32))
+
+    @classmethod
+    def load(cls, model_path: str, mmap_mode: Optional[str] = "r") -> "WordVectors":
+        with open(model_path + VOCAB_SUFFIX, "r", encoding="utf-8") as file:
+            index_to_key = file.read().split("\n")
+        vectors = np.load(model_path + VECTORS_SUFFIX, mmap_mode=mmap_mode)
+        scales = None
+        if vectors.dtype == np.int8:
+            scales = np.load(model_path + SCALES_SUFFIX, mmap_mode=mmap_mode)
+        return cls(index_to_key, vectors, scales)
+
+    def save(self, model_path: str):
+        with open(model_path + VOCAB_SUFFIX, "w", encoding="utf-8") as file:
+            file.write("\n".join(self.index_to_key))
+        np.save(model_path + VECTORS_SUFFIX, self.vectors)
+        if self.scales is not None:
+            np.save(model_path + SCALES_SUFFIX, self.scales)
+
+    def quantize(self, dtype: str) -> "WordVectors":
+        """The same vectors in float16 or in int8 with a scale per word"""
+        vectors = self.get_vectors(np.arange(len(self.index_to_key)))
+        if dtype == "float16":
+            return WordVectors(self.index_to_key, vectors.astype(np.float16))
+        if dtype == "int8":
+            scales = np.maximum(np.abs(vectors).max(axis=1), 1e-12) / 127
+            quantized = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+            return WordVectors(self.index_to_key, quantized, scales.astype(np.float32))
+        if dtype == "float32":
+            return WordVectors(self.index_to_key, vectors)
+        raise ValueError(f"Unknown dtype {dtype}")
+
+    def get_vectors(self, indices) -> np.ndarray:
+        """The float32 vectors of the words at the indices, only these rows are read"""
+        vectors = np.asarray(self.vectors[indices], dtype=np.float32)
+        if self.scales is not None:
+            vectors = vectors * self.scales[indices][:, None]
+        return vectors
+
+    def most_similar(
+        self, indices: List[int], topn: int, chunk_size: int = 65536
+    ) -> List[List[Tuple[int, float]]]:
+        """
+        (word index, cosine similarity) of the `topn` most similar words of every word at the
+        indices, like the most_similar of gensim, the vectors are read by chunks
+        """
+        query_vectors = self.get_vectors(indices)
+        best_indices = np.empty((len(indices), 0), dtype=np.int64)
+        best_similarities = np.empty((len(indices), 0), dtype=np.float32)
+        for start in range(0, len(self.index_to_key), chunk_size):
+            chunk_indices = np.arange(start, min(start + chunk_size, len(self.index_to_key)))
+            similarities = query_vectors @ self.get_vectors(chunk_indices).T
+            for row, index in enumerate(indices):
+                if start <= index < start + len(chunk_indices):
+                    similarities[row, index - start] = -np.inf
+            best_indices = np.concatenate([best_indices, np.broadcast_to(chunk_indices, similarities.shape)], axis=1)
+            best_similarities = np.concatenate([best_similarities, similarities], axis=1)
+            k = min(topn, best_similarities.shape[1])
+            top = np.argpartition(-best_similarities, k - 1, axis=1)[:, :k]
+            best_indices = np.take_along_axis(best_indices, top, axis=1)
+            best_similarities = np.take_along_axis(best_similarities, top, axis=1)
+        order = np.argsort(-best_similarities, axis=1, kind="stable")
+        return [
+            [
+                (int(index), float(similarity))
+                for index, similarity in zip(row_indices, row_similarities)
+                if similarity != -np.inf
+            ]
+            for row_indices, row_similarities in zip(
+                np.take_along_axis(best_indices, order, axis=1),
+                np.take_along_axis(best_similarities, order, axis=1),
+            )
+        ]
+
+
+if __name__ == "__main__":
+    from gensim.models import Word2Vec
+
+    parser = argparse.ArgumentParser(
+        description="Export the word vectors of a word2vec model to memory-mappable files"
+    )
+    parser.add_argument("--model", default="word2vec_200_10.model", help="model file in the word2vec folder")
+    parser.add_argument("--dtype", default="float16", choices=["float32", "float16", "int8"])
+    args = parser.parse_args()
+
+    model_path = os.path.join(QUERY_EXPANSION_MODEL_PATH, args.model)
+    start_time = time.time()
+    word_vectors = WordVectors.from_keyed_vectors(Word2Vec.load(model_path).wv)
+    print(f"Loaded {len(word_vectors.index_to_key)} word vectors in {time.time() - start_time:.2f} seconds")
+
+    word_vectors.quantize(args.dtype).save(model_path)
+    print(f"Saved the {args.dtype} vectors to {model_path + VECTORS_SUFFIX}")